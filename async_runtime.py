@@ -0,0 +1,114 @@
+'''
+  async_runtime.py
+  Runs the smartplug timer as asyncio tasks (uasyncio on MicroPython)
+
+  Event dispatch, the web server, NTP resync, plug state polling and the display each run as a separate task.
+  Matured events are sent concurrently in their own task so one slow plug or browser cannot delay other events.
+  Tasks are started by start_task, which keeps a reference to each one until it ends and prints its exception.
+'''
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+import timer_utils
+from timer_utils import const
+from smartplug_timer import MAX_WAIT_MS
+
+NTP_CHECK_SECS = const(600) # how often to check if the hourly ntp resync is due
+NTP_ATTEMPTS = const(2)
+NTP_RETRY_SECS = const(2) # the loop keeps running while an ntp retry waits
+DISPLAY_CHECK_SECS = const(1)
+
+class Async_Runtime(object):
+
+    def __init__(self, timer):
+        self.timer = timer
+        self.wakeup = asyncio.Event() # set when the event queue may have changed
+        self.offload_task = None
+        self.tasks = set() # the loop only holds weak references to tasks on CPython
+
+    def start_task(self, coro):
+        self.tasks = set(task for task in self.tasks if not task.done())
+        task = asyncio.create_task(self.run_task(coro))
+        self.tasks.add(task)
+        return task
+
+    async def run_task(self, coro):
+        # an exception in a task nobody awaits would otherwise go unseen
+        try:
+            return await coro
+        except Exception as e:
+            print("task failed: {!r}".format(e))
+
+    async def dispatch_task(self):
+        timer = self.timer
+        while True:
+            if timer.clock_jumped():
+                self.start_task(self.send_events(timer.reconcile_events(timer.utils.timestamp_now())))
+            timer.extend_schedule() # loads the next day's window when it is needed
+            # on-device timer pushes wait on the plugs, so they get their own task, one at a time
+            if timer.offload_due and (self.offload_task is None or self.offload_task.done()):
+                self.offload_task = self.start_task(timer.async_offload_timers())
+            timer.observe_pushed()
+            timeout = min(max(timer.ms_to_next_event(), 0), MAX_WAIT_MS)
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout / 1000)
+            except asyncio.TimeoutError:
+                pass
+            events = timer.get_due_events(timer.utils.timestamp_now())
+            if events:
+                self.start_task(self.send_events(events))
+
+    async def send_events(self, events):
+        await self.timer.dispatcher.dispatch(events)
+        self.timer.display_status()
+
+    async def serve_client(self, reader, writer):
+        await self.timer.webserver.serve_client(reader, writer)
+        self.wakeup.set() # a posted config change may have rescheduled the events
+
+    async def sync_clock(self):
+        # utils.check_sync, but the wait between ntp attempts is an asyncio.sleep instead of time.sleep
+        utils = self.timer.utils
+        if utils.is_synced():
+            return False
+        for attempt in range(NTP_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(NTP_RETRY_SECS)
+            if utils.set_clock(utils.pico_rtc_setter, attempts=1):
+                return True
+        return False
+
+    async def ntp_task(self):
+        while True:
+            await asyncio.sleep(NTP_CHECK_SECS)
+            if timer_utils.upython and await self.sync_clock():
+                self.wakeup.set() # the clock may have stepped
+
+    async def poll_task(self):
+        # reads back the plug states every poll interval, alongside dispatch
+        poller = self.timer.poller
+        while True:
+            self.timer.observe_states(await poller.poll())
+            await asyncio.sleep(poller.interval_secs)
+
+    async def display_task(self):
+        while True:
+            self.timer.check_display_trigger(self.timer.utils.timestamp_now())
+            await asyncio.sleep(DISPLAY_CHECK_SECS)
+
+    async def main(self):
+        self.timer.webserver.close() # the port is served by asyncio instead
+        self.server = await asyncio.start_server(self.serve_client, '0.0.0.0', 80)
+        print('asyncio runtime listening on port 80')
+        self.start_task(self.ntp_task())
+        self.start_task(self.display_task())
+        if self.timer.poller:
+            self.start_task(self.poll_task())
+        await self.dispatch_task()
+
+    def run(self):
+        asyncio.run(self.main())
@@ -0,0 +1,104 @@
+'''
+  dispatch.py
+  Sends all the events that matured in the same tick concurrently
+
+  Events are sent by a bounded pool of asyncio worker tasks, each plug command has its own deadline,
+  so a fleet switches in about one network round trip rather than one round trip per plug.
+  Drivers with async_set_states (e.g. My_Kasa) are given the whole tick at once instead, so the
+  outlets of a strip switching to the same state share one command, those drivers put the deadline
+  on each device.
+  Either way a plug with several events in the tick is sent only its last state, and each of its
+  events gets the result of that command. elapsed_ms in the results is the plug's own command time
+  when sent per plug, but the whole batch's time for a driver with async_set_states.
+'''
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+from timer_utils import const
+from loop_utils import run_until_complete
+
+MAX_WORKERS = const(8) # most plug commands in flight at once
+DEADLINE_MS = const(3000) # default time allowed for each plug command
+
+
+def reply_ok(reply):
+    # a driver reply is ok if there is one and it does not report an error (see kasa_reply)
+    return reply is not None and getattr(reply, 'ok', True)
+
+
+class Batch_Dispatcher(object):
+
+    def __init__(self, smartplug, utils, max_workers=MAX_WORKERS, deadline_ms=DEADLINE_MS):
+        self.smartplug = smartplug
+        self.utils = utils  # Time_utils, used for ticks
+        self.max_workers = max_workers
+        self.deadline_ms = deadline_ms
+        self.plug_deadlines = {} # optional deadline in ms keyed by plug index, overrides deadline_ms (per plug sends)
+
+    async def send(self, event):
+        # returns (event, ok, elapsed_ms), ok is False if the plug did not reply within its deadline
+        start = self.utils.ticks_ms()
+        deadline_ms = self.plug_deadlines.get(event.index, self.deadline_ms)
+        try:
+            reply = await asyncio.wait_for(
+                self.smartplug.async_set_plug_state(event.index, event.state), deadline_ms / 1000)
+            ok = reply_ok(reply)
+        except asyncio.TimeoutError:
+            print("plug index {} missed its {} ms deadline".format(event.index, deadline_ms))
+            ok = False
+        return event, ok, self.utils.ticks_diff(self.utils.ticks_ms(), start)
+
+    async def send_batch(self, events):
+        # sends the events in one driver call, returns a list of (event, ok, elapsed_ms) in event order
+        # the driver puts a deadline on each device and backend (see My_Kasa and Driver_Registry), so a plug
+        # that misses it fails alone and the replies that did arrive are kept, an earlier event for a plug
+        # also in a later event is not sent as only the plug's final state matters
+        # the driver does not time each reply, so elapsed_ms is the time the whole batch took
+        start = self.utils.ticks_ms()
+        states = {}
+        for event in events:
+            states[event.index] = event.state
+        replies = await self.smartplug.async_set_states(list(states.items()))
+        elapsed_ms = self.utils.ticks_diff(self.utils.ticks_ms(), start)
+        return [(event, reply_ok(replies.get(event.index)), elapsed_ms) for event in events]
+
+    async def dispatch(self, events):
+        # sends the given events concurrently, returns a list of (event, ok, elapsed_ms) in event order
+        if hasattr(self.smartplug, 'async_set_states'):
+            results = await self.send_batch(events)
+            print("dispatched {} events ({} ok) in one batch of {} ms".format(
+                len(events), len([r for r in results if r[1]]), results[0][2] if results else 0))
+            return results
+        # as in send_batch only each plug's last event is sent, concurrent commands to one plug could land in any order
+        last = {} # plug index -> position of its last event
+        for i, event in enumerate(events):
+            last[event.index] = i
+        sends = sorted(last.values())
+        results = [None] * len(events)
+        next_send = [0]  # shared by the workers
+
+        async def worker():
+            while next_send[0] < len(sends):
+                i = sends[next_send[0]]
+                next_send[0] += 1
+                results[i] = await self.send(events[i])
+
+        start = self.utils.ticks_ms()
+        await asyncio.gather(*[worker() for _ in range(min(self.max_workers, len(sends)))])
+        for i, event in enumerate(events):
+            if results[i] is None: # superseded by a later event for the plug
+                results[i] = (event,) + results[last[event.index]][1:]
+        if len(events) > 1:
+            nbr_ok = len([r for r in results if r[1]])
+            print("dispatched {} events ({} ok) in {} ms".format(len(events), nbr_ok,
+                self.utils.ticks_diff(self.utils.ticks_ms(), start)))
+        return results
+
+    def dispatch_now(self, events):
+        # blocking version of dispatch for the non asyncio main loop, every tick runs on the same loop
+        if not events:
+            return []
+        return run_until_complete(self.dispatch(events))
@@ -0,0 +1,240 @@
+'''
+  driver_registry.py
+  Drives a fleet of Kasa and Tasmota plugs together
+
+  Each plug in the timer's plugs tuple names its backend in an optional fourth field,
+  (plug index, inversion, profile or None, backend). The backend is a name from BACKENDS, where
+  the plug index is also the plug's index in that driver's smartplugs tuple, or a (name, driver
+  index) pair when the timer's plug indices and the driver's differ. Plugs without one use
+  DEFAULT_BACKEND. Only the drivers in use are loaded.
+  Driver_Registry has the interface of a single driver. A batch of (plug index, state) pairs is split
+  by backend and each driver's batch call runs concurrently, so a mixed fleet switches in the time of
+  the slowest backend rather than the sum of its plugs. get_states reads back the fleet the same way.
+'''
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+from loop_utils import run_until_complete
+
+BACKENDS = { # backend name -> (module, driver class)
+    'kasa': ('my_kasa', 'My_Kasa'),
+    'tasmota': ('my_tasmota', 'my_tasmota'),
+    'tasmota_mqtt': ('my_tasmota_mqtt', 'my_tasmota_mqtt')}
+DEFAULT_BACKEND = 'kasa'
+BACKEND_DEADLINE_MS = 4000 # time allowed for each backend's batch, longer than the drivers' own device deadlines
+
+
+def load_driver(name):
+    module_name, class_name = BACKENDS[name]
+    return getattr(__import__(module_name), class_name)()
+
+
+def plug_backend(plug, default=DEFAULT_BACKEND):
+    # returns (backend name, driver index) for a plugs tuple entry
+    backend = plug[3] if len(plug) > 3 and plug[3] else default
+    if isinstance(backend, str):
+        return backend, plug[0]
+    return backend[0], backend[1]
+
+
+class Driver_Registry(object):
+
+    def __init__(self, plugs, drivers=None, default=DEFAULT_BACKEND):
+        # drivers is an optional dict of backend name -> driver, to use instead of loading the backend
+        self.default = default
+        self.deadline_ms = BACKEND_DEADLINE_MS
+        self.drivers = dict(drivers) if drivers else {}
+        self.routes = {} # plug index -> (backend name, driver index)
+        self.indices = {} # (backend name, driver index) -> plug index
+        for plug in plugs:
+            route = plug_backend(plug, default)
+            self.driver(route[0])
+            self.routes[plug[0]] = route
+            self.indices[route] = plug[0]
+
+    def driver(self, name):
+        if name not in self.drivers:
+            self.drivers[name] = load_driver(name)
+        return self.drivers[name]
+
+    def route(self, index):
+        # returns (backend name, driver index), plugs not in plugs use the default backend
+        return self.routes.get(index, (self.default, index))
+
+    def plug_driver(self, index):
+        # returns (driver, driver index) for the plug
+        name, driver_index = self.route(index)
+        return self.driver(name), driver_index
+
+    def split(self, items):
+        # groups (plug index, value) pairs by backend, returns backend name -> list of (driver index, value)
+        batches = {}
+        for index, value in items:
+            name, driver_index = self.route(index)
+            batches.setdefault(name, []).append((driver_index, value))
+        return batches
+
+    def plug_index(self, name, driver_index):
+        return self.indices.get((name, driver_index), driver_index)
+
+    def get_name(self, index):
+        driver, driver_index = self.plug_driver(index)
+        return driver.get_name(driver_index)
+
+    def set_plug_state(self, index, state):
+        driver, driver_index = self.plug_driver(index)
+        return driver.set_plug_state(driver_index, state)
+
+    async def async_set_plug_state(self, index, state):
+        driver, driver_index = self.plug_driver(index)
+        return await driver.async_set_plug_state(driver_index, state)
+
+    def get_plug_state(self, index):
+        driver, driver_index = self.plug_driver(index)
+        return driver.get_plug_state(driver_index)
+
+    async def driver_set_states(self, driver, pairs):
+        if hasattr(driver, 'async_set_states'):
+            return await driver.async_set_states(pairs)
+        results = await asyncio.gather(*[driver.async_set_plug_state(index, state) for index, state in pairs])
+        return dict((pair[0], reply) for pair, reply in zip(pairs, results))
+
+    async def backend_set_states(self, name, pairs):
+        # returns a dict of plug index -> reply for one backend's batch, no replies if it missed its deadline,
+        # so a hung backend does not fail the other backends' plugs
+        try:
+            replies = await asyncio.wait_for(self.driver_set_states(self.driver(name), pairs), self.deadline_ms / 1000)
+        except asyncio.TimeoutError:
+            print("{} backend missed its {} ms deadline".format(name, self.deadline_ms))
+            replies = {}
+        return dict((self.plug_index(name, driver_index), reply) for driver_index, reply in replies.items())
+
+    async def async_set_states(self, pairs):
+        # sets a list of (plug index, state), one batch per backend, the backends concurrently
+        # returns a dict of plug index -> reply
+        batches = self.split(pairs)
+        replies = {}
+        for backend_replies in await asyncio.gather(*[self.backend_set_states(name, batch)
+                                                      for name, batch in batches.items()]):
+            replies.update(backend_replies)
+        return replies
+
+    def set_states(self, pairs):
+        return run_until_complete(self.async_set_states(pairs))
+
+    async def backend_get_states(self, name, driver_indices):
+        # no states if the backend's read failed, so the other backends' states are kept
+        try:
+            states = await self.driver(name).async_get_states(driver_indices)
+        except Exception as e:
+            print("{} backend status read failed: {!r}".format(name, e))
+            states = {}
+        return dict((self.plug_index(name, driver_index), state) for driver_index, state in states.items())
+
+    async def async_get_states(self, indices=None):
+        # returns a dict of plug index -> relay state for the plugs that answered (all plugs if None),
+        # the backends are read concurrently
+        indices = list(self.routes) if indices is None else indices
+        batches = self.split([(index, None) for index in indices])
+        states = {}
+        for backend_states in await asyncio.gather(*[self.backend_get_states(name, [pair[0] for pair in batch])
+                                                     for name, batch in batches.items()]):
+            states.update(backend_states)
+        return states
+
+    def get_states(self, indices=None):
+        return run_until_complete(self.async_get_states(indices))
+
+    def pushed_states(self):
+        # (plug index, state) pairs pushed by drivers that receive states by push (see my_tasmota_mqtt.py)
+        pairs = []
+        for name, driver in self.drivers.items():
+            if hasattr(driver, 'pushed_states'):
+                pairs.extend((self.indices[(name, driver_index)], state) for driver_index, state in driver.pushed_states()
+                             if (name, driver_index) in self.indices)
+        return pairs
+
+    def refresh_registry(self):
+        # lets drivers with device discovery refresh it (see kasa_registry.py)
+        for driver in self.drivers.values():
+            if hasattr(driver, 'refresh_registry'):
+                driver.refresh_registry()
+
+    def has_timers(self, index):
+        # True if the plug's driver has on-device timers (see tasmota_timers.py)
+        return hasattr(self.plug_driver(index)[0], 'set_timers')
+
+    def get_timers(self, index):
+        # on-device timers of plugs whose driver has them, None for the others (see tasmota_timers.py)
+        driver, driver_index = self.plug_driver(index)
+        return driver.get_timers(driver_index) if hasattr(driver, 'get_timers') else None
+
+    def set_timers(self, index, backlog_command):
+        driver, driver_index = self.plug_driver(index)
+        return driver.set_timers(driver_index, backlog_command) if hasattr(driver, 'set_timers') else None
+
+    async def async_get_timers(self, index):
+        driver, driver_index = self.plug_driver(index)
+        return await driver.async_get_timers(driver_index) if hasattr(driver, 'async_get_timers') else None
+
+    async def async_set_timers(self, index, backlog_command):
+        driver, driver_index = self.plug_driver(index)
+        return await driver.async_set_timers(driver_index, backlog_command) if hasattr(driver, 'async_set_timers') else None
+
+
+if __name__ == "__main__":
+    # switches a mixed fleet of emulated Kasa and Tasmota plugs, one plug at a time, one backend after
+    # the other and all backends concurrently
+    import sys
+    import io
+    import time
+    from contextlib import redirect_stdout
+
+    import my_tasmota
+    from my_kasa import My_Kasa
+    from kasa_emulator import Kasa_Emulator
+    from tasmota_emulator import Tasmota_Emulator
+
+    nbr_kasa = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    nbr_tasmota = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    latency_ms = float(sys.argv[3]) if len(sys.argv) > 3 else 20
+    kasa_emulator = Kasa_Emulator(nbr_kasa, latency_ms, latency_ms / 2).start_thread()
+    tasmota_emulator = Tasmota_Emulator(nbr_tasmota, latency_ms, latency_ms / 2, connect_ms=latency_ms).start_thread()
+    kasa = My_Kasa('emulator_registry.json')
+    kasa.use_registry(kasa_emulator.registry())
+    my_tasmota.smartplugs = tasmota_emulator.smartplugs()
+    nbr_kasa_plugs = len(kasa.smartplugs)
+    plugs = tuple((i, 0, None, 'kasa') for i in range(nbr_kasa_plugs)) + \
+        tuple((nbr_kasa_plugs + i, 0, None, ('tasmota', i)) for i in range(nbr_tasmota))
+    registry = Driver_Registry(plugs, {'kasa': kasa, 'tasmota': my_tasmota.my_tasmota()})
+    print("{} kasa plugs on {} devices, {} tasmota plugs, latency {} ms".format(
+        nbr_kasa_plugs, nbr_kasa, nbr_tasmota, latency_ms))
+
+    def per_plug(pairs):
+        return dict((index, registry.set_plug_state(index, state)) for index, state in pairs)
+
+    def per_backend(pairs):
+        replies = {}
+        for name in registry.drivers:
+            replies.update(registry.set_states([pair for pair in pairs if registry.route(pair[0])[0] == name]))
+        return replies
+
+    print("{:>12} {:>6} {:>8} {:>10} {:>8}".format('mode', 'state', 'plugs', 'total ms', 'ok'))
+    for name, set_states in (('per plug', per_plug), ('per backend', per_backend), ('concurrent', registry.set_states)):
+        for state in (1, 0):
+            pairs = [(plug[0], state) for plug in plugs]
+            t = time.time()
+            with redirect_stdout(io.StringIO()):
+                replies = set_states(pairs)
+            print("{:>12} {:>6} {:>8} {:>10.0f} {:>8}".format(name, state, len(pairs), (time.time() - t) * 1000,
+                  len([reply for reply in replies.values() if reply is not None and getattr(reply, 'ok', True)])))
+    t = time.time()
+    with redirect_stdout(io.StringIO()):
+        states = registry.get_states()
+    print("read {} plug states in {:.0f} ms, all off: {}".format(
+        len(states), (time.time() - t) * 1000, not any(states.values())))
+    kasa_emulator.stop()
+    tasmota_emulator.stop()
@@ -0,0 +1,151 @@
+'''
+  event_queue.py
+  Priority queue of pending smartplug events ordered by start time
+
+  A heapq heap of int keys (start time and slot) with the events held in an Event_Store, so push and
+  pop are O(log n) with the comparisons in heapq's C code, a bulk load is O(n) and each pending event
+  costs an int and a few bytes of array space rather than a python object.
+  Events pushed are any objects with start, end, index and state attributes (see plug_event in event_store.py),
+  pop returns a plug_event copy, peek and iteration return event_view objects into the store.
+'''
+
+from heapq import heappush, heappop, heapify
+from event_store import Event_Store
+
+SLOT_BITS = 20 # heap keys are start << SLOT_BITS | slot, room for a million pending events
+SLOT_MASK = (1 << SLOT_BITS) - 1
+
+
+class Event_Queue(object):
+
+    def __init__(self, events=None):
+        self.store = Event_Store()
+        self._heap = [] # int keys, compared by heapq without calling back into python, equal starts pop by slot
+        self.version = 0 # changes whenever the queue does, so views of it can be cached
+        if events:
+            self.load(events)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __iter__(self):
+        # yields views of the pending events in start order, the queue is not modified
+        for key in sorted(self._heap):
+            yield self.store.view(key & SLOT_MASK)
+
+    def _key(self, event):
+        # stores the event and returns its heap key
+        slot = self.store.add_event(event)
+        return self.store.start[slot] << SLOT_BITS | slot
+
+    def push(self, event):
+        heappush(self._heap, self._key(event))
+        self.version += 1
+
+    def load(self, events):
+        # adds all the given events, heapified once rather than one push per event
+        add_event = self.store.add_event
+        start = self.store.start
+        heap = self._heap
+        for event in events:
+            slot = add_event(event)
+            heap.append(start[slot] << SLOT_BITS | slot)
+        heapify(heap)
+        self.version += 1
+
+    def peek(self):
+        # returns a view of the next event without removing it, or None if the queue is empty
+        if self._heap:
+            return self.store.view(self._heap[0] & SLOT_MASK)
+        return None
+
+    def pop(self):
+        # removes and returns the next event, or None if the queue is empty
+        if not self._heap:
+            return None
+        slot = heappop(self._heap) & SLOT_MASK
+        event = self.store.copy(slot)
+        self.store.release(slot)
+        self.version += 1
+        return event
+
+    def pop_due(self, timestamp):
+        # removes and returns the next event if it has matured, else None
+        if self._heap and self._heap[0] >> SLOT_BITS <= timestamp:
+            return self.pop()
+        return None
+
+    def remove_plug(self, plug_index):
+        # removes all events for the given plug, returns the number removed
+        return self.remove_if(lambda event: event.index == plug_index)
+
+    def remove_if(self, predicate):
+        # removes all events for which predicate(event) is true, returns the number removed
+        kept = []
+        for key in self._heap:
+            slot = key & SLOT_MASK
+            if predicate(self.store.view(slot)):
+                self.store.release(slot)
+            else:
+                kept.append(key)
+        removed = len(self._heap) - len(kept)
+        if removed:
+            heapify(kept)
+            self._heap = kept
+            self.version += 1
+        return removed
+
+    def clear(self):
+        self.store.clear()
+        self._heap = []
+        self.version += 1
+
+
+if __name__ == "__main__":
+    # benchmark: Event_Queue against the previous sorted list with pop(0)
+    from random import randint
+    import time
+
+    try:
+        ticks_ms = time.ticks_ms
+        ticks_diff = time.ticks_diff
+    except AttributeError:
+        ticks_ms = lambda: time.perf_counter() * 1000
+        ticks_diff = lambda a, b: a - b
+
+    from event_store import plug_event
+
+    EVENTS_PER_PLUG = 10
+    LIST_LIMIT = 10000  # the sorted list is quadratic, skip it above this size
+
+    def bench_list(events):
+        t = ticks_ms()
+        queue = []
+        for i in range(0, len(events), EVENTS_PER_PLUG):  # sorted after each plug, as schedule_events did
+            queue.extend(events[i:i + EVENTS_PER_PLUG])
+            queue = sorted(queue, key=lambda e: e.start)
+        build = ticks_diff(ticks_ms(), t)
+        t = ticks_ms()
+        while queue:
+            queue.pop(0)
+        return build, ticks_diff(ticks_ms(), t)
+
+    def bench_heap(events):
+        t = ticks_ms()
+        queue = Event_Queue()
+        queue.load(events)
+        build = ticks_diff(ticks_ms(), t)
+        t = ticks_ms()
+        while queue.pop():
+            pass
+        return build, ticks_diff(ticks_ms(), t)
+
+    print("{:>8} {:>22} {:>22}".format('events', 'list build/drain ms', 'heap build/drain ms'))
+    for n in (10, 1000, 100000):
+        events = [plug_event(randint(0, 86400), 86400, i // EVENTS_PER_PLUG, i & 1) for i in range(n)]
+        heap_times = '{:.1f} / {:.1f}'.format(*bench_heap(events))
+        if n <= LIST_LIMIT:
+            list_times = '{:.1f} / {:.1f}'.format(*bench_list(events))
+        else:
+            list_times = 'skipped'
+        print("{:>8} {:>22} {:>22}".format(n, list_times, heap_times))
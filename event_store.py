@@ -0,0 +1,180 @@
+'''
+  event_store.py
+  Compact column storage for pending smartplug events
+
+  Each event is a slot in parallel arrays (start, end, plug index, state, window) rather than a
+  python object with its own __dict__, names are interned once per plug index.
+  event_view gives the web page and display attribute access to a slot without copying it.
+'''
+
+import gc
+from array import array
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None # MicroPython uses gc.mem_alloc
+
+
+def format_event(name, index, state, start, end):
+    if plug_event._util:
+        return '{} {} {}, end {}'.format(
+            name if name else "index {}".format(index),
+            "on" if state else "off",
+            plug_event._util.str_timestamp(start),
+            plug_event._util.str_timestamp(end)
+        )
+    return 'Utility method not set'
+
+
+class plug_event:
+    _util = None
+
+    # trigger and end are timestamps, index is into plug array, state is 0 if off, 1 if on
+    # window is the day number of the sequence window that generated the event
+    def __init__(self, start, end, index, state, name = None, window = None):
+        self.start = start
+        self.end = end
+        self.index = index
+        self.state = state
+        self.name = name
+        self.window = window
+
+    def set_name(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return format_event(self.name, self.index, self.state, self.start, self.end)
+
+    @staticmethod
+    def set_util(util):
+        plug_event._util = util
+
+
+class event_view(object):
+    # read only view of one slot in an Event_Store, only valid until the slot is released
+    __slots__ = ('store', 'slot')
+
+    def __init__(self, store, slot):
+        self.store = store
+        self.slot = slot
+
+    @property
+    def start(self):
+        return self.store.start[self.slot]
+
+    @property
+    def end(self):
+        return self.store.end[self.slot]
+
+    @property
+    def index(self):
+        return self.store.index[self.slot]
+
+    @property
+    def state(self):
+        return self.store.state[self.slot]
+
+    @property
+    def window(self):
+        return self.store.window[self.slot]
+
+    @property
+    def name(self):
+        return self.store.names.get(self.store.index[self.slot])
+
+    def __repr__(self):
+        return format_event(self.name, self.index, self.state, self.start, self.end)
+
+
+class Event_Store(object):
+
+    def __init__(self):
+        self.start = array('l')
+        self.end = array('l')
+        self.index = array('H')
+        self.state = array('B')
+        self.window = array('H') # day number, 0 if not from a window
+        self.names = {} # plug index -> name
+        self.free = array('l') # released slots available for reuse
+        self.nbr_free = 0
+
+    def __len__(self):
+        # number of slots in use
+        return len(self.start) - self.nbr_free
+
+    def add(self, start, end, index, state, name=None, window=None):
+        # stores an event and returns its slot
+        if name is not None and index not in self.names:
+            self.names[index] = name
+        if self.nbr_free:
+            self.nbr_free -= 1
+            slot = self.free[self.nbr_free]
+            self.start[slot] = start
+            self.end[slot] = end
+            self.index[slot] = index
+            self.state[slot] = state
+            self.window[slot] = window or 0
+        else:
+            slot = len(self.start)
+            self.start.append(start)
+            self.end.append(end)
+            self.index.append(index)
+            self.state.append(state)
+            self.window.append(window or 0)
+        return slot
+
+    def add_event(self, event):
+        return self.add(event.start, event.end, event.index, event.state,
+                        getattr(event, 'name', None), getattr(event, 'window', None))
+
+    def release(self, slot):
+        # array has no pop on MicroPython, so the free list keeps its own count
+        if self.nbr_free < len(self.free):
+            self.free[self.nbr_free] = slot
+        else:
+            self.free.append(slot)
+        self.nbr_free += 1
+
+    def clear(self):
+        self.__init__()
+
+    def view(self, slot):
+        return event_view(self, slot)
+
+    def copy(self, slot):
+        # returns a plug_event holding the slot's values, unaffected when the slot is reused
+        return plug_event(self.start[slot], self.end[slot], self.index[slot], self.state[slot],
+                          self.names.get(self.index[slot]), self.window[slot] or None)
+
+
+def allocated_bytes():
+    # bytes currently allocated, from gc on MicroPython or tracemalloc on CPython
+    gc.collect()
+    if hasattr(gc, 'mem_alloc'):
+        return gc.mem_alloc()
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def memory_report(nbr_events):
+    # returns (bytes used by nbr_events plug_event objects, bytes used by the same events in an Event_Store)
+    names = ['plug {}'.format(i) for i in range(10)]
+    before = allocated_bytes()
+    objects = [plug_event(1700000000 + i, 1700000100 + i, i % 10, i & 1, names[i % 10], 20000)
+               for i in range(nbr_events)]
+    object_bytes = allocated_bytes() - before
+    del objects
+    before = allocated_bytes()
+    store = Event_Store()
+    for i in range(nbr_events):
+        store.add(1700000000 + i, 1700000100 + i, i % 10, i & 1, names[i % 10], 20000)
+    store_bytes = allocated_bytes() - before
+    return object_bytes, store_bytes
+
+
+if __name__ == "__main__":
+    print("{:>8} {:>16} {:>16}".format('events', 'plug_event bytes', 'store bytes'))
+    for n in (10, 100, 1000, 10000):
+        print("{:>8} {:>16} {:>16}".format(n, *memory_report(n)))
@@ -0,0 +1,107 @@
+'''
+  fleet_numpy.py
+  Optional NumPy generation of a sequence window for many plugs at once
+
+  On CPython hosts with numpy installed, all the random offsets and cumulative durations for every plug
+  sharing a profile are drawn in a few array operations instead of per state python loops.
+  The events have the same layout as Smartplug_Timer.generate_profile_events, including the trailing
+  off event for inverted plugs. Without numpy (e.g. MicroPython) available is False and the timer
+  keeps using the pure python path.
+
+  Random draws are made for every plug index up to the largest one requested, from a generator seeded
+  with the timer seed and day, so a plug gets the same events whether or not the other plugs are generated.
+  The draws come from random.getrandbits rather than numpy.random, which fails to import when run from
+  this directory because secrets.py (the wifi credentials) hides the standard library secrets module.
+'''
+
+import random
+
+try:
+    import numpy as np
+    available = True
+except ImportError:
+    available = False
+
+from event_store import plug_event
+
+MIN_PLUGS = 64 # below this many plugs in a profile the python loop is as quick
+on = 1
+off = 0
+
+
+def random_rows(rnd, rows, cols):
+    # rows x cols array of random uint32 from a single getrandbits call, row i only depends on the
+    # seed and i, not on how many rows are drawn
+    n = rows * cols
+    raw = np.frombuffer(rnd.getrandbits(32 * n).to_bytes(4 * n, 'little'), dtype=np.uint32)
+    return raw.reshape((rows, cols)).astype(np.int64)
+
+
+def rand_secs(r):
+    # vectorized Smartplug_Timer.rand_secs for draws r in 0..max_rand_mins
+    return np.where(r == 0, 30, r * 15)
+
+
+def generate_profile_events(profile, profile_plugs, start_timestamp, day, seed, get_name):
+    # returns the plug_events for the given plugs in the profile's window on the given day
+    indices = np.array([plug[0] for plug in profile_plugs])
+    inversions = np.array([plug[1] for plug in profile_plugs])
+    max_seq = profile.max_nbr_sequences
+    rnd = random.Random(seed * 100000 + day)
+    # column 0 is the start offset, 1 the number of sequences, the rest the state durations
+    raw = random_rows(rnd, int(indices.max()) + 1, 2 * max_seq + 2)[indices]
+    max_rand = profile.max_rand_mins + 1
+    first = rand_secs(raw[:, 0] % max_rand)
+    nbr_sequences = profile.min_nbr_sequences + raw[:, 1] % (max_seq - profile.min_nbr_sequences + 1)
+    durations = rand_secs(raw[:, 2:] % max_rand)
+
+    off_dur = np.where(nbr_sequences > 1, profile.off_dur // np.maximum(nbr_sequences - 1, 1), profile.off_dur)
+    durations[:, 0::2] += (profile.on_dur // nbr_sequences)[:, None]
+    durations[:, 1::2] += off_dur[:, None]
+    nbr_states = 2 * nbr_sequences
+    columns = np.arange(2 * max_seq)
+    durations[columns[None, :] >= nbr_states[:, None]] = 0
+    cume_dur = np.zeros((len(indices), 2 * max_seq + 1), dtype=np.int64)
+    np.cumsum(durations, axis=1, out=cume_dur[:, 1:])
+    event_time = int(start_timestamp) + first
+
+    rows, cols = np.nonzero(columns[None, :] < nbr_states[:, None])
+    starts = (event_time[rows] + cume_dur[rows, cols]).tolist()
+    ends = (event_time[rows] + cume_dur[rows, cols + 1]).tolist()
+    states = ((cols & 1 ^ 1) ^ inversions[rows]).tolist()
+    plug_rows = rows.tolist()
+
+    index_list = indices.tolist()
+    names = [get_name(index) for index in index_list]
+    new_events = [plug_event(starts[i], ends[i], index_list[row], states[i], names[row], day)
+                  for i, row in enumerate(plug_rows)]
+    for row in np.nonzero(inversions)[0].tolist(): # off if inv
+        ne = int(event_time[row] + cume_dur[row, nbr_states[row]])
+        new_events.append(plug_event(ne, ne + int(off_dur[row]), index_list[row], off, names[row], day))
+    return new_events
+
+
+if __name__ == "__main__":
+    # benchmark: numpy against the python loop for one window of 1k and 10k plugs
+    import time
+    from profiles import schedule_profile
+    from smartplug_timer import Smartplug_Timer, default_cfg
+
+    class bench_timer(Smartplug_Timer):
+        def __init__(self):
+            self.rng = random.Random(1)
+            self.seed = 1
+
+    profile = schedule_profile('default', default_cfg)
+    timer = bench_timer()
+    get_name = lambda index: 'plug {}'.format(index)
+    print("{:>6} {:>10} {:>10} {:>10} {:>10}".format('plugs', 'python ms', 'numpy ms', 'py events', 'np events'))
+    for nbr_plugs in (1000, 10000):
+        plugs = [(i, 1 if i % 4 == 3 else 0) for i in range(nbr_plugs)]
+        t = time.perf_counter()
+        py_events = timer.generate_profile_events(profile, plugs, 1700000000, 19675, get_name)
+        py_ms = (time.perf_counter() - t) * 1000
+        t = time.perf_counter()
+        np_events = generate_profile_events(profile, plugs, 1700000000, 19675, 1, get_name)
+        np_ms = (time.perf_counter() - t) * 1000
+        print("{:>6} {:>10.1f} {:>10.1f} {:>10} {:>10}".format(nbr_plugs, py_ms, np_ms, len(py_events), len(np_events)))
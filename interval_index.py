@@ -0,0 +1,91 @@
+'''
+  interval_index.py
+  Index of scheduled on/off spans answering "what state should a plug be in at time t"
+
+  Built once from the pending events (each event is a span from start to end in one state),
+  queries are bisect lookups into per plug arrays sorted by start time.
+  A plug is off when no span covers t, as it is between sequence windows.
+'''
+
+from array import array
+
+
+def bisect_right(a, x):
+    # MicroPython has no bisect module
+    lo, hi = 0, len(a)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if x < a[mid]:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+class Interval_Index(object):
+
+    def __init__(self, events):
+        # events can be in any order, spans for a plug that overlap are resolved by the latest start
+        self.starts = {} # plug index -> array of span starts
+        self.ends = {}
+        self.states = {}
+        self.fleet_starts = array('l') # every span start in the fleet, for fleet wide next change
+        for event in sorted(events, key=lambda event: event.start):
+            index = event.index
+            if index not in self.starts:
+                self.starts[index] = array('l')
+                self.ends[index] = array('l')
+                self.states[index] = bytearray()
+            self.starts[index].append(event.start)
+            self.ends[index].append(event.end)
+            self.states[index].append(event.state)
+            self.fleet_starts.append(event.start)
+
+    def plugs(self):
+        return self.starts.keys()
+
+    def span_at(self, plug_index, t):
+        # returns the position of the span covering t for the given plug, or -1
+        starts = self.starts.get(plug_index)
+        if not starts:
+            return -1
+        pos = bisect_right(starts, t) - 1
+        if pos >= 0 and t < self.ends[plug_index][pos]:
+            return pos
+        return -1
+
+    def desired_state(self, plug_index, t):
+        pos = self.span_at(plug_index, t)
+        return self.states[plug_index][pos] if pos >= 0 else 0
+
+    def desired_states(self, t):
+        # returns a dict of plug index -> state at time t for every plug in the index
+        return dict((plug_index, self.desired_state(plug_index, t)) for plug_index in self.starts)
+
+    def next_change(self, plug_index, t):
+        # returns the time after t when the plug's desired state next changes, or None
+        starts = self.starts.get(plug_index)
+        if not starts:
+            return None
+        ends = self.ends[plug_index]
+        states = self.states[plug_index]
+        state = self.desired_state(plug_index, t)
+        pos = bisect_right(starts, t)
+        prev_end = ends[pos - 1] if pos else t
+        while pos < len(starts):
+            if state and prev_end < starts[pos]:
+                return prev_end # off in the gap before the next span
+            if states[pos] != state:
+                return starts[pos]
+            prev_end = ends[pos]
+            pos += 1
+        if state:
+            return prev_end
+        return None
+
+    def fleet_next_change(self, t):
+        # returns the first span start after t across all plugs, or None
+        pos = bisect_right(self.fleet_starts, t)
+        if pos < len(self.fleet_starts):
+            return self.fleet_starts[pos]
+        return None
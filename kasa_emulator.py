@@ -0,0 +1,243 @@
+'''
+  kasa_emulator.py
+  Emulated Kasa plugs and strips on localhost for testing My_Kasa without real devices
+
+  Each emulated device listens on its own loopback address (127.0.1.1, 127.0.1.2 ...) on port 9999
+  for the encrypted tcp protocol and udp get_sysinfo queries, cycling through the KP303 strip and
+  the HS100 and KP105 single plug models used in my_kasa.py. Replies can be delayed (latency plus
+  random jitter), tcp replies are sometimes held back as if a packet was lost and retransmitted,
+  udp replies are sometimes lost, and connections are sometimes dropped after a reply.
+  The emulator runs its own asyncio loop in a thread, so blocking and asyncio clients can use it.
+  CPython only (loopback addresses other than 127.0.0.1 are needed).
+
+  usage: python kasa_emulator.py [nbr devices] [latency ms] [loss] [drop]
+  benchmarks dispatch to every emulated plug, per plug and batched per device
+'''
+
+import json
+import random
+import struct
+import threading
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+import kasa_cipher
+from kasa_registry import Kasa_Registry, DISCOVERY_PORT
+
+MODELS = (('KP303(UK)', 3), ('HS100(UK)', 1), ('KP105(UK)', 1)) # (model, number of outlets)
+RETRANSMIT_MS = 200 # extra delay of a tcp reply whose packet was 'lost'
+
+
+def device_ip(n):
+    # 250 devices per /24 on loopback, starting at 127.0.1.1
+    return '127.0.{}.{}'.format(1 + n // 250, 1 + n % 250)
+
+
+class Emulated_Device(object):
+
+    def __init__(self, n, model, nbr_outlets):
+        self.ip = device_ip(n)
+        self.device_id = '8006{:036X}'.format(n)
+        self.model = model
+        self.alias = 'emulated {}'.format(n)
+        self.children = nbr_outlets > 1
+        self.states = [0] * nbr_outlets
+        self.commands = 0
+
+    def child_id(self, outlet):
+        return self.device_id + '{:02d}'.format(outlet)
+
+    def plugs(self):
+        # (device id, name, model, ip) for each outlet, as in the smartplugs tuple
+        if not self.children:
+            return [(self.device_id, self.alias, self.model, self.ip)]
+        return [(self.child_id(i), '{} outlet {}'.format(self.alias, i), self.model, self.ip)
+                for i in range(len(self.states))]
+
+    def sysinfo(self):
+        info = {'deviceId': self.device_id, 'alias': self.alias, 'model': self.model, 'err_code': 0}
+        if self.children:
+            info['children'] = [{'id': self.child_id(i), 'alias': '{} outlet {}'.format(self.alias, i),
+                                 'state': state} for i, state in enumerate(self.states)]
+        else:
+            info['relay_state'] = self.states[0]
+        return info
+
+    def handle(self, request):
+        # returns the reply dict for a decoded request
+        self.commands += 1
+        system = request.get('system', {})
+        if 'get_sysinfo' in system:
+            return {'system': {'get_sysinfo': self.sysinfo()}}
+        if 'set_relay_state' in system:
+            state = system['set_relay_state'].get('state', 0)
+            if self.children:
+                child_ids = request.get('context', {}).get('child_ids', [])
+                outlets = [i for i in range(len(self.states)) if self.child_id(i) in child_ids]
+                if len(outlets) != len(child_ids):
+                    return {'system': {'set_relay_state': {'err_code': -14, 'err_msg': 'entry not exist'}}}
+            else:
+                outlets = [0]
+            for i in outlets:
+                self.states[i] = state
+            return {'system': {'set_relay_state': {'err_code': 0}}}
+        return {'system': {'err_code': -1, 'err_msg': 'module not support'}}
+
+
+class udp_protocol(asyncio.DatagramProtocol):
+
+    def __init__(self, emulator, device):
+        self.emulator = emulator
+        self.device = device
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        emulator = self.emulator
+        if emulator.rng.random() < emulator.loss:
+            return
+        reply = kasa_cipher.encrypt(json.dumps(self.device.handle(json.loads(kasa_cipher.decrypt(data)))), header=False)
+        asyncio.get_event_loop().call_later(emulator.delay_ms() / 1000, self.transport.sendto, reply, addr)
+
+
+class Kasa_Emulator(object):
+
+    def __init__(self, nbr_devices, latency_ms=0, jitter_ms=0, loss=0.0, drop=0.0, port=DISCOVERY_PORT, seed=1):
+        self.devices = [Emulated_Device(n, *MODELS[n % len(MODELS)]) for n in range(nbr_devices)]
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.loss = loss # probability a udp reply is lost, or a tcp reply is retransmitted
+        self.drop = drop # probability the connection is closed after a tcp reply
+        self.port = port
+        self.rng = random.Random(seed)
+        self.servers = []
+        self.loop = None
+        self.drops = 0
+
+    def plugs(self):
+        return [plug for device in self.devices for plug in device.plugs()]
+
+    def registry(self):
+        return Kasa_Registry(self.plugs())
+
+    def addresses(self):
+        return [(device.ip, self.port) for device in self.devices]
+
+    def delay_ms(self):
+        delay = self.latency_ms + self.rng.random() * self.jitter_ms
+        if self.rng.random() < self.loss:
+            delay += RETRANSMIT_MS
+        return delay
+
+    async def handle_tcp(self, device, reader, writer):
+        try:
+            while True:
+                header = await reader.readexactly(4)
+                payload = await reader.readexactly(struct.unpack('>I', header)[0])
+                reply = device.handle(json.loads(kasa_cipher.decrypt(payload)))
+                await asyncio.sleep(self.delay_ms() / 1000)
+                writer.write(kasa_cipher.encrypt(json.dumps(reply)))
+                await writer.drain()
+                if self.rng.random() < self.drop:
+                    self.drops += 1
+                    break
+        except (EOFError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        for device in self.devices:
+            handler = lambda reader, writer, device=device: self.handle_tcp(device, reader, writer)
+            self.servers.append(await asyncio.start_server(handler, device.ip, self.port))
+            transport, protocol = await loop.create_datagram_endpoint(
+                lambda device=device: udp_protocol(self, device), local_addr=(device.ip, self.port))
+            self.servers.append(transport)
+
+    def start_thread(self):
+        # runs the emulator in a daemon thread, returns once every device is listening
+        ready = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(self.start())
+            ready.set()
+            self.loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        def shutdown():
+            for server in self.servers:
+                server.close()
+            for task in asyncio.all_tasks(self.loop): # connections kept open by the pool
+                task.cancel()
+            self.loop.call_soon(self.loop.stop) # after the cancelled tasks have run
+
+        self.loop.call_soon_threadsafe(shutdown)
+
+
+if __name__ == "__main__":
+    import sys
+    import io
+    import time
+    from contextlib import redirect_stdout
+
+    from my_kasa import My_Kasa
+    from kasa_registry import discover
+    from dispatch import Batch_Dispatcher
+    from event_store import plug_event
+    import timer_utils
+
+    nbr_devices = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 20
+    loss = float(sys.argv[3]) if len(sys.argv) > 3 else 0.01
+    drop = float(sys.argv[4]) if len(sys.argv) > 4 else 0.05
+    emulator = Kasa_Emulator(nbr_devices, latency_ms, latency_ms / 2, loss, drop).start_thread()
+    print("{} devices, {} plugs, latency {} ms, loss {}, drop {}".format(
+        nbr_devices, len(emulator.plugs()), latency_ms, loss, drop))
+
+    t = time.time()
+    found = discover(1, emulator.addresses(), 2)
+    print("discovered {} of {} devices in {:.2f} s".format(len(found), nbr_devices, time.time() - t))
+
+    kasa = My_Kasa('emulator_registry.json')
+    kasa.use_registry(emulator.registry())
+    utils = timer_utils.Time_utils(0)
+
+    class per_plug(object):
+        # hides async_set_states so the dispatcher sends one command per plug
+        def __init__(self, kasa):
+            self.async_set_plug_state = kasa.async_set_plug_state
+
+    def percentile(values, p):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+    print("{:>10} {:>6} {:>10} {:>10} {:>8} {:>8} {:>8} {:>8}".format(
+        'mode', 'state', 'plugs', 'total ms', 'ok', 'p50 ms', 'p99 ms', 'max ms'))
+    for name, driver in (('per plug', per_plug(kasa)), ('batched', kasa)):
+        dispatcher = Batch_Dispatcher(driver, utils, max_workers=64)
+        for state in (1, 0, 1, 0):
+            events = [plug_event(0, 0, index, state) for index in range(len(kasa.smartplugs))]
+            t = time.time()
+            with redirect_stdout(io.StringIO()):
+                results = dispatcher.dispatch_now(events)
+            total_ms = (time.time() - t) * 1000
+            elapsed = [r[2] for r in results]
+            if driver is kasa: # a batch has one elapsed time for every plug, it is the total
+                elapsed = ['-']
+            print("{:>10} {:>6} {:>10} {:>10.0f} {:>8} {:>8} {:>8} {:>8}".format(
+                name, state, len(events), total_ms, len([r for r in results if r[1]]),
+                percentile(elapsed, 0.5), percentile(elapsed, 0.99), max(elapsed)))
+    states_ok = all(all(s == 0 for s in device.states) for device in emulator.devices)
+    print("all emulated outlets off: {}, connections dropped by devices: {}".format(states_ok, emulator.drops))
+    emulator.stop()
@@ -0,0 +1,185 @@
+'''
+  kasa_pool.py
+  Persistent TCP connections to Kasa devices, one per device IP
+
+  The outlets of a power strip (e.g. the KP303 children) share one IP address, so a scene change
+  reuses a single connection instead of a TCP handshake per outlet. A connection the plug has dropped
+  is reopened and the command resent once, connections unused for idle_secs are closed.
+  Per device stats separate the time spent connecting from the command round trip time.
+  Replies are read by a Frame_Reader per device and returned as kasa_reply objects.
+'''
+
+import socket
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+from timer_utils import const, ticks_ms, ticks_diff
+from loop_utils import check_loop
+from kasa_reader import Frame_Reader
+
+IDLE_SECS = const(30) # Kasa plugs drop idle connections, close ours before they do
+
+
+class device_stats(object):
+    # connect and round trip times in ms for one device
+
+    def __init__(self):
+        self.connects = 0
+        self.connect_ms = 0
+        self.commands = 0
+        self.rtt_ms = 0
+        self.reconnects = 0 # connections found dropped by the plug
+
+    def __repr__(self):
+        return '{} connects avg {} ms, {} commands avg {} ms, {} reconnects'.format(
+            self.connects, self.connect_ms // max(self.connects, 1),
+            self.commands, self.rtt_ms // max(self.commands, 1), self.reconnects)
+
+
+class Kasa_Connection_Pool(object):
+
+    def __init__(self, port=9999, timeout=2.0, idle_secs=IDLE_SECS):
+        self.port = port
+        self.timeout = timeout
+        self.idle_ms = idle_secs * 1000
+        self.socks = {} # ip -> [socket, ticks ms last used]
+        self.streams = {} # ip -> [reader, writer, ticks ms last used]
+        self.locks = {} # ip -> asyncio.Lock, commands to the same device take turns on its stream
+        self.loop = None # streams and locks belong to the event loop they were made in
+        self.stats = {} # ip -> device_stats
+        self.readers = {} # ip -> Frame_Reader, each device has its own buffer as async replies interleave
+
+    def frame_reader(self, ip):
+        if ip not in self.readers:
+            self.readers[ip] = Frame_Reader()
+        return self.readers[ip]
+
+    def device_stats(self, ip):
+        if ip not in self.stats:
+            self.stats[ip] = device_stats()
+        return self.stats[ip]
+
+    def report(self):
+        for ip, stats in self.stats.items():
+            print('{}: {}'.format(ip, stats))
+
+    def evict_idle(self):
+        # closes connections that have not been used for idle_ms
+        now = ticks_ms()
+        for ip in [ip for ip, entry in self.socks.items() if ticks_diff(now, entry[1]) > self.idle_ms]:
+            self.close_sock(ip)
+        for ip in [ip for ip, entry in self.streams.items() if ticks_diff(now, entry[2]) > self.idle_ms]:
+            self.streams.pop(ip)[1].close()
+
+    def close_sock(self, ip):
+        entry = self.socks.pop(ip, None)
+        if entry:
+            try:
+                entry[0].close()
+            except OSError:
+                pass
+
+    def close(self):
+        for ip in list(self.socks):
+            self.close_sock(ip)
+        for ip in list(self.streams):
+            self.streams.pop(ip)[1].close()
+
+    def connect(self, ip):
+        start = ticks_ms()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect((ip, self.port))
+        except OSError:
+            sock.close()
+            raise
+        stats = self.device_stats(ip)
+        stats.connects += 1
+        stats.connect_ms += ticks_diff(ticks_ms(), start)
+        self.socks[ip] = [sock, start]
+        return sock
+
+    def exchange(self, sock, command, ip):
+        # sends the framed command and returns the kasa_reply, None if the plug closed the connection
+        sock.send(command)
+        return self.frame_reader(ip).read(sock)
+
+    def send_and_recv(self, command, ip):
+        # returns the kasa_reply, or None if the device could not be reached
+        self.evict_idle()
+        stats = self.device_stats(ip)
+        for attempt in range(2):
+            reused = ip in self.socks
+            try:
+                sock = self.socks[ip][0] if reused else self.connect(ip)
+                start = ticks_ms()
+                reply = self.exchange(sock, command, ip)
+            except OSError as e:
+                reply = None
+                if not reused:
+                    print(e, ip)
+            if reply is not None:
+                stats.commands += 1
+                stats.rtt_ms += ticks_diff(ticks_ms(), start)
+                self.socks[ip][1] = ticks_ms()
+                return reply
+            self.close_sock(ip)
+            if not reused:
+                return None
+            stats.reconnects += 1 # the plug closed the idle connection, try once on a new one
+        return None
+
+    async def async_connect(self, ip):
+        start = ticks_ms()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, self.port), self.timeout)
+        stats = self.device_stats(ip)
+        stats.connects += 1
+        stats.connect_ms += ticks_diff(ticks_ms(), start)
+        self.streams[ip] = [reader, writer, start]
+        return reader, writer
+
+    async def async_exchange(self, reader, writer, command, ip):
+        writer.write(command)
+        await writer.drain()
+        return await self.frame_reader(ip).async_read(reader, lambda aw: asyncio.wait_for(aw, self.timeout))
+
+    async def async_send_and_recv(self, command, ip):
+        # awaitable send_and_recv, commands to one device are sent one at a time on its connection
+        check_loop(self)
+        self.evict_idle()
+        if ip not in self.locks:
+            self.locks[ip] = asyncio.Lock()
+        async with self.locks[ip]:
+            stats = self.device_stats(ip)
+            for attempt in range(2):
+                reused = ip in self.streams
+                try:
+                    reader, writer = self.streams[ip][:2] if reused else await self.async_connect(ip)
+                    start = ticks_ms()
+                    reply = await self.async_exchange(reader, writer, command, ip)
+                except (OSError, asyncio.TimeoutError) as e:
+                    reply = None
+                    if not reused:
+                        print(e, ip)
+                except asyncio.CancelledError:
+                    # the caller's deadline passed mid exchange, the late reply must not be read as the next one's
+                    entry = self.streams.pop(ip, None)
+                    if entry:
+                        entry[1].close()
+                    raise
+                if reply is not None:
+                    stats.commands += 1
+                    stats.rtt_ms += ticks_diff(ticks_ms(), start)
+                    self.streams[ip][2] = ticks_ms()
+                    return reply
+                entry = self.streams.pop(ip, None)
+                if entry:
+                    entry[1].close()
+                if not reused:
+                    return None
+                stats.reconnects += 1
+        return None
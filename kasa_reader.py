@@ -0,0 +1,121 @@
+'''
+  kasa_reader.py
+  Reads length prefixed Kasa tcp replies into a reusable buffer
+
+  Frame_Reader reads the 4 byte big endian length, then exactly that many bytes with recv_into
+  (readinto on MicroPython streams) into a buffer kept between replies, and decrypts it in place.
+  Peak memory is the largest reply seen rather than a new bytes object per recv.
+  Replies are returned as kasa_reply objects with the err_code reported by the device.
+'''
+
+import json
+import struct
+
+import kasa_cipher
+from timer_utils import const
+
+BUFFER_SIZE = const(2048) # initial buffer, grown once if a larger reply arrives
+MAX_REPLY = const(65536) # a longer announced length is treated as a corrupt stream
+HEADER_LEN = const(4)
+
+
+class kasa_reply(object):
+    # data is the decoded json reply, err_code the first non zero err_code in it (0 if the command succeeded)
+
+    def __init__(self, data, err_code=0, err_msg=None):
+        self.data = data
+        self.err_code = err_code
+        self.err_msg = err_msg
+
+    @property
+    def ok(self):
+        return self.err_code == 0
+
+    def __repr__(self):
+        if self.ok:
+            return 'ok {}'.format(self.data)
+        return 'err_code {} {}'.format(self.err_code, self.err_msg or '')
+
+
+def find_error(data):
+    # returns (err_code, err_msg) of the first failing module in the reply, or (0, None)
+    if isinstance(data, dict):
+        err_code = data.get('err_code', 0)
+        if err_code:
+            return err_code, data.get('err_msg')
+        for value in data.values():
+            error = find_error(value)
+            if error[0]:
+                return error
+    return 0, None
+
+
+def parse_reply(payload):
+    # payload is the decrypted json without its length header
+    try:
+        data = json.loads(bytes(payload))
+    except ValueError:
+        return kasa_reply(None, -1, 'invalid json')
+    return kasa_reply(data, *find_error(data))
+
+
+class Frame_Reader(object):
+
+    def __init__(self, size=BUFFER_SIZE):
+        self.header = bytearray(HEADER_LEN)
+        self.buffer = bytearray(size)
+
+    def payload_view(self, length):
+        # returns a memoryview of length bytes of the buffer, growing it if needed
+        if length > MAX_REPLY:
+            raise OSError('reply length {} too long'.format(length))
+        if length > len(self.buffer):
+            self.buffer = bytearray(length)
+        return memoryview(self.buffer)[:length]
+
+    def decode(self, view):
+        kasa_cipher.decrypt_into(view, view) # each cipher byte is read before it is overwritten
+        return parse_reply(view)
+
+    def read(self, sock):
+        # returns the next reply on the socket, or None if the device closed the connection
+        recv_into = getattr(sock, 'recv_into', None) or sock.readinto
+        if not self.read_exactly(recv_into, memoryview(self.header)):
+            return None
+        view = self.payload_view(struct.unpack('>I', self.header)[0])
+        if not self.read_exactly(recv_into, view):
+            return None
+        return self.decode(view)
+
+    def read_exactly(self, recv_into, view):
+        n = 0
+        while n < len(view):
+            got = recv_into(view[n:])
+            if not got:
+                return False
+            n += got
+        return True
+
+    async def async_read(self, reader, wait):
+        # awaitable read from an asyncio stream, wait(awaitable) applies the caller's timeout
+        if not await self.async_read_exactly(reader, memoryview(self.header), wait):
+            return None
+        view = self.payload_view(struct.unpack('>I', self.header)[0])
+        if not await self.async_read_exactly(reader, view, wait):
+            return None
+        return self.decode(view)
+
+    async def async_read_exactly(self, reader, view, wait):
+        if hasattr(reader, 'readinto'): # MicroPython streams
+            n = 0
+            while n < len(view):
+                got = await wait(reader.readinto(view[n:]))
+                if not got:
+                    return False
+                n += got
+            return True
+        try: # CPython streams have no readinto
+            view[:] = await wait(reader.readexactly(len(view)))
+        except EOFError:
+            return False
+        return True
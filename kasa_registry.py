@@ -0,0 +1,163 @@
+'''
+  kasa_registry.py
+  UDP broadcast discovery of Kasa devices and a registry file of the plugs found
+
+  discover broadcasts get_sysinfo on port 9999 and collects every device answering within the time
+  budget, a strip's outlets are registered as separate plugs. The registry keeps the plugs in the
+  same (device id, name, model, ip) layout as the smartplugs tuple in my_kasa.py, indexed by name,
+  ip and device id, and is saved to a json file that is reused until its ttl expires.
+  Plugs keep their index when the registry is refreshed, new plugs are added at the end, so schedules
+  configured by plug index are not affected by rediscovery.
+'''
+
+import json
+import socket
+import time
+
+import kasa_cipher
+from kasa_reader import parse_reply
+from timer_utils import const
+
+DISCOVERY_PORT = const(9999)
+DISCOVERY_SECS = const(3) # time budget for collecting replies
+DISCOVERY_REPEATS = const(3) # udp is lossy, the query is broadcast this many times within the budget
+REGISTRY_FILE = 'kasa_registry.json'
+REGISTRY_TTL_SECS = const(604800) # rediscover after a week
+SYSINFO = '{"system":{"get_sysinfo":{}}}'
+MAX_DATAGRAM = const(4096)
+
+ID, NAME, MODEL, IP = 0, 1, 2, 3 # fields of a plug tuple
+
+
+def query_udp(sock, addresses, command):
+    data = kasa_cipher.encrypt(command, header=False)
+    for address in addresses:
+        sock.sendto(data, address)
+
+
+def discover(budget_secs=DISCOVERY_SECS, addresses=None, repeats=DISCOVERY_REPEATS):
+    # returns a dict of ip -> sysinfo for every device answering within budget_secs
+    # addresses defaults to the broadcast address, a list of (ip, port) queries those devices instead
+    addresses = addresses or [('255.255.255.255', DISCOVERY_PORT)]
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    devices = {}
+    interval = budget_secs / repeats
+    try:
+        for repeat in range(repeats):
+            query_udp(sock, addresses, SYSINFO)
+            end = time.time() + interval
+            while True:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    break
+                sock.settimeout(remaining)
+                try:
+                    data, addr = sock.recvfrom(MAX_DATAGRAM)
+                except OSError: # timed out
+                    break
+                payload = bytearray(len(data))
+                kasa_cipher.decrypt_into(payload, data)
+                reply = parse_reply(payload)
+                try:
+                    devices[addr[0]] = reply.data['system']['get_sysinfo']
+                except (KeyError, TypeError):
+                    print('unexpected discovery reply from', addr[0], reply)
+    finally:
+        sock.close()
+    return devices
+
+
+def sysinfo_plugs(sysinfo, ip):
+    # returns the plug tuples for a device, one per outlet for a strip
+    device_id = sysinfo.get('deviceId', '')
+    model = sysinfo.get('model', '')
+    children = sysinfo.get('children')
+    if not children:
+        return [(device_id, sysinfo.get('alias', ip), model, ip)]
+    plugs = []
+    for child in children:
+        child_id = child['id']
+        if len(child_id) <= 2: # some firmware only reports the outlet number
+            child_id = device_id + child_id
+        plugs.append((child_id, child.get('alias', child_id), model, ip))
+    return plugs
+
+
+class Kasa_Registry(object):
+
+    def __init__(self, plugs=(), discovered=0, ttl_secs=REGISTRY_TTL_SECS):
+        self.plugs = [] # (device id, name, model, ip), the position is the plug index
+        self.by_id = {}
+        self.by_name = {}
+        self.by_ip = {} # ip -> list of plug indices, a strip has several outlets on one ip
+        self.discovered = discovered # time.time() of the last discovery
+        self.ttl_secs = ttl_secs
+        for plug in plugs:
+            self.add(plug)
+
+    def __len__(self):
+        return len(self.plugs)
+
+    def add(self, plug):
+        # adds or updates a plug, returns its index
+        plug = tuple(plug)
+        index = self.by_id.get(plug[ID])
+        if index is None:
+            index = len(self.plugs)
+            self.plugs.append(plug)
+        else:
+            old = self.plugs[index]
+            self.by_name.pop(old[NAME], None)
+            self.by_ip[old[IP]].remove(index)
+            self.plugs[index] = plug
+        self.by_id[plug[ID]] = index
+        self.by_name[plug[NAME]] = index
+        self.by_ip.setdefault(plug[IP], []).append(index)
+        return index
+
+    def lookup(self, key):
+        # returns the indices of the plugs with the given device id, name or ip
+        if key in self.by_id:
+            return [self.by_id[key]]
+        if key in self.by_name:
+            return [self.by_name[key]]
+        return list(self.by_ip.get(key, ()))
+
+    def merge(self, devices, now):
+        # adds the plugs of the devices returned by discover
+        for ip, sysinfo in devices.items():
+            for plug in sysinfo_plugs(sysinfo, ip):
+                self.add(plug)
+        self.discovered = now
+
+    def expired(self, now):
+        return not self.plugs or now - self.discovered > self.ttl_secs
+
+    def save(self, filename=REGISTRY_FILE):
+        with open(filename, 'w') as fp:
+            json.dump({'discovered': self.discovered, 'ttl': self.ttl_secs, 'plugs': self.plugs}, fp)
+
+    @staticmethod
+    def load(filename=REGISTRY_FILE):
+        # returns the saved registry, or None if there is no readable registry file
+        try:
+            with open(filename, 'r') as fp:
+                data = json.load(fp)
+            return Kasa_Registry(data['plugs'], data['discovered'], data['ttl'])
+        except (OSError, ValueError, KeyError):
+            return None
+
+
+def load_or_discover(filename=REGISTRY_FILE, registry=None, budget_secs=DISCOVERY_SECS, addresses=None):
+    # returns the registry (by default the saved one) if it has not expired, else rediscovers into it
+    # and saves it, plugs no longer answering are kept so plug indices do not change
+    now = time.time()
+    registry = registry or Kasa_Registry.load(filename) or Kasa_Registry()
+    if registry.expired(now):
+        devices = discover(budget_secs, addresses)
+        print("discovered {} kasa devices".format(len(devices)))
+        if devices:
+            registry.merge(devices, now)
+            registry.save(filename)
+    return registry
@@ -0,0 +1,39 @@
+'''
+  loop_utils.py
+  The event loop used by the blocking callers of the async drivers
+
+  The polling main loop dispatches (Batch_Dispatcher.dispatch_now), polls (Status_Poller.poll_now) and
+  reads the registry outside of asyncio. They all run their coroutines on the one loop kept here, so
+  the connection pools' streams and locks, which belong to the loop they were made in, survive from
+  one tick to the next instead of being reopened for every new loop.
+  check_loop is shared by the pools (kasa_pool.py, tasmota_pool.py) to drop streams from another loop.
+'''
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+blocking_loop = [None] # created on first use
+
+
+def run_until_complete(coro):
+    # runs the coroutine on the shared loop, blocking until it is done
+    if blocking_loop[0] is None:
+        blocking_loop[0] = asyncio.new_event_loop()
+    return blocking_loop[0].run_until_complete(coro)
+
+
+def check_loop(pool):
+    # drops the pool's streams and locks if they were made in another event loop (e.g. the asyncio
+    # runtime's after blocking calls), pool.streams maps ip -> entry with the stream writer second
+    loop = asyncio.get_event_loop()
+    if loop is not pool.loop:
+        for entry in pool.streams.values():
+            try:
+                entry[1].close()
+            except RuntimeError: # the old loop is closed
+                pass
+        pool.streams = {}
+        pool.locks = {}
+        pool.loop = loop
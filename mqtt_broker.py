@@ -0,0 +1,197 @@
+'''
+  mqtt_broker.py
+  Minimal mqtt broker stand-in with emulated Tasmota plugs, for testing my_tasmota_mqtt without a broker
+
+  Handles CONNECT, SUBSCRIBE (with + and # wildcards), QoS 0 PUBLISH, PINGREQ and DISCONNECT, which is
+  all mqtt_client.py uses. Emulated plugs act as Tasmota does: a message to cmnd/<topic>/POWER
+  (ON, OFF or empty to ask) is answered after the given latency with stat/<topic>/RESULT and
+  stat/<topic>/POWER. press() switches a plug as its button would, publishing the new state.
+  Runs its own asyncio loop in a thread. CPython only.
+
+  usage: python mqtt_broker.py [nbr plugs] [latency ms]
+  benchmarks dispatch to every emulated plug, per plug and in one burst
+'''
+
+import json
+import struct
+import threading
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+from mqtt_client import CONNACK, PUBLISH, SUBSCRIBE, SUBACK, PINGREQ, PINGRESP, DISCONNECT, \
+    packet, publish_packet
+
+PAYLOADS = (b'OFF', b'ON')
+
+
+def topic_matches(topic_filter, topic):
+    filter_parts = topic_filter.split('/')
+    parts = topic.split('/')
+    for i, part in enumerate(filter_parts):
+        if part == '#':
+            return True
+        if i >= len(parts) or (part != '+' and part != parts[i]):
+            return False
+    return len(parts) == len(filter_parts)
+
+
+async def read_packet(reader):
+    # returns (packet type, body)
+    header = await reader.readexactly(1)
+    length = 0
+    multiplier = 1
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7F) * multiplier
+        multiplier <<= 7
+        if not byte & 0x80:
+            break
+    return header[0], await reader.readexactly(length)
+
+
+class MQTT_Broker(object):
+
+    def __init__(self, topics=(), latency_ms=0, host='127.0.0.1', port=1883):
+        self.host = host
+        self.port = port
+        self.latency_ms = latency_ms
+        self.plugs = dict((topic, 0) for topic in topics) # emulated plug topic -> relay state
+        self.subscriptions = [] # (writer, topic filter)
+        self.commands = 0 # commands received by emulated plugs
+        self.server = None
+        self.loop = None
+
+    def route(self, topic, payload):
+        data = publish_packet(topic, payload)
+        for writer, topic_filter in self.subscriptions:
+            if topic_matches(topic_filter, topic):
+                writer.write(data)
+        parts = topic.split('/')
+        if len(parts) == 3 and parts[0] == 'cmnd' and parts[2].upper() == 'POWER' and parts[1] in self.plugs:
+            self.commands += 1
+            self.loop.call_later(self.latency_ms / 1000, self.plug_command, parts[1], payload.upper())
+
+    def plug_command(self, topic, payload):
+        if payload in (b'ON', b'1'):
+            self.plugs[topic] = 1
+        elif payload in (b'OFF', b'0'):
+            self.plugs[topic] = 0
+        elif payload in (b'TOGGLE', b'2'):
+            self.plugs[topic] ^= 1
+        self.publish_state(topic)
+
+    def publish_state(self, topic):
+        state = PAYLOADS[self.plugs[topic]]
+        self.route('stat/{}/RESULT'.format(topic), json.dumps({'POWER': state.decode()}).encode())
+        self.route('stat/{}/POWER'.format(topic), state)
+
+    def press(self, topic):
+        # switches an emulated plug from another thread, as if its button was pressed
+        self.loop.call_soon_threadsafe(self.plug_command, topic, b'TOGGLE')
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                packet_type, body = await read_packet(reader)
+                kind = packet_type & 0xF0
+                if kind == 0x10: # CONNECT
+                    writer.write(packet(CONNACK, b'\x00\x00'))
+                elif kind == PUBLISH:
+                    topic_len = struct.unpack('>H', body[:2])[0]
+                    offset = 2 + topic_len + (2 if packet_type & 0x06 else 0)
+                    self.route(body[2:2 + topic_len].decode(), body[offset:])
+                elif kind == SUBSCRIBE & 0xF0:
+                    packet_id, pos, granted = body[:2], 2, b''
+                    while pos < len(body):
+                        filter_len = struct.unpack('>H', body[pos:pos + 2])[0]
+                        self.subscriptions.append((writer, body[pos + 2:pos + 2 + filter_len].decode()))
+                        pos += 3 + filter_len
+                        granted += b'\x00'
+                    writer.write(packet(SUBACK, packet_id + granted))
+                elif kind == PINGREQ:
+                    writer.write(packet(PINGRESP))
+                elif kind == DISCONNECT:
+                    break
+                await writer.drain()
+        except (EOFError, ConnectionError):
+            pass
+        finally:
+            self.subscriptions = [s for s in self.subscriptions if s[0] is not writer]
+            writer.close()
+
+    def start_thread(self):
+        # runs the broker in a daemon thread, returns once it is listening
+        ready = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.server = self.loop.run_until_complete(
+                asyncio.start_server(self.handle_client, self.host, self.port))
+            ready.set()
+            self.loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        def shutdown():
+            self.server.close()
+            for task in asyncio.all_tasks(self.loop): # connected clients
+                task.cancel()
+            self.loop.call_soon(self.loop.stop) # after the cancelled tasks have run
+
+        self.loop.call_soon_threadsafe(shutdown)
+
+
+if __name__ == "__main__":
+    import sys
+    import io
+    import time
+    from contextlib import redirect_stdout
+
+    import my_tasmota_mqtt
+    from dispatch import Batch_Dispatcher
+    from event_store import plug_event
+    import timer_utils
+
+    nbr_plugs = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    latency_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 20
+    my_tasmota_mqtt.smartplugs = tuple(('plug {}'.format(i), 'tasmota_{:06X}'.format(i)) for i in range(nbr_plugs))
+    broker = MQTT_Broker([plug[1] for plug in my_tasmota_mqtt.smartplugs], latency_ms, port=18830).start_thread()
+    print("{} emulated plugs, latency {} ms".format(nbr_plugs, latency_ms))
+
+    driver = my_tasmota_mqtt.my_tasmota_mqtt('127.0.0.1', 18830)
+    t = time.time()
+    driver.connect()
+    while len(driver.states) < nbr_plugs and time.time() - t < 5:
+        driver.client.wait_msg(1)
+    print("states of {} plugs pushed {:.0f} ms after connecting".format(len(driver.states), (time.time() - t) * 1000))
+    utils = timer_utils.Time_utils(0)
+
+    class per_plug(object):
+        # hides async_set_states so the dispatcher sends one command per plug
+        def __init__(self, driver):
+            self.async_set_plug_state = driver.async_set_plug_state
+
+    print("{:>10} {:>6} {:>10} {:>10} {:>8}".format('mode', 'state', 'plugs', 'total ms', 'ok'))
+    for name, plugs in (('per plug', per_plug(driver)), ('burst', driver)):
+        dispatcher = Batch_Dispatcher(plugs, utils, max_workers=64)
+        for state in (1, 0):
+            events = [plug_event(0, 0, index, state) for index in range(nbr_plugs)]
+            t = time.time()
+            with redirect_stdout(io.StringIO()):
+                results = dispatcher.dispatch_now(events)
+            print("{:>10} {:>6} {:>10} {:>10.0f} {:>8}".format(
+                name, state, len(events), (time.time() - t) * 1000, len([r for r in results if r[1]])))
+    print("all emulated plugs off: {}, commands received: {}".format(
+        not any(broker.plugs.values()), broker.commands))
+    driver.pushed_states()
+    broker.press('tasmota_000003')
+    time.sleep(latency_ms / 1000 + 0.1)
+    print("pushed after a button press: {}".format(driver.pushed_states()))
+    broker.stop()
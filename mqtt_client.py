@@ -0,0 +1,184 @@
+'''
+  mqtt_client.py
+  Minimal MQTT 3.1.1 client (QoS 0) for MicroPython and CPython
+
+  Keeps one connection to the broker. publish_many sends a burst of messages in a single socket write,
+  check_msg reads whatever has arrived without blocking and passes each PUBLISH to the callback,
+  wait_msg blocks until a message arrives or the timeout expires. A ping is sent when the connection
+  has been idle for half the keepalive.
+'''
+
+import socket
+import struct
+
+from timer_utils import const, ticks_ms, ticks_diff
+
+CONNECT = const(0x10)
+CONNACK = const(0x20)
+PUBLISH = const(0x30)
+SUBSCRIBE = const(0x82) # with the reserved flag bits MQTT requires
+SUBACK = const(0x90)
+PINGREQ = const(0xC0)
+PINGRESP = const(0xD0)
+DISCONNECT = const(0xE0)
+
+
+def encode_length(n):
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        out.append(byte | 0x80 if n else byte)
+        if not n:
+            return bytes(out)
+
+
+def encode_string(text):
+    data = text.encode() if isinstance(text, str) else text
+    return struct.pack('>H', len(data)) + data
+
+
+def packet(packet_type, body=b''):
+    return bytes([packet_type]) + encode_length(len(body)) + body
+
+
+def publish_packet(topic, payload, retain=False):
+    payload = payload.encode() if isinstance(payload, str) else payload
+    return packet(PUBLISH | (1 if retain else 0), encode_string(topic) + payload)
+
+
+def parse_packet(data):
+    # returns (packet type, body, length used) for the first complete packet in data, or None
+    multiplier = 1
+    length = 0
+    pos = 1
+    while True:
+        if pos >= len(data):
+            return None
+        byte = data[pos]
+        length += (byte & 0x7F) * multiplier
+        multiplier <<= 7
+        pos += 1
+        if not byte & 0x80:
+            break
+    if len(data) < pos + length:
+        return None
+    return data[0], data[pos:pos + length], pos + length
+
+
+class MQTT_Client(object):
+
+    def __init__(self, server, port=1883, client_id='smartplug_timer', keepalive=60, timeout=2.0, callback=None):
+        self.server = server
+        self.port = port
+        self.client_id = client_id
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.callback = callback # called with (topic str, payload bytes) for each message received
+        self.sock = None
+        self.pending = b'' # bytes received that are not yet a complete packet
+        self.packet_id = 0
+        self.last_sent = 0
+
+    def connect(self):
+        addr = socket.getaddrinfo(self.server, self.port)[0][-1]
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        try:
+            self.sock.connect(addr)
+            body = encode_string('MQTT') + bytes([4, 0x02]) + struct.pack('>H', self.keepalive) + \
+                encode_string(self.client_id) # protocol level 4 (3.1.1), clean session
+            self.send(packet(CONNECT, body))
+            packet_type, body = self.wait_packet(CONNACK)
+            if body[1] != 0:
+                raise OSError('broker refused connection, code {}'.format(body[1]))
+        except OSError:
+            self.close()
+            raise
+        self.pending = b''
+
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.send(packet(DISCONNECT))
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+
+    def send(self, data):
+        self.sock.settimeout(self.timeout)
+        self.sock.sendall(data) if hasattr(self.sock, 'sendall') else self.sock.write(data)
+        self.last_sent = ticks_ms()
+
+    def publish(self, topic, payload, retain=False):
+        self.send(publish_packet(topic, payload, retain))
+
+    def publish_many(self, messages):
+        # sends a list of (topic, payload) in one write
+        self.send(b''.join(publish_packet(topic, payload) for topic, payload in messages))
+
+    def subscribe(self, topic_filter):
+        self.packet_id = self.packet_id % 0xFFFF + 1
+        self.send(packet(SUBSCRIBE, struct.pack('>H', self.packet_id) + encode_string(topic_filter) + b'\x00'))
+        self.wait_packet(SUBACK)
+
+    def handle(self, packet_type, body):
+        if packet_type & 0xF0 == PUBLISH:
+            topic_len = struct.unpack('>H', body[:2])[0]
+            topic = body[2:2 + topic_len].decode()
+            offset = 2 + topic_len + (2 if packet_type & 0x06 else 0) # a packet id follows the topic if QoS > 0
+            if self.callback:
+                self.callback(topic, body[offset:])
+
+    def read_available(self, timeout):
+        # receives into pending, timeout 0 does not block, returns False if nothing arrived
+        self.sock.settimeout(timeout)
+        try:
+            data = self.sock.recv(1024)
+        except OSError: # timed out or would block
+            return False
+        if not data:
+            raise OSError('broker closed the connection')
+        self.pending += data
+        return True
+
+    def next_packet(self):
+        parsed = parse_packet(self.pending)
+        if parsed is None:
+            return None
+        packet_type, body, used = parsed
+        self.pending = self.pending[used:]
+        return packet_type, body
+
+    def wait_packet(self, wanted):
+        # blocks until a packet of the wanted type arrives, handling messages received meanwhile
+        start = ticks_ms()
+        while True:
+            parsed = self.next_packet()
+            if parsed:
+                if parsed[0] & 0xF0 == wanted:
+                    return parsed
+                self.handle(*parsed)
+            elif ticks_diff(ticks_ms(), start) > self.timeout * 1000 or not self.read_available(self.timeout):
+                raise OSError('no reply from broker')
+
+    def check_msg(self):
+        # handles every message already received without blocking, returns the number handled
+        if ticks_diff(ticks_ms(), self.last_sent) > self.keepalive * 500:
+            self.send(packet(PINGREQ))
+        self.read_available(0)
+        handled = 0
+        parsed = self.next_packet()
+        while parsed:
+            self.handle(*parsed)
+            handled += 1
+            parsed = self.next_packet()
+        return handled
+
+    def wait_msg(self, timeout):
+        # blocks until at least one message has been handled or the timeout expires
+        handled = self.check_msg()
+        if not handled and self.read_available(timeout):
+            handled = self.check_msg()
+        return handled
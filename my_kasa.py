@@ -1,9 +1,8 @@
 #  Class to turn on or off kasa plugs using prediscovered ids 
-import json
 import socket
-from time import sleep
-import struct
-from builtins import bytes
+from kasa_pool import Kasa_Connection_Pool
+import kasa_cipher
+from kasa_registry import Kasa_Registry, REGISTRY_FILE, SYSINFO, discover, load_or_discover, sysinfo_plugs
 
 try:
     from micropython import const
@@ -11,7 +10,14 @@ try:
 except ImportError:
     const = lambda x : x
     upython = False
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
     
+DEADLINE_MS = const(3000) # time allowed for each device to answer its command in a batch
+
 smartplugs = const(( 
             ('8006B196B161301BAAB04C385B337B3D1FB8CA0000', 'plug 1', 'KP303(UK)', '192.168.1.186'),
             ('8006B196B161301BAAB04C385B337B3D1FB8CA0001', 'plug 2', 'KP303(UK)', '192.168.1.186'),
@@ -20,105 +26,212 @@ smartplugs = const((
             ('8006E091F6F579E27A1E9B7E3C5CA5BE1FA21112', 'security lamp1', 'KP105(UK)', '192.168.1.185')))
 
 class My_Kasa():
-    def __init__(self):
+    def __init__(self, registry_file=REGISTRY_FILE):
         self.kasa_port = 9999
         self.timeout = 2.0
+        self.deadline_ms = DEADLINE_MS
+        self.registry_file = registry_file
+        # plugs found by discovery (see kasa_registry.py), the smartplugs tuple until the first discovery
+        self.registry = Kasa_Registry.load(registry_file) or Kasa_Registry(smartplugs)
+        self.smartplugs = self.registry.plugs
+        self.sys_info = None
+        self.device_id = None
         self.show_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.pool = Kasa_Connection_Pool(self.kasa_port, self.timeout) # connections kept open per device ip
+        self.sysinfo_frame = kasa_cipher.encrypt(SYSINFO)
+        self.build_frames()
+
+    def build_frames(self):
+        self.frames = {} # (plug indices, state) -> encrypted relay command, so dispatch does no encryption
+        for plug_index in range(len(self.smartplugs)):
+            for state in (0, 1):
+                self.relay_frame((plug_index,), state)
+
+    def refresh_registry(self, addresses=None):
+        # rediscovers the plugs if the registry file was missing or has expired, call once the network is up
+        self.use_registry(load_or_discover(self.registry_file, self.registry, addresses=addresses))
+
+    def use_registry(self, registry):
+        self.registry = registry
+        self.smartplugs = registry.plugs
+        self.build_frames()
+
+    def lookup(self, key):
+        # returns the plug indices with the given device id, name or ip
+        return self.registry.lookup(key)
     
     def show(self, text, addr=('192.168.1.117',9998)):
         # print(text)
         print('call to show with text:', text)
                 
     def show_discovered_plugs(self):
-        for i in range(len(smartplugs)):
-            print(smartplugs[i][1:])
+        for i in range(len(self.smartplugs)):
+            print(self.smartplugs[i][1:])
 
-    def get_system_info(self):    
-        self.sys_info = self.send_udp_command('{"system":{"get_sysinfo":{}}}', protocol='udp')
+    def get_system_info(self, plug_index=0):
+        # queries the device of the given plug over udp
+        ip = self.smartplugs[plug_index][3]
+        self.sys_info = discover(self.timeout, [(ip, self.kasa_port)], 1).get(ip)
         if self.sys_info != None:
-            # print("full info=", self.sys_info)
-            self.sys_info =  self.sys_info['system']['get_sysinfo']
             print("in get_system_info", self.sys_info)
             if not self.device_id:
                 self.device_id = self.sys_info['deviceId']
                 print("device id =", self.device_id)
         else:
             print("failed to get sys_info")
-        # return self._udp_send_command('{"system":{"get_sysinfo":{}}}')
 
     def get_plug_info(self, plug_num):
         if self.sys_info != None:
-            target_plug = [plug for plug in self.sys_info['children'] if plug['id'] == zfl(str(int(plug_num)-1), 2)]
+            target_plug = [plug for plug in self.sys_info['children'] if plug['id'][-2:] == '{:02d}'.format(int(plug_num)-1)]
             return target_plug
         else:
             print("Plug info not available")
             return None
 
+    def device_ips(self):
+        # one entry per physical device, the outlets of a strip share an ip
+        return list(self.registry.by_ip)
+
+    def sysinfo_data(self, reply):
+        if reply is None or not reply.ok:
+            return None
+        try:
+            return reply.data['system']['get_sysinfo']
+        except (KeyError, TypeError):
+            return None
+
+    def get_sysinfo(self, ip):
+        # returns the device's sysinfo dict over its pooled tcp connection, or None
+        return self.sysinfo_data(self.pool.send_and_recv(self.sysinfo_frame, ip))
+
+    async def async_get_sysinfo(self, ip):
+        # awaitable version of get_sysinfo
+        return self.sysinfo_data(await self.pool.async_send_and_recv(self.sysinfo_frame, ip))
+
+    def plug_ips(self, indices):
+        # the device ips of the given plugs, all devices if indices is None
+        if indices is None:
+            return self.device_ips()
+        ips = []
+        for index in indices:
+            ip = self.smartplugs[index][3]
+            if ip not in ips:
+                ips.append(ip)
+        return ips
+
+    def collect_states(self, ips, sysinfos, indices):
+        # returns a dict of plug index -> relay state for the plugs whose device answered
+        states = {}
+        for ip, sysinfo in zip(ips, sysinfos):
+            if sysinfo is not None:
+                for index, state in self.outlet_states(ip, sysinfo):
+                    if indices is None or index in indices:
+                        states[index] = state
+        return states
+
+    def get_states(self, indices=None):
+        # reads the relay states of the given plugs (all plugs if None), one sysinfo request per device
+        ips = self.plug_ips(indices)
+        return self.collect_states(ips, [self.get_sysinfo(ip) for ip in ips], indices)
+
+    async def async_get_states(self, indices=None):
+        # awaitable get_states, the devices are read concurrently
+        ips = self.plug_ips(indices)
+        return self.collect_states(ips, await asyncio.gather(*[self.async_get_sysinfo(ip) for ip in ips]), indices)
+
+    def outlet_states(self, ip, sysinfo):
+        # returns (plug index, relay state) for the registered outlets in a device's sysinfo
+        if 'children' not in sysinfo:
+            return [(index, sysinfo.get('relay_state', 0)) for index in self.registry.by_ip.get(ip, ())]
+        states = []
+        for plug, child in zip(sysinfo_plugs(sysinfo, ip), sysinfo['children']):
+            index = self.registry.by_id.get(plug[0])
+            if index is not None:
+                states.append((index, child.get('state', 0)))
+        return states
+
     def get_name(self, index):
-        if index < len(smartplugs):
-            return smartplugs[index][1]
+        if index < len(self.smartplugs):
+            return self.smartplugs[index][1]
         else:
             return None
         
+    def relay_command(self, plug_index, state):
+        # returns the json relay command and address for the given plug
+        addr = (self.smartplugs[plug_index][3], self.kasa_port)
+        return self.relay_json((plug_index,), state), addr
+
+    def relay_json(self, indices, state):
+        # returns the json relay command for plugs on the same device
+        if self.smartplugs[indices[0]][2][2] == '1': # single plug (no children)
+            return '{"system":{"set_relay_state":{"state":' + str(state) + '}}}'
+        return '{"context":{"child_ids":["' + '","'.join(self.smartplugs[i][0] for i in indices) + '"]},' + \
+                '"system":{"set_relay_state":{"state":' + str(state) + '}}}'
+
+    def relay_frame(self, indices, state):
+        # returns the encrypted relay command for the tuple of plug indices, built once and cached
+        key = (indices, state)
+        frame = self.frames.get(key)
+        if frame is None:
+            frame = self.frames[key] = kasa_cipher.encrypt(self.relay_json(indices, state))
+        return frame
+
+    def relay_batches(self, pairs):
+        # groups (plug index, state) pairs by device ip and state, returns a list of (encrypted relay command,
+        # ip, plug indices), one command switches all the outlets of a strip going to the same state
+        groups = {}
+        for plug_index, state in pairs:
+            groups.setdefault((self.smartplugs[plug_index][3], state), []).append(plug_index)
+        batches = []
+        for (ip, state), indices in groups.items():
+            print("Setting plug indices {} on {} {}".format(indices, ip, 'on' if state else 'off'))
+            batches.append((self.relay_frame(tuple(indices), state), ip, indices))
+        return batches
+
+    def set_states(self, pairs):
+        # sets several plugs with one command per device and state, returns a dict of plug index -> reply
+        replies = {}
+        for command, ip, indices in self.relay_batches(pairs):
+            reply = self.pool.send_and_recv(command, ip)
+            for plug_index in indices:
+                replies[plug_index] = reply
+        return replies
+
+    async def device_send(self, command, ip):
+        # async_send_and_recv within the device's deadline, None if the device missed it
+        try:
+            return await asyncio.wait_for(self.pool.async_send_and_recv(command, ip), self.deadline_ms / 1000)
+        except asyncio.TimeoutError:
+            print("{} missed its {} ms deadline".format(ip, self.deadline_ms))
+            return None
+
+    async def async_set_states(self, pairs):
+        # awaitable set_states, the commands to different devices are sent concurrently, each with its own
+        # deadline so a slow device does not hold up the others
+        batches = self.relay_batches(pairs)
+        results = await asyncio.gather(*[self.device_send(command, ip) for command, ip, indices in batches])
+        replies = {}
+        for (command, ip, indices), reply in zip(batches, results):
+            for plug_index in indices:
+                replies[plug_index] = reply
+        return replies
+
     def set_plug_state(self, plug_index, state):
         # state 0 is off, 1 is on, index into smartplugs tuple for ip and plug id
         print("Setting plug index {} ({}) {}".format( plug_index, self.get_name(plug_index), 'on' if state else 'off'))
-        plug_id = smartplugs[plug_index][0]
-        addr = (smartplugs[plug_index][3], self.kasa_port)
-        if smartplugs[plug_index][2][2] == '1': # single plug (no children)
-            relay_command = '{"system":{"set_relay_state":{"state":' + str(state) + '}}}'
-        else:
-            relay_command = '{"context":{"child_ids":["' + plug_id + '"]},' + \
-                    '"system":{"set_relay_state":{"state":' + str(state) + '}}}'
-        # print(relay_command)
-        return self.tcp_send_and_recv(self._encrypt_command(relay_command), addr)
-        
-    def tcp_send_and_recv(self, command, addr=None):
-
-        if addr: 
-            # here if allocating sock on each call
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            sock.settimeout(self.timeout)
-            try:
-                sock.connect(addr) # (self.ip, self.port))
-            except Exception as e:
-                print(e, addr)
-            
-        else:
-            if sock == None:
-                print("sock not connected")
-                return None
+        return self.pool.send_and_recv(self.relay_frame((plug_index,), state), self.smartplugs[plug_index][3])
+
+    async def async_set_plug_state(self, plug_index, state):
+        # awaitable version of set_plug_state
+        print("Setting plug index {} ({}) {}".format( plug_index, self.get_name(plug_index), 'on' if state else 'off'))
+        return await self.pool.async_send_and_recv(self.relay_frame((plug_index,), state), self.smartplugs[plug_index][3])
         
-        if sock != None:
-            try:
-                sock.send(command) # self._encrypt_command(command))
-                # print("sent", command)
-                data = sock.recv(2048)       
-                sock.close()
-                # the first 4 chars are the length of the command so can be excluded
-                return data[4:]
-            except:
-                pass
-        return None
+    def tcp_send_and_recv(self, command, addr):
+        # returns the kasa_reply to the encrypted command, or None if the device could not be reached
+        return self.pool.send_and_recv(command, addr[0])
 
     def _encrypt_command(self, string):
-        key = 171
-        result = b''
-        
-        result = struct.pack(">I", len(string)) # prepend length for tcp msgs
-        for i in bytes(string.encode('latin-1')):
-            a = key ^ i
-            key = a
-            result += bytes([a])
-        return result
+        return kasa_cipher.encrypt(string) # prepends the length for tcp msgs
 
     def _decrypt_command(self, string):
-        key = 171
-        result = b''
-        for i in bytes(string):
-            a = key ^ i
-            key = i
-            result += bytes([a])
-        return result.decode('latin-1')
-
+        return kasa_cipher.decrypt(string)
@@ -2,20 +2,23 @@
   my_tasmota.py
   Class to turn on or off tasmota plugs using http protocol
  
-  Update the smartplugs tuple with your plug ip addresses
+  Update the smartplugs tuple with your plug ip addresses (ip:port for a plug not on port 80)
   names field only used for debug printing, it does not need to match the actual plug name    
 '''
-import json
-import time
 
 try:
     from micropython import const
-    import urequests as requests
     is_upython = True
 except ImportError:
     const = lambda x : x
     is_upython = False
-    import requests
+
+from tasmota_pool import Tasmota_Session_Pool
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
     
 smartplugs = const(( 
             # tuple of plug names and reserved (or static) Ip addresses   
@@ -23,57 +26,99 @@ smartplugs = const((
             ('plug EA2D', '192.168.4.12'),
             ('plug E946', '192.168.4.13')))
 
+POWER_COMMANDS = ('Power%200', 'Power%201') # indexed by state
+DEADLINE_MS = const(3000) # time allowed for each plug to answer its command in a batch
+
+def power_state(reply):
+    # returns the relay state in a Power command reply, or None
+    power = reply.get('POWER', reply.get('POWER1')) if reply else None
+    return 1 if power == 'ON' else 0 if power == 'OFF' else None
+
 class my_tasmota():
     def __init__(self):
-        pass
+        self.timeout = 2.0
+        self.deadline_ms = DEADLINE_MS
+        self.pool = Tasmota_Session_Pool(self.timeout) # keep-alive connection per plug ip
 
     def send_request(self, plug_ip, command):
-        url = f"http://{plug_ip}/cm?cmnd={command}"
-        try:
-            # print(f"sending: {url}")
-            response = requests.get(url)
-            if response.status_code == 200:
-                # print(f"response: {response.json()}")
-                return response.json()
-            else:
-                print(f"Error: {response.status_code}")
-                return None
-        except Exception as e:
-            if is_upython:
-                # Handle network-related errors in MicroPython
-                if isinstance(e, OSError):
-                    if e.args[0] == -2:
-                        print("Network is unreachable")
-                    elif e.args[0] == -3:
-                        print("Temporary failure in name resolution")
-                    elif e.args[0] == 110:
-                        print("Connection timed out")
-                    else:
-                        print(f"An error occurred: {e}")
-                else:
-                    print(f"An error occurred: {e}")
-            else:
-                # Handle network-related errors in CPython
-                if isinstance(e, requests.exceptions.RequestException):
-                    print(f"Unable to connect to {plug_ip}")
-                else:
-                    print(f"An error occurred: {e}")
+        # returns the json reply, or None if the plug could not be reached
+        return self.pool.get(plug_ip, '/cm?cmnd=' + command)
  
+    async def async_send_request(self, plug_ip, command):
+        # awaitable version of send_request
+        return await self.pool.async_get(plug_ip, '/cm?cmnd=' + command)
+
     def set_plug_state(self, index, state):
         plug_name,  plug_ip  = smartplugs[index]
-        command = f"Power%20{state}"
+        command = POWER_COMMANDS[state]
         state_str = "On" if state == 1 else "Off" if state == 0 else "?"
         print("Setting {} ({}) {}".format(plug_name, plug_ip, state_str ))
 
         return self.send_request(plug_ip, command)
 
+    async def async_set_plug_state(self, index, state):
+        plug_name,  plug_ip  = smartplugs[index]
+        state_str = "On" if state == 1 else "Off" if state == 0 else "?"
+        print("Setting {} ({}) {}".format(plug_name, plug_ip, state_str ))
+        return await self.async_send_request(plug_ip, POWER_COMMANDS[state])
+
+    def set_states(self, pairs):
+        # sets a list of (plug index, state), returns a dict of plug index -> reply
+        return dict((index, self.set_plug_state(index, state)) for index, state in pairs)
+
+    async def plug_send(self, index, state):
+        # async_set_plug_state within the plug's deadline, None if the plug missed it
+        try:
+            return await asyncio.wait_for(self.async_set_plug_state(index, state), self.deadline_ms / 1000)
+        except asyncio.TimeoutError:
+            print("{} missed its {} ms deadline".format(smartplugs[index][0], self.deadline_ms))
+            return None
+
+    async def async_set_states(self, pairs):
+        # awaitable set_states, the plugs are sent their commands concurrently, each within its deadline
+        replies = await asyncio.gather(*[self.plug_send(index, state) for index, state in pairs])
+        return dict((pair[0], reply) for pair, reply in zip(pairs, replies))
+
     def get_plug_state(self, index):
         plug_name,  plug_ip = smartplugs[index]
         command = "Power"
         print(f"Getting status of {plug_name} ({plug_ip})")
         return self.send_request(plug_ip, command)
+
+    async def async_get_plug_state(self, index):
+        plug_name,  plug_ip = smartplugs[index]
+        return await self.async_send_request(plug_ip, "Power")
  
 
+    def get_states(self, indices=None):
+        # returns a dict of plug index -> relay state for the plugs that answered (all plugs if indices is None)
+        indices = range(len(smartplugs)) if indices is None else indices
+        states = {}
+        for index in indices:
+            state = power_state(self.send_request(smartplugs[index][1], "Power"))
+            if state is not None:
+                states[index] = state
+        return states
+
+    async def async_get_states(self, indices=None):
+        # awaitable get_states, the plugs are asked concurrently
+        indices = list(range(len(smartplugs)) if indices is None else indices)
+        replies = await asyncio.gather(*[self.async_get_plug_state(index) for index in indices])
+        return dict((index, power_state(reply)) for index, reply in zip(indices, replies) if power_state(reply) is not None)
+
+    def get_timers(self, index):
+        # returns the Timers reply with the plug's 16 on-device timers (see tasmota_timers.py)
+        return self.send_request(smartplugs[index][1], "Timers")
+
+    def set_timers(self, index, backlog_command):
+        return self.send_request(smartplugs[index][1], backlog_command)
+
+    async def async_get_timers(self, index):
+        return await self.async_send_request(smartplugs[index][1], "Timers")
+
+    async def async_set_timers(self, index, backlog_command):
+        return await self.async_send_request(smartplugs[index][1], backlog_command)
+
     def get_name(self, index):
         if index < len(smartplugs):
             return smartplugs[index][0]
@@ -0,0 +1,278 @@
+'''
+  my_tasmota_mqtt.py
+  Class to turn on or off tasmota plugs over mqtt
+
+  Update the smartplugs tuple with your plug names and mqtt topics (the Topic shown in the plug's
+  MQTT configuration), and BROKER with the address of your mqtt broker.
+  One connection to the broker is kept open. Commands are published to cmnd/<topic>/POWER, a batch
+  of plugs is published in a single write, and the plugs' stat/<topic>/POWER messages confirm each
+  command and keep a table of plug states up to date by push, so the plugs need not be polled.
+  A broker that cannot be reached is not tried again for RETRY_SECS, and pushed_states never connects,
+  so a broker that is down costs the timer loop one connect timeout per RETRY_SECS. Under asyncio
+  connecting runs in a thread (CPython) so it does not block the event loop.
+  python mqtt_broker.py runs this driver against a bundled stand-in broker.
+'''
+
+try:
+    from micropython import const
+    is_upython = True
+except ImportError:
+    const = lambda x : x
+    is_upython = False
+
+from mqtt_client import MQTT_Client, ticks_ms, ticks_diff
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+BROKER = '192.168.4.2'
+MQTT_PORT = const(1883)
+STATE_TOPIC = 'stat/+/POWER'
+PAYLOADS = (b'OFF', b'ON') # indexed by state
+WAIT_MS = const(10) # sleep between checks for confirmations under asyncio
+RETRY_SECS = const(30) # wait after failing to reach the broker before connecting again
+
+smartplugs = const((
+            # tuple of plug names and mqtt topics
+            ('plug 14F0', 'tasmota_14F0'),
+            ('plug EA2D', 'tasmota_EA2D'),
+            ('plug E946', 'tasmota_E946')))
+
+class my_tasmota_mqtt():
+    def __init__(self, broker=BROKER, port=MQTT_PORT):
+        self.timeout = 2.0
+        self.client = MQTT_Client(broker, port, 'smartplug_timer', timeout=self.timeout, callback=self.on_message)
+        self.topics = dict((plug[1], index) for index, plug in enumerate(smartplugs))
+        self.states = {} # plug index -> last state the plug published
+        self.pushed = {} # plug index -> state published since pushed_states was last called
+        self.waiting = {} # plug index -> state a command is waiting to see confirmed
+        self.failed_at = None # ticks ms of the last failed connect
+        self.busy = False # a publish is running in a thread, the socket is not read meanwhile
+
+    def on_message(self, topic, payload):
+        parts = topic.split('/')
+        if len(parts) != 3 or parts[0] != 'stat' or parts[2] != 'POWER' or parts[1] not in self.topics:
+            return
+        if payload not in PAYLOADS:
+            return
+        index = self.topics[parts[1]]
+        state = PAYLOADS.index(payload)
+        self.states[index] = state
+        self.pushed[index] = state
+        if self.waiting.get(index) == state:
+            del self.waiting[index]
+
+    def connect(self):
+        self.client.connect()
+        self.client.subscribe(STATE_TOPIC)
+        # every plug answers an empty POWER command with its state, filling the table
+        self.client.publish_many([('cmnd/{}/POWER'.format(plug[1]), b'') for plug in smartplugs])
+
+    def reconnect(self):
+        # connects unless a connect failed less than RETRY_SECS ago, returns False if not connected
+        if self.failed_at is not None and ticks_diff(ticks_ms(), self.failed_at) < RETRY_SECS * 1000:
+            return False
+        try:
+            self.connect()
+        except OSError as e:
+            print("mqtt broker {}: {}, retrying in {} s".format(self.client.server, e, RETRY_SECS))
+            self.client.close()
+            self.failed_at = ticks_ms()
+            return False
+        self.failed_at = None
+        return True
+
+    def publish(self, messages):
+        # publishes a list of (topic, payload) in one write, reconnecting once if the broker dropped the connection
+        for attempt in range(2):
+            reused = self.client.sock is not None
+            if not reused and not self.reconnect():
+                return False
+            try:
+                self.client.publish_many(messages)
+                return True
+            except OSError as e:
+                print("mqtt broker {}: {}".format(self.client.server, e))
+                self.client.close()
+            if not reused:
+                return False
+        return False
+
+    async def async_publish(self, messages):
+        # publish without blocking the event loop, a live connection takes the write into its socket buffer,
+        # connecting waits on the broker so it runs in a thread where there are threads
+        loop = asyncio.get_event_loop()
+        if not hasattr(loop, 'run_in_executor'): # MicroPython
+            return self.publish(messages)
+        while self.busy:
+            await asyncio.sleep(WAIT_MS / 1000)
+        if self.client.sock is not None:
+            try:
+                self.client.publish_many(messages)
+                return True
+            except OSError as e:
+                print("mqtt broker {}: {}".format(self.client.server, e))
+                self.client.close()
+        self.busy = True
+        try:
+            return await loop.run_in_executor(None, self.publish, messages)
+        finally:
+            self.busy = False
+
+    def check_msg(self):
+        if self.client.sock is None or self.busy:
+            return 0
+        try:
+            return self.client.check_msg()
+        except OSError as e:
+            print("mqtt broker {}: {}".format(self.client.server, e))
+            self.client.close()
+            return 0
+
+    def command_messages(self, pairs):
+        # returns the messages for the commands, each command waits for its confirmation
+        for index, state in pairs:
+            plug_name, topic = smartplugs[index]
+            state_str = "On" if state == 1 else "Off" if state == 0 else "?"
+            print("Setting {} ({}) {}".format(plug_name, topic, state_str))
+            self.waiting[index] = state
+        return [('cmnd/{}/POWER'.format(smartplugs[index][1]), PAYLOADS[state]) for index, state in pairs]
+
+    def replies(self, pairs):
+        # a plug's reply is its confirmed state in the form of the http reply, None if not confirmed
+        replies = {}
+        for index, state in pairs:
+            if self.waiting.get(index) == state:
+                del self.waiting[index]
+                replies[index] = None
+            else:
+                replies[index] = {'POWER': PAYLOADS[state].decode()}
+        return replies
+
+    def set_states(self, pairs):
+        # sets a list of (plug index, state) in one burst, returns a dict of plug index -> reply
+        if self.publish(self.command_messages(pairs)):
+            start = ticks_ms()
+            while any(index in self.waiting for index, state in pairs):
+                remaining = self.timeout - ticks_diff(ticks_ms(), start) / 1000
+                if remaining <= 0:
+                    break
+                try:
+                    self.client.wait_msg(remaining)
+                except OSError:
+                    self.client.close()
+                    break
+        return self.replies(pairs)
+
+    async def async_set_states(self, pairs):
+        # awaitable set_states, checks for confirmations between sleeps
+        if await self.async_publish(self.command_messages(pairs)):
+            start = ticks_ms()
+            while any(index in self.waiting for index, state in pairs):
+                if ticks_diff(ticks_ms(), start) > self.timeout * 1000 or self.client.sock is None:
+                    break
+                if not self.check_msg():
+                    await asyncio.sleep(WAIT_MS / 1000)
+        return self.replies(pairs)
+
+    def set_plug_state(self, index, state):
+        return self.set_states([(index, state)])[index]
+
+    async def async_set_plug_state(self, index, state):
+        return (await self.async_set_states([(index, state)]))[index]
+
+    def get_plug_state(self, index):
+        # returns the last state the plug published, asking the plug if it has not published one
+        self.check_msg()
+        if index not in self.states:
+            plug_name, topic = smartplugs[index]
+            print(f"Getting status of {plug_name} ({topic})")
+            if self.publish([('cmnd/{}/POWER'.format(topic), b'')]):
+                start = ticks_ms()
+                while index not in self.states and ticks_diff(ticks_ms(), start) < self.timeout * 1000:
+                    try:
+                        self.client.wait_msg(self.timeout)
+                    except OSError:
+                        self.client.close()
+                        break
+        if index not in self.states:
+            return None
+        return {'POWER': PAYLOADS[self.states[index]].decode()}
+
+    async def async_get_plug_state(self, index):
+        self.check_msg()
+        if index not in self.states:
+            if not await self.async_publish([('cmnd/{}/POWER'.format(smartplugs[index][1]), b'')]):
+                return None
+            start = ticks_ms()
+            while index not in self.states and ticks_diff(ticks_ms(), start) < self.timeout * 1000:
+                if not self.check_msg():
+                    await asyncio.sleep(WAIT_MS / 1000)
+        if index not in self.states:
+            return None
+        return {'POWER': PAYLOADS[self.states[index]].decode()}
+
+    def query_messages(self, indices):
+        # returns the unknown plugs among indices and the empty POWER commands asking them for their state
+        self.check_msg()
+        unknown = [index for index in indices if index not in self.states]
+        return unknown, [('cmnd/{}/POWER'.format(smartplugs[index][1]), b'') for index in unknown]
+
+    def query_states(self, indices):
+        # asks the plugs with no published state for it in one burst, returns the plugs still unknown
+        unknown, messages = self.query_messages(indices)
+        if unknown and not self.publish(messages):
+            return []
+        return unknown
+
+    async def async_query_states(self, indices):
+        unknown, messages = self.query_messages(indices)
+        if unknown and not await self.async_publish(messages):
+            return []
+        return unknown
+
+    def known_states(self, indices):
+        return dict((index, self.states[index]) for index in indices if index in self.states)
+
+    def get_states(self, indices=None):
+        # returns a dict of plug index -> relay state for the plugs that have published one
+        indices = range(len(smartplugs)) if indices is None else indices
+        unknown = self.query_states(indices)
+        start = ticks_ms()
+        while any(index not in self.states for index in unknown):
+            remaining = self.timeout - ticks_diff(ticks_ms(), start) / 1000
+            if remaining <= 0:
+                break
+            try:
+                self.client.wait_msg(remaining)
+            except OSError:
+                self.client.close()
+                break
+        return self.known_states(indices)
+
+    async def async_get_states(self, indices=None):
+        indices = range(len(smartplugs)) if indices is None else indices
+        unknown = await self.async_query_states(indices)
+        start = ticks_ms()
+        while any(index not in self.states for index in unknown):
+            if ticks_diff(ticks_ms(), start) > self.timeout * 1000 or self.client.sock is None:
+                break
+            if not self.check_msg():
+                await asyncio.sleep(WAIT_MS / 1000)
+        return self.known_states(indices)
+
+    def pushed_states(self):
+        # returns the (plug index, state) pairs published since the last call, never connects as it is
+        # called on every pass of the timer loop, the next command or poll connects
+        self.check_msg()
+        pairs = list(self.pushed.items())
+        self.pushed = {}
+        return pairs
+
+    def get_name(self, index):
+        if index < len(smartplugs):
+            return smartplugs[index][0]
+        else:
+            return None
@@ -0,0 +1,139 @@
+'''
+  plug_cache.py
+  Last known state cache in front of a smartplug driver
+
+  Plug_State_Cache wraps any driver (My_Kasa, my_tasmota or the simulator's Fake_Plug) and skips
+  commands for a plug already known to be in the requested state. A state is only trusted for
+  max_age_secs after the plug confirmed it, so a plug switched by hand is corrected by the next event.
+  coalesce_events merges on -> off -> on (or off -> on -> off) bursts where the middle state is shorter
+  than coalesce_secs into a single span before the events are queued.
+'''
+
+from timer_utils import const
+from event_store import plug_event
+from dispatch import reply_ok
+
+MAX_AGE_SECS = const(3600) # a confirmed state is resent once it is older than this
+COALESCE_SECS = const(30) # states shorter than this between two equal states are merged away
+SUPPRESSED = 'suppressed' # reply returned for a command that was not sent
+
+
+def coalesce_events(events, coalesce_secs):
+    # returns (events, number of events removed), events for a plug must follow on from each other
+    # to be merged, a merged span is a new event so the horizon's cached windows are left unchanged
+    by_plug = {}
+    for event in events:
+        by_plug.setdefault(event.index, []).append(event)
+    kept = []
+    removed = 0
+    for plug_events in by_plug.values():
+        plug_events.sort(key=lambda event: event.start)
+        merged = []
+        for event in plug_events:
+            if len(merged) >= 2:
+                short, before = merged[-1], merged[-2]
+                if (short.end - short.start < coalesce_secs and before.state == event.state != short.state
+                        and before.end == short.start and short.end == event.start):
+                    merged.pop()
+                    merged[-1] = plug_event(before.start, event.end, before.index, before.state,
+                                            before.name, before.window)
+                    removed += 2
+                    continue
+            merged.append(event)
+        kept.extend(merged)
+    return kept, removed
+
+
+class Plug_State_Cache(object):
+
+    def __init__(self, smartplug, utils, max_age_secs=MAX_AGE_SECS, coalesce_secs=COALESCE_SECS):
+        self.smartplug = smartplug
+        self.utils = utils # Time_utils, used for ticks
+        self.max_age_ms = max_age_secs * 1000
+        self.coalesce_secs = coalesce_secs
+        self.states = {} # plug index -> (state, ticks ms when confirmed)
+        self.counters = {'sent': 0, 'suppressed': 0, 'coalesced': 0}
+
+    def __getattr__(self, name):
+        # anything not cached (get_name, get_plug_state ...) goes straight to the driver,
+        # the batch calls are only available when the driver has them (e.g. My_Kasa)
+        attr = getattr(self.smartplug, name)
+        if name == 'set_states':
+            return self.set_cached_states
+        if name == 'async_set_states':
+            return self.async_set_cached_states
+        return attr
+
+    def is_known(self, index, state):
+        known = self.states.get(index)
+        return (known is not None and known[0] == state and
+            self.utils.ticks_diff(self.utils.ticks_ms(), known[1]) < self.max_age_ms)
+
+    def forget(self, index=None):
+        # forgets the state of the given plug, or of every plug if index is None
+        if index is None:
+            self.states = {}
+        else:
+            self.states.pop(index, None)
+
+    def observe(self, index, state):
+        # records a state read back from the plug
+        self.states[index] = (state, self.utils.ticks_ms())
+
+    def update(self, index, state, reply):
+        # remembers the state if the plug replied, else forgets it as the plug may not have switched
+        self.counters['sent'] += 1
+        if not reply_ok(reply):
+            self.forget(index)
+        else:
+            self.states[index] = (state, self.utils.ticks_ms())
+        return reply
+
+    def set_plug_state(self, index, state):
+        if self.is_known(index, state):
+            self.counters['suppressed'] += 1
+            return SUPPRESSED
+        return self.update(index, state, self.smartplug.set_plug_state(index, state))
+
+    async def async_set_plug_state(self, index, state):
+        if self.is_known(index, state):
+            self.counters['suppressed'] += 1
+            return SUPPRESSED
+        return self.update(index, state, await self.smartplug.async_set_plug_state(index, state))
+
+    def unknown_pairs(self, pairs, replies):
+        # returns the (index, state) pairs that need sending, the others are added to replies as suppressed
+        to_send = []
+        for index, state in pairs:
+            if self.is_known(index, state):
+                self.counters['suppressed'] += 1
+                replies[index] = SUPPRESSED
+            else:
+                to_send.append((index, state))
+        return to_send
+
+    def set_cached_states(self, pairs):
+        replies = {}
+        to_send = self.unknown_pairs(pairs, replies)
+        if to_send:
+            sent = self.smartplug.set_states(to_send)
+            for index, state in to_send:
+                replies[index] = self.update(index, state, sent.get(index))
+        return replies
+
+    async def async_set_cached_states(self, pairs):
+        replies = {}
+        to_send = self.unknown_pairs(pairs, replies)
+        if to_send:
+            sent = await self.smartplug.async_set_states(to_send)
+            for index, state in to_send:
+                replies[index] = self.update(index, state, sent.get(index))
+        return replies
+
+    def coalesce(self, events):
+        # returns the events with short bursts merged, counting the commands saved
+        if self.coalesce_secs <= 0:
+            return events
+        events, removed = coalesce_events(events, self.coalesce_secs)
+        self.counters['coalesced'] += removed
+        return events
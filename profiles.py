@@ -0,0 +1,73 @@
+'''
+  profiles.py
+  Named schedule profiles assigned to plugs or groups of plugs
+
+  config.json holds each profile as a dict of the keys in default_cfg, for example:
+    {"profiles": {"default": {...}, "porch": {...}},
+     "groups": {"downstairs": [0, 1]},
+     "assign": {"downstairs": "default", "2": "porch"}}
+  assign maps a plug index (as a string) or group name to a profile, a plug's own assignment wins
+  over its group's, otherwise the third field of the plug's entry in plugs is used, then 'default'.
+  Profile names are used in html form field names so should be single words.
+
+  Profiles are compiled into schedule_profile objects so the scheduling loop reads precomputed
+  attributes rather than looking up cfg keys for every event.
+'''
+
+DEFAULT_PROFILE = 'default'
+
+
+class schedule_profile(object):
+    __slots__ = ('name', 'sunset', 'start_hour', 'start_min', 'dur_secs', 'on_dur', 'off_dur',
+                 'max_rand_mins', 'min_nbr_sequences', 'max_nbr_sequences')
+
+    def __init__(self, name, cfg):
+        self.name = name
+        self.sunset = cfg['sunset']
+        self.start_hour = cfg['start_hour']
+        self.start_min = cfg['start_min']
+        self.dur_secs = cfg['dur_minutes'] * 60
+        self.on_dur = int(self.dur_secs * cfg['on_percent'] * .01)
+        self.off_dur = int(self.dur_secs - self.on_dur) # total off time, split between the sequences
+        self.max_rand_mins = cfg['max_rand_mins']
+        self.min_nbr_sequences = cfg['min_nbr_sequences']
+        self.max_nbr_sequences = cfg['max_nbr_sequences']
+
+
+def upgrade_config(cfg, defaults):
+    # returns cfg in the profiles format, a config.json from before profiles is a single flat
+    # profile and becomes the default profile. Missing keys are filled from defaults
+    if 'profiles' not in cfg:
+        cfg = {'profiles': {DEFAULT_PROFILE: cfg}}
+    if DEFAULT_PROFILE not in cfg['profiles']:
+        cfg['profiles'][DEFAULT_PROFILE] = {}
+    if 'groups' not in cfg:
+        cfg['groups'] = {}
+    if 'assign' not in cfg:
+        cfg['assign'] = {}
+    for profile in cfg['profiles'].values():
+        for key, value in defaults.items():
+            if key not in profile:
+                profile[key] = value
+    return cfg
+
+
+def compile_profiles(cfg):
+    # returns a dict of profile name -> schedule_profile
+    return dict((name, schedule_profile(name, profile)) for name, profile in cfg['profiles'].items())
+
+
+def plug_profile_name(cfg, plug):
+    # returns the name of the profile used by the given plug tuple (index, inversion[, profile])
+    assign = cfg['assign']
+    name = assign.get(str(plug[0]))
+    if name is None:
+        for group, members in cfg['groups'].items():
+            if plug[0] in members and group in assign:
+                name = assign[group]
+                break
+    if name is None and len(plug) > 2:
+        name = plug[2]
+    if name not in cfg['profiles']:
+        name = DEFAULT_PROFILE
+    return name
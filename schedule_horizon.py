@@ -0,0 +1,72 @@
+'''
+  schedule_horizon.py
+  Generates the daily sequence windows for a rolling multi-day horizon on demand
+
+  Windows are identified by day number (days since the epoch) and only generated when asked for,
+  only the next few are loaded into the event queue and a small cache serves paging from the web page.
+'''
+
+from timer_utils import const
+
+HORIZON_DAYS = const(14) # furthest day ahead that can be generated
+QUEUE_WINDOWS = const(2) # windows loaded into the event queue ahead of time (today and tomorrow)
+CACHE_WINDOWS = const(3) # generated windows kept for paging
+
+
+class Schedule_Horizon(object):
+
+    def __init__(self, generate, horizon_days=HORIZON_DAYS, queue_windows=QUEUE_WINDOWS,
+                 cache_windows=CACHE_WINDOWS):
+        self.generate = generate  # function(day) returning the list of events in that day's window
+        self.horizon_days = horizon_days
+        self.queue_windows = queue_windows
+        self.cache_windows = cache_windows
+        self.cache = {}  # day -> events
+        self.cache_order = []  # cached days, oldest first
+        self.loaded_through = None # last day loaded into the event queue
+
+    def reset(self, first_day):
+        # forget all windows, the next call to next_window starts again from first_day
+        self.cache = {}
+        self.cache_order = []
+        self.loaded_through = first_day - 1
+
+    def invalidate(self):
+        # discards cached windows, e.g. after a config change, windows already loaded are unaffected
+        self.cache = {}
+        self.cache_order = []
+
+    def in_horizon(self, today, day):
+        return today <= day < today + self.horizon_days
+
+    def window(self, day):
+        # returns the events for the given day, generated on first use
+        events = self.cache.get(day)
+        if events is None:
+            events = self.generate(day)
+            self.cache[day] = events
+            self.cache_order.append(day)
+            if len(self.cache_order) > self.cache_windows:
+                del self.cache[self.cache_order.pop(0)]
+        return events
+
+    def stream(self, first_day, nbr_days):
+        # yields (day, events) for consecutive days without keeping them in memory
+        for day in range(first_day, first_day + nbr_days):
+            yield day, self.cache.get(day) or self.generate(day)
+
+    def next_window(self, today):
+        # returns (day, events) for the next window the event queue needs,
+        # or None if queue_windows are already loaded from today onward
+        # yesterday's window is the earliest loaded, as it can still be in progress after midnight
+        if self.loaded_through is None:
+            self.loaded_through = today - 1
+        if self.loaded_through >= today + self.queue_windows - 1:
+            return None
+        day = max(self.loaded_through + 1, today - 1)
+        self.loaded_through = day
+        events = self.window(day)
+        # the queue now holds these events, so drop the cached copy
+        del self.cache[day]
+        self.cache_order.remove(day)
+        return day, events
@@ -0,0 +1,161 @@
+'''
+  simulator.py
+  Fast-forward simulation of Smartplug_Timer on a virtual clock
+
+  Runs the real scheduling code (profiles, horizon windows and the event queue) and the timer's
+  dispatch path (get_due_events and the Plug_State_Cache in front of the driver) against a virtual
+  clock, a seeded random number generator and a fake plug driver that records every command,
+  so months of schedules can be checked in seconds. The default profile is used unless a cfg is
+  given, the local config.json is not read.
+
+  usage: python simulator.py [days] [nbr plugs] [seed] [timeline.csv]
+'''
+
+import sys
+import time
+import random
+
+import timer_utils
+from smartplug_timer import Smartplug_Timer, SECS_PER_DAY, norm, inv, default_cfg
+from profiles import DEFAULT_PROFILE
+
+SIM_START = (2024, 1, 1, 0, 0, 0, 0, 0, -1) # default start so runs are repeatable
+
+
+def sim_cfg():
+    # every plug on the default profile with its default values
+    return {'profiles': {DEFAULT_PROFILE: dict(default_cfg)}}
+
+
+class Virtual_Clock(object):
+
+    def __init__(self, start):
+        self.now = start  # seconds, same epoch as Time_utils.timestamp_now
+
+    def advance_to(self, timestamp):
+        if timestamp > self.now:
+            self.now = timestamp
+
+
+class Sim_Time_utils(timer_utils.Time_utils):
+    # Time_utils reading the virtual clock instead of the real one
+
+    def __init__(self, clock, utc_offset=0):
+        timer_utils.Time_utils.__init__(self, utc_offset)
+        self.clock = clock
+
+    def timestamp_now(self):
+        return int(self.clock.now)
+
+    def timestamp_ms(self):
+        return int(self.clock.now * 1000)
+
+    def ticks_ms(self):
+        return int(self.clock.now * 1000)
+
+    def set_clock(self, rtc_setter = None):
+        return False # there is no ntp in a simulation
+
+
+class Fake_Plug(object):
+    # smartplug driver that records the commands it is sent
+
+    def __init__(self, clock, nbr_plugs):
+        self.clock = clock
+        self.timelines = [[] for i in range(nbr_plugs)] # per plug list of (timestamp, state)
+
+    def get_name(self, index):
+        return 'sim {}'.format(index)
+
+    def set_plug_state(self, index, state):
+        self.timelines[index].append((int(self.clock.now), state))
+        return b'{}'
+
+    async def async_set_plug_state(self, index, state):
+        return self.set_plug_state(index, state)
+
+    def set_states(self, pairs):
+        return dict((index, self.set_plug_state(index, state)) for index, state in pairs)
+
+
+class Simulation(object):
+
+    def __init__(self, nbr_plugs, days, seed=1, cfg=None, start=None):
+        self.nbr_plugs = nbr_plugs
+        self.days = days
+        self.start = start if start is not None else int(time.mktime(SIM_START))
+        self.clock = Virtual_Clock(self.start)
+        self.utils = Sim_Time_utils(self.clock)
+        self.plug = Fake_Plug(self.clock, nbr_plugs)
+        plugs = tuple((i, inv if i % 4 == 3 else norm) for i in range(nbr_plugs))
+        self.timer = Smartplug_Timer(smartplug=self.plug, utils=self.utils, rng=random.Random(seed),
+                                     cfg=cfg if cfg is not None else sim_cfg(), plugs=plugs, hardware=False)
+
+    def run(self):
+        # dispatches every event up to the end of the simulated period as the timer does, returns the number
+        # of events due, commands for plugs already in the requested state are suppressed by the timer's cache
+        end = self.start + self.days * SECS_PER_DAY
+        queue = self.timer.plug_events
+        nbr_events = 0
+        while self.clock.now < end:
+            self.timer.extend_schedule()
+            next_event = queue.peek()
+            if next_event is None or next_event.start >= end:
+                # nothing pending, wake at the next midnight when another window is loaded
+                self.clock.advance_to(min(end, (self.clock.now // SECS_PER_DAY + 1) * SECS_PER_DAY))
+                continue
+            self.clock.advance_to(next_event.start)
+            events = self.timer.get_due_events(self.clock.now)
+            if events:
+                self.timer.smartplug.set_states([(event.index, event.state) for event in events])
+            nbr_events += len(events)
+        return nbr_events
+
+    def stats(self):
+        # returns a list with a dict of summary values for each plug
+        end = self.start + self.days * SECS_PER_DAY
+        results = []
+        for index, timeline in enumerate(self.plug.timelines):
+            on_secs = 0
+            switches = 0
+            state = 0
+            since = self.start
+            for ts, new_state in timeline:
+                if new_state != state:
+                    switches += 1
+                    if state:
+                        on_secs += ts - since
+                    state = new_state
+                    since = ts
+            if state:
+                on_secs += end - since
+            results.append({'plug': index, 'commands': len(timeline), 'switches': switches,
+                            'on_hours_per_day': on_secs / 3600 / self.days, 'final_state': state})
+        return results
+
+    def write_timelines(self, filename):
+        with open(filename, 'w') as fp:
+            fp.write('plug,timestamp,time,state\n')
+            for index, timeline in enumerate(self.plug.timelines):
+                for ts, state in timeline:
+                    fp.write('{},{},{},{}\n'.format(index, ts, self.utils.str_timestamp(ts), state))
+
+
+if __name__ == "__main__":
+    import io
+    from contextlib import redirect_stdout
+
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 365
+    nbr_plugs = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    sim = Simulation(nbr_plugs, days, seed)
+    t = time.time()
+    with redirect_stdout(io.StringIO()): # the timer logs every event
+        nbr_events = sim.run()
+    print("\nsimulated {} days for {} plugs, {} events in {:.1f} s".format(days, nbr_plugs, nbr_events, time.time() - t))
+    print("{:>5} {:>9} {:>9} {:>12} {:>6}".format('plug', 'commands', 'switches', 'on hrs/day', 'final'))
+    for r in sim.stats():
+        print("{plug:>5} {commands:>9} {switches:>9} {on_hours_per_day:>12.2f} {final_state:>6}".format(**r))
+    if len(sys.argv) > 4:
+        sim.write_timelines(sys.argv[4])
+        print("timelines written to", sys.argv[4])
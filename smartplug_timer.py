@@ -1,12 +1,27 @@
 # smartplug_timer.py
 
 import time
-from random import randint
+import random
 import json
 
-from my_kasa import My_Kasa as Smartplug
-# from my_tasmota import my_tasmota as Smartplug
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+from driver_registry import Driver_Registry
 from webserver import my_HTTPserver
+from event_queue import Event_Queue
+from event_store import plug_event
+from dispatch import Batch_Dispatcher
+from schedule_horizon import Schedule_Horizon, QUEUE_WINDOWS
+from interval_index import Interval_Index
+from plug_cache import Plug_State_Cache
+from status_poller import Status_Poller
+from tasmota_timers import Tasmota_Timer_Offload
+from loop_utils import run_until_complete
+import fleet_numpy
+from profiles import DEFAULT_PROFILE, upgrade_config, compile_profiles, plug_profile_name
 import timer_utils
 from timer_utils import const
 from display import Display
@@ -16,40 +31,15 @@ norm = 0
 inv = 1
 off = 0
 on = 1
-plugs = ((2,norm),)
+plugs = ((2,norm),) # (plug index, norm or inv[, profile name[, backend]]), see profiles.py and driver_registry.py
 DISPLAY_SLEEP_MINS = 1
+MAX_WAIT_MS = const(60000) # longest sleep between loop passes so the display timeout is still checked
+SECS_PER_DAY = const(86400)
+OFFLOAD_TIMERS = False # push pending events to the Tasmota on-device timers instead of sending them live
+SEED_STRIDE = const(1 << 20) # more than the largest plug index, so each (day, plug) gets its own seed
+CLOCK_JUMP_MS = const(120000) # wall clock moving this much more or less than the ticks is a clock jump
 
-class plug_event:
-    _util = None
-    
-    # trigger and end are timestamps, index is into plug array, state is 0 if off, 1 if on
-    def __init__(self, start, end, index, state, name = None):
-        self.start = start
-        self.end = end
-        self.index = index
-        self.state = state
-        self.name = name
-        
-    def set_name(self, name):
-        self.name = name
-        
-    def __repr__(self):
-        if plug_event._util:
-            rep = '{} {} {}, end {}'.format(
-                self.name if self.name else "index ".format(self.index),
-                "on" if self.state else "off",
-                plug_event._util.str_timestamp(self.start),
-                plug_event._util.str_timestamp(self.end)
-            )
-        else:
-            rep = 'Utility method not set'
-        return rep
-    
-    @staticmethod
-    def set_util(util):
-        plug_event._util = util    
-
-default_cfg = { # these are defaults, actual values are in config.json
+default_cfg = { # these are defaults for each profile, actual values are in config.json
     'sunset':True, # start at sunset if True
     'start_hour':19,
     'start_min':0,
@@ -59,6 +49,9 @@ default_cfg = { # these are defaults, actual values are in config.json
     'min_nbr_sequences':1,
     'max_nbr_sequences':3 }
 
+schedule_keys = ('sunset', 'start_hour', 'start_min', 'dur_minutes', 'on_percent',  # cfg keys used to generate events
+    'max_rand_mins', 'min_nbr_sequences', 'max_nbr_sequences')
+
 cfg_tags = (  # tuple used to create html cfg tags
     ('C', 1, 'sunset', 'Start sequence at Sunset', None, None),
     ('T', 1, None, 'Or', None, None),
@@ -74,19 +67,55 @@ cfg_tags = (  # tuple used to create html cfg tags
 
 class Smartplug_Timer(object):
 
-    def __init__(self):
-        self.plug_events = [] # sorted queue of pending smartplug events
-        self.cfg = self.load_config()
+    def __init__(self, smartplug=None, utils=None, rng=None, cfg=None, plugs=plugs, hardware=True):
+        # the defaults run the real timer, the simulator passes a fake smartplug driver, a Time_utils
+        # on a virtual clock, a seeded random.Random, its own cfg and plugs, and hardware False to skip
+        # wifi, ntp, the web server and the startup plug test
+        self.plugs = plugs
+        if rng is None:
+            # windows reseed the rng, a private one leaves the global random module alone
+            # MicroPython's random has no Random class, there the timer is the module's only user
+            rng = random.Random() if hasattr(random, 'Random') else random
+        self.rng = rng
+        self.plug_events = Event_Queue() # queue of pending smartplug events ordered by start time
+        self.max_late_ms = 0 # latest wake-up after an event start seen so far
+        self.seed = self.rng.randint(0, 0x3fffffff) # combined with the day and plug number to seed each window
+        self.in_flight = set() # (window, plug index) of sequences with events already dispatched
+        self.last_clock = None # (timestamp ms, ticks ms) when the clock was last checked for jumps
+        self.status_version = 0 # changes with the config, plug states and command counters shown on the status page
+        self.horizon = Schedule_Horizon(lambda day: self.generate_window(self.plugs, day))
+        self.cfg = upgrade_config(cfg, default_cfg) if cfg else self.load_config()
+        self.compile_config()
         self.wifi = WiFi()
-        self.wifi.init_hardware()
-        self.smartplug = Smartplug()
         self.display = Display(DISPLAY_SLEEP_MINS) # display goes to sleep after this interval
         self.display.update('','   Starting','')
         self.display.wake(2716060823) # way in the future
         self.scheduled_time_str = "Not yet Scheduled"
          
-        self.utils = timer_utils.Time_utils(0) # arg is offset from utc
+        self.utils = utils if utils else timer_utils.Time_utils(0) # arg is offset from utc
         plug_event.set_util(self.utils)
+        # commands for plugs already in the requested state are not sent
+        self.smartplug = Plug_State_Cache(smartplug if smartplug else Driver_Registry(self.plugs), self.utils)
+        self.dispatcher = Batch_Dispatcher(self.smartplug, self.utils)
+        self.offload = None
+        self.offloaded = {} # plug index -> timestamp after which its events are on the plug's own timers
+        self.offload_due = False # the queue changed since the timers were last pushed
+        self.timer_plugs = [plug for plug in self.plugs if self.has_timers(plug[0])] if OFFLOAD_TIMERS else []
+        if self.timer_plugs:
+            self.offload = Tasmota_Timer_Offload(self.smartplug)
+        # drivers that can read back the relay states are polled (see status_poller.py)
+        self.poller = Status_Poller(self.smartplug, self.utils) if hasattr(self.smartplug, 'async_get_states') else None
+        self.pushed = {} # plug index -> (state, timestamp) published by drivers with pushed_states (see my_tasmota_mqtt.py)
+        if hardware:
+            self.start_hardware()
+        self.schedule_events(self.plugs)
+        if hardware:
+            self.poll_status()
+            self.reconcile() # plugs may be part way through a sequence after a reboot
+        self.display_status()
+
+    def start_hardware(self):
+        self.wifi.init_hardware()
         self.utils.set_clock(self.utils.pico_rtc_setter)
         self.display.wake(self.utils.timestamp_now()) # reset wake timer
         print("\nScript started at {} on {}".format (self.utils.str_timestamp(self.utils.timestamp_now()),
@@ -99,19 +128,17 @@ class Smartplug_Timer(object):
 
 
         self.display.update(self.wifi.this_ip,'','Scheduling ...',)
+        if hasattr(self.smartplug, 'refresh_registry'): # kasa plugs are rediscovered when the registry expires
+            self.smartplug.refresh_registry()
         self.webserver = my_HTTPserver(self.cfg, cfg_tags, self)
 
-        for plug in plugs:
+        for plug in self.plugs:
             self.smartplug.set_plug_state(plug[0], 1)
             time.sleep(.5)
             self.smartplug.set_plug_state(plug[0], 0)  
-        
-        self.schedule_events(plugs)
-        self.display_status()
-
-
 
     def display_status(self):
+        self.status_version += 1 # called after every dispatch
         if len(self.plug_events):
             for event in self.plug_events:
                 if event.state:                    
@@ -120,7 +147,7 @@ class Smartplug_Timer(object):
                     self.display.update(self.wifi.this_ip, on, off)
                     break;
         else:
-            self.display.update(self.wifi.this_ip, self.utils.str_day_month, 'No events', '')
+            self.display.update(self.wifi.this_ip, 'No events', '')
     
     def save_config(self, data):
         with open("config.json","w") as fp:
@@ -130,34 +157,81 @@ class Smartplug_Timer(object):
         try:
             with open('config.json', 'r') as fp:
                 data = json.load(fp)
-            return data
         except: # FileNotFoundError:
-            return default_cfg # default values
+            data = {} # default values
+        return upgrade_config(data, default_cfg)
+
+    def compile_config(self):
+        # precomputes the schedule profiles and the profile used by each plug
+        self.profiles = compile_profiles(self.cfg)
+        self.plug_profiles = dict((plug[0], plug_profile_name(self.cfg, plug)) for plug in self.plugs)
+        self.profile_sizes = {} # profile name -> number of plugs using it
+        for name in self.plug_profiles.values():
+            self.profile_sizes[name] = self.profile_sizes.get(name, 0) + 1
             
     def update_config(self, updated_dict):
-        is_changed = False
-        if not 'sunset' in updated_dict:
-            updated_dict.update({'sunset':0})  
+        # keys are profile.key as posted by the web form, a key without a profile is for the default profile
+        changed_keys = [] # (profile name, key)
+        for name in self.cfg['profiles']:
+            if not name + '.sunset' in updated_dict:
+                updated_dict.update({name + '.sunset':0})  
         for k, v in updated_dict.items():
             # print(k,v)
+            name, _, key = k.rpartition('.')
+            name = name or DEFAULT_PROFILE
+            profile = self.cfg['profiles'][name]
             if type(v) == str:
                 v = int(v)
-            if self.cfg[k] != v:
-                is_changed = True
-                self.cfg[k] = int(v)
-        if is_changed:
+            if profile[key] != v:
+                changed_keys.append((name, key))
+                profile[key] = int(v)
+        if changed_keys:
+            self.status_version += 1
             self.save_config(self.cfg)
             print("saving changed cfg", self.cfg)
-            self.schedule_events(plugs)
+            self.compile_config()
+            return self.reschedule(changed_keys)
+
+    def reschedule(self, changed_keys):
+        # regenerates the loaded windows of plugs whose profile has changed (profile name, key) pairs
+        # sequences that have already started are kept as they are
+        # returns a dict with the number of plug windows and events regenerated and plug windows kept
+        report = {'windows': 0, 'events': 0, 'kept': 0}
+        changed_profiles = set(name for name, key in changed_keys if key in schedule_keys)
+        affected = [plug for plug in self.plugs if self.plug_profiles[plug[0]] in changed_profiles]
+        if not affected:
+            return report
+        self.horizon.invalidate() # cached previews used the old cfg
+        today = self.today()
+        regenerate = {} # day -> plugs to regenerate
+        for day in range(today - 1, self.horizon.loaded_through + 1):
+            for plug in affected:
+                if (day, plug[0]) in self.in_flight:
+                    report['kept'] += 1
+                else:
+                    regenerate.setdefault(day, []).append(plug)
+                    report['windows'] += 1
+        keys = set((day, plug[0]) for day in regenerate for plug in regenerate[day])
+        self.plug_events.remove_if(lambda event: (event.window, event.index) in keys)
+        now = self.utils.timestamp_now()
+        for day in regenerate:
+            new_events = [event for event in self.smartplug.coalesce(self.generate_window(regenerate[day], day))
+                          if event.end >= now]
+            self.plug_events.load(new_events)
+            report['events'] += len(new_events)
+        self.offload_due = self.offload is not None
+        self.scheduled_time_str = self.utils.str_timestamp(now)
+        print("rescheduled {windows} plug windows ({events} events), kept {kept} in progress".format(**report))
+        return report
 
     def get_eventQ(self):
         for event in self.plug_events:
             yield event 
 
     def ms_to_next_event(self):
-        if len(self.plug_events) > 0:
-            remaining = self.plug_events[0].start - self.utils.timestamp_now()
-            return remaining * 1000  # time in ms
+        next_event = self.plug_events.peek()
+        if next_event:
+            return next_event.start * 1000 - self.utils.timestamp_ms()  # time in ms
         else:
             print('todo ms to next event - no events!')
             return 1000
@@ -167,18 +241,33 @@ class Smartplug_Timer(object):
 
     def get_time_scheduled(self):
         return  self.scheduled_time_str
+
+    def page_version(self):
+        # changes whenever the status page may change, both counters only go up
+        return self.plug_events.version + self.status_version
+
+    def get_command_counters(self):
+        # dict of plug commands sent, suppressed as the plug was already in that state, and coalesced away
+        return self.smartplug.counters
         
-    def get_next_start(self, dur_secs,  hour, minute):
-        t_now = list(time.localtime())
-        t_now[3] = hour
-        t_now[4] = minute
-        next_start = time.mktime(tuple(t_now)) + self.utils.utc_offset
-        if next_start + dur_secs < self.utils.timestamp_now():
-            next_start += 3600*24 # seconds per day
-        return next_start
+    def today(self):
+        return self.utils.timestamp_now() // SECS_PER_DAY
+
+    def window_start(self, profile, day):
+        # returns the timestamp when the profile's sequence window on the given day (days since the epoch) starts
+        noon = day * SECS_PER_DAY + SECS_PER_DAY // 2
+        if profile.sunset:
+            hour, minute = self.utils.get_sunset_time(noon)
+        else:
+            hour, minute = profile.start_hour, profile.start_min
+        tt = list(time.localtime(noon))
+        tt[3] = hour
+        tt[4] = minute
+        tt[5] = 0
+        return int(time.mktime(tuple(tt))) + self.utils.utc_offset
         
-    def rand_secs(self):
-        r = randint(0, self.cfg['max_rand_mins'])
+    def rand_secs(self, max_rand_mins):
+        r = self.rng.randint(0, max_rand_mins)
         r = r-(r/2)
         if r ==0:
             r = 1
@@ -186,35 +275,190 @@ class Smartplug_Timer(object):
         return  int(r*30)
         
     def schedule_events(self, plugs):
-        # plug event tuple: (event trigger time, event end time, plug index, on/off)  (0 is off, 1 is on))
+        # discards pending events and reloads the queue starting with yesterday's window, whose
+        # sequences can still be running after midnight (e.g. a reboot or clock jump at 01:00)
         self.display.wake(self.utils.timestamp_now())
-        new_events = []
         now = self.utils.timestamp_now()
-        date_str = self.utils.str_day_month(now)
-        if self.cfg['sunset']:
-            sunset_hr,sunset_min = self.utils.get_sunset_time(now)
-            print("next sunset at:", sunset_hr,sunset_min)
-            self.cfg['start_hour'] = sunset_hr
-            self.cfg['start_min'] = sunset_min
-        start_hour =  self.cfg['start_hour'] 
-        start_minute =  self.cfg['start_min']      
-        dur_secs = self.cfg['dur_minutes'] *60
-        on_dur = int(dur_secs * self.cfg['on_percent']*.01)
-        min_nbr_sequences = self.cfg['min_nbr_sequences']
-        max_nbr_sequences = self.cfg['max_nbr_sequences']
-        start_timestamp = self.get_next_start(dur_secs, start_hour, start_minute)
+        sunset_hr,sunset_min = self.utils.get_sunset_time(now)
+        for profile in self.cfg['profiles'].values():
+            if profile['sunset']: # show the sunset time in the web form
+                print("next sunset at:", sunset_hr,sunset_min)
+                profile['start_hour'] = sunset_hr
+                profile['start_min'] = sunset_min
         self.scheduled_time_str = self.utils.str_timestamp(now)
+        self.plug_events.clear()   # clear old events
+        self.in_flight = set()
+        self.horizon.reset(self.today() - 1)
+        while self.extend_schedule():
+            pass
+        next_event = self.plug_events.peek()
         print("\nrecalculating at {}, next start: {}".format (self.utils.str_timestamp(now),
-            self.utils.str_timestamp(start_timestamp))) 
-        self.plug_events = []   # clear old events
+            self.utils.str_timestamp(next_event.start) if next_event else 'none')) 
+
+    def extend_schedule(self):
+        # loads the next window into the event queue if fewer than the horizon's queue_windows are loaded
+        # returns True if a window was loaded, cheap enough to call on every loop pass
+        now = self.utils.timestamp_now()
+        window = self.horizon.next_window(now // SECS_PER_DAY)
+        if window is None:
+            return False
+        day, new_events = window
+        new_events = self.smartplug.coalesce(new_events)
+        self.in_flight = set(key for key in self.in_flight if key[0] >= day - QUEUE_WINDOWS)
+        # print("removing events ending prior to", self.utils.str_timestamp(now))
+        pending = [event for event in new_events if event.end >= now]
+        expired = len(new_events) - len(pending)
+        if expired > 0:
+           print("removed {} expired event(s)".format(expired))
+        self.plug_events.load(pending) # heapified once for the whole fleet
+        self.offload_due = self.offload is not None
+        return True
+
+    def has_timers(self, index):
+        # True if the plug's driver has on-device timers, a Driver_Registry asks the plug's own driver
+        has_timers = getattr(self.smartplug, 'has_timers', None)
+        return has_timers(index) if has_timers else hasattr(self.smartplug, 'set_timers')
+
+    async def async_offload_timers(self):
+        # pushes each plug's pending events to its on-device timers, the plugs concurrently, plugs with too
+        # many are sent live, until the pushes are done events are sent live as before
+        self.offload_due = False
+        now = self.utils.timestamp_now()
+        by_plug = {}
+        for event in self.plug_events:
+            by_plug.setdefault(event.index, []).append(event)
+        pushed = await asyncio.gather(*[self.offload.async_push(plug[0], by_plug.get(plug[0], []), now)
+                                        for plug in self.timer_plugs])
+        self.offloaded = dict((plug[0], now) for plug, ok in zip(self.timer_plugs, pushed) if ok)
+        print("{} of {} plugs on device timers, {} timer requests".format(
+            len(self.offloaded), len(self.timer_plugs), self.offload.requests))
+
+    def offload_timers(self):
+        # blocking version of async_offload_timers for the polling main loop
+        if self.offload_due:
+            run_until_complete(self.async_offload_timers())
+
+    def reconcile_events(self, timestamp):
+        # removes every matured event and returns one event per plug with the state it should be in now,
+        # so after a reboot or clock jump each plug is sent its final state rather than every missed event
+        index = Interval_Index(self.plug_events)
+        for event in self.plug_events:
+            if event.start > timestamp:
+                break
+            self.in_flight.add((event.window, event.index))
+        self.plug_events.remove_if(lambda event: event.start <= timestamp)
+        get_name = self.smartplug.get_name
+        events = []
+        for plug in self.plugs:
+            plug_index = plug[0]
+            pos = index.span_at(plug_index, timestamp)
+            if pos >= 0:
+                events.append(plug_event(timestamp, index.ends[plug_index][pos], plug_index,
+                    index.states[plug_index][pos], get_name(plug_index)))
+            else: # between windows
+                end = index.next_change(plug_index, timestamp)
+                events.append(plug_event(timestamp, end or timestamp, plug_index, off, get_name(plug_index)))
+        return events
+        
+    def reconcile(self):
+        # sends every plug the state it should be in now, returns a list of (event, ok, elapsed_ms)
+        events = self.reconcile_events(self.utils.timestamp_now())
+        print("reconciling {} plugs".format(len(events)))
+        results = self.dispatcher.dispatch_now(events)
+        self.display_status()
+        return results
+
+    def observe_states(self, pairs):
+        # (plug index, state) pairs read back from the plugs, commands matching them are not sent
+        for index, state in pairs:
+            self.smartplug.observe(index, state)
+        if pairs:
+            self.status_version += 1
+
+    def observe_pushed(self):
+        # states the plugs published since the last call, from drivers that receive them by push
+        if not hasattr(self.smartplug, 'pushed_states'):
+            return
+        pairs = self.smartplug.pushed_states()
+        now = self.utils.timestamp_now()
+        for index, state in pairs:
+            self.pushed[index] = (state, now)
+        self.observe_states(pairs)
+
+    def poll_status(self):
+        # reads back the plug states if a poll is due and it will finish before the next event
+        if self.poller is None or not self.poller.due(self.utils.timestamp_now()):
+            return
+        if len(self.plug_events) and self.ms_to_next_event() < self.poller.timeout_secs * 1000:
+            return
+        self.observe_states(self.poller.poll_now())
+
+    def get_plug_states(self):
+        # list of (plug name, state, timestamp read) from the last status poll or pushed by the plugs
+        states = dict(self.poller.states) if self.poller else {}
+        states.update(self.pushed)
+        return [(self.smartplug.get_name(index), state, timestamp)
+                for index, (state, timestamp) in sorted(states.items())]
+
+    def clock_jumped(self):
+        # returns True if the wall clock has moved CLOCK_JUMP_MS more or less than the ticks since the last call
+        # (an ntp step or the rtc being set), after which the schedule is reloaded for the new time
+        wall_ms = self.utils.timestamp_ms()
+        ticks = self.utils.ticks_ms()
+        last_clock = self.last_clock
+        self.last_clock = (wall_ms, ticks)
+        if last_clock is None:
+            return False
+        drift = (wall_ms - last_clock[0]) - self.utils.ticks_diff(ticks, last_clock[1])
+        if abs(drift) < CLOCK_JUMP_MS:
+            return False
+        print("clock jumped {} s, rescheduling".format(drift // 1000))
+        self.schedule_events(self.plugs)
+        return True
+
+    def get_window_events(self, day_offset):
+        # returns the events in the window day_offset days from today, or None if beyond the horizon
+        today = self.today()
+        if not self.horizon.in_horizon(today, today + day_offset):
+            return None
+        return self.horizon.window(today + day_offset)
+
+    def generate_window(self, plugs, day):
+        # plug event tuple: (event trigger time, event end time, plug index, on/off)  (0 is off, 1 is on))
+        by_profile = {}
         for plug in plugs:
-            plug_index, inversion = plug 
+            by_profile.setdefault(self.plug_profiles.get(plug[0], DEFAULT_PROFILE), []).append(plug)
+        new_events = []
+        for name, profile_plugs in by_profile.items():
+            profile = self.profiles[name]
+            start_timestamp = self.window_start(profile, day) # once for all the plugs sharing the profile
+            # chosen by the whole profile's size, not the plugs being generated, so regenerating some
+            # of its plugs uses the same generator as a full schedule
+            if fleet_numpy.available and self.profile_sizes.get(name, 0) >= fleet_numpy.MIN_PLUGS:
+                new_events.extend(fleet_numpy.generate_profile_events(profile, profile_plugs,
+                    start_timestamp, day, self.seed, self.smartplug.get_name))
+            else:
+                new_events.extend(self.generate_profile_events(profile, profile_plugs,
+                    start_timestamp, day, self.smartplug.get_name))
+        return new_events
+
+    def generate_profile_events(self, profile, profile_plugs, start_timestamp, day, get_name):
+        # returns the events for the given plugs, all using profile, in the window starting at start_timestamp
+        new_events = []
+        max_rand_mins = profile.max_rand_mins
+        on_dur = profile.on_dur
+        for plug in profile_plugs:
+            plug_index, inversion = plug[:2]
+            # each plug and day always generates the same events, so previews and
+            # plugs regenerated by reschedule match a full schedule_events
+            self.rng.seed(self.seed + day * SEED_STRIDE + plug_index)
+            plug_name = get_name(plug_index)
             # print("plug index=", plug_index)
-            nxt_event_time = int(start_timestamp + self.rand_secs())
+            nxt_event_time = int(start_timestamp + self.rand_secs(max_rand_mins))
             # print("next event time for {} is {}".format(plug, time.gmtime(nxt_event_time)))
-            off_dur = int(dur_secs - on_dur)
-            nbr_sequences = randint(min_nbr_sequences, max_nbr_sequences)
-            # print("totals: on={}, off={}, total dur={}, nbr sequences={}".format(on_dur, off_dur, dur_secs, nbr_sequences))
+            off_dur = profile.off_dur
+            nbr_sequences = self.rng.randint(profile.min_nbr_sequences, profile.max_nbr_sequences)
+            # print("totals: on={}, off={}, total dur={}, nbr sequences={}".format(on_dur, off_dur, profile.dur_secs, nbr_sequences))
        
             if nbr_sequences > 1:
                  off_dur = int(off_dur/(nbr_sequences-1))   
@@ -222,45 +466,24 @@ class Smartplug_Timer(object):
             cume_dur = [0]
 
             for i in range(nbr_sequences):           
-               state_duration.append(int((on_dur / nbr_sequences)) + self.rand_secs())
-               state_duration.append(off_dur + self.rand_secs())
+               state_duration.append(int((on_dur / nbr_sequences)) + self.rand_secs(max_rand_mins))
+               state_duration.append(off_dur + self.rand_secs(max_rand_mins))
             cume =0
             for i in range (len(state_duration)):
                 cume += state_duration[i]
                 cume_dur.append(cume)
             cume_index = 0
             for i in range(nbr_sequences):
-                self.plug_events.append(plug_event(nxt_event_time + cume_dur[cume_index],
-                  nxt_event_time + cume_dur[cume_index+1], plug_index, on^inversion,
-                  self.smartplug.get_name(plug_index)))
+                new_events.append(plug_event(nxt_event_time + cume_dur[cume_index],
+                  nxt_event_time + cume_dur[cume_index+1], plug_index, on^inversion, plug_name, day))
                 cume_index += 1
-                self.plug_events.append(plug_event(nxt_event_time + cume_dur[cume_index], 
-                  nxt_event_time + cume_dur[cume_index+1], plug_index, off^inversion, 
-                  self.smartplug.get_name(plug_index)))
+                new_events.append(plug_event(nxt_event_time + cume_dur[cume_index], 
+                  nxt_event_time + cume_dur[cume_index+1], plug_index, off^inversion, plug_name, day))
                 cume_index += 1
             if inversion:
                     ne = nxt_event_time + cume_dur[cume_index]
-                    self.plug_events.append( plug_event(ne, ne+off_dur, plug_index, 0,
-                    self.smartplug.get_name(plug_index))) # off if inv    
-            
-            self.plug_events = sorted(self.plug_events, key=lambda e: e.start)  # sort by start time
-            # print( '\n'.join(str(y) for y in self.plug_events) )
-            now = self.utils.timestamp_now()
-            # print("removing events ending prior to", self.utils.str_timestamp(now))
-            expired = 0
-            for i in range(len(self.plug_events)):
-                # print(i, self.utils.str_timestamp(self.plug_events[i].end), self.plug_events[i].end < now, self.utils.str_timestamp(now))
-                if self.plug_events[i].end < now:
-                  expired += 1
-            if expired > 0:
-               print("removed {} expired event(s)".format(expired))
-            self.plug_events = self.plug_events[expired:] # remove events that ended before now       
-            # print( '\n'.join(str(y) for y in self.plug_events) )
-            
-        '''    
-        for plug_event in self.plug_events:
-            print(str(plug_event))
-        '''
+                    new_events.append( plug_event(ne, ne+off_dur, plug_index, 0, plug_name, day)) # off if inv    
+        return new_events
    
     def check_display_trigger(self, timestamp):
         # if gpio low then self.wake() else:
@@ -271,33 +494,61 @@ class Smartplug_Timer(object):
         # returns the first unexpired event or None if no events matured
         # the returned event is removed
         self.check_display_trigger(timestamp)
-        if len(self.plug_events) > 0:
-            remaining = self.plug_events[0].start - timestamp
-            # print("remaining", remaining)
-            if remaining <= 0: # true if next event has matured
-                event = self.plug_events[0]
-                print("Event Ready on", self.utils.str_timestamp(timestamp), event, "finishes at", self.utils.str_timestamp(event.end))
-                self.plug_events.pop(0)
-                if len(self.plug_events) > 0:
-                    next_event = self.utils.str_timestamp(self.plug_events[0].start)
-                    print("Processing event on {}, next event at {}".format (self.utils.str_timestamp(timestamp), next_event)) 
-                else:
-                    print("Processing last event on {}\n".format(self.utils.str_timestamp(timestamp))) 
-                return event   
-        return None
+        event = self.plug_events.pop_due(timestamp) # None if next event has not matured
+        if event:
+            print("Event Ready on", self.utils.str_timestamp(timestamp), event, "finishes at", self.utils.str_timestamp(event.end))
+            next_event = self.plug_events.peek()
+            if next_event:
+                print("Processing event on {}, next event at {}".format (self.utils.str_timestamp(timestamp),
+                    self.utils.str_timestamp(next_event.start))) 
+            else:
+                print("Processing last event on {}\n".format(self.utils.str_timestamp(timestamp))) 
+        return event
+
+    def report_lateness(self, event):
+        late_ms = self.utils.timestamp_ms() - event.start * 1000
+        self.max_late_ms = max(self.max_late_ms, late_ms)
+        print("woke {} ms after event start (max {} ms)".format(late_ms, self.max_late_ms))
+
+    def get_due_events(self, timestamp):
+        # removes and returns all events that have matured at the given time
+        due_events = []
+        event = self.check_next_event(timestamp)
+        while event:
+            self.report_lateness(event)
+            self.in_flight.add((event.window, event.index))
+            if event.start <= self.offloaded.get(event.index, event.start):
+                due_events.append(event)
+            else: # the plug switches itself, its cached state no longer holds
+                self.smartplug.forget(event.index)
+            event = self.check_next_event(timestamp)
+        return due_events
 
+    def dispatch_due_events(self):
+        # sends all matured events concurrently, returns a list of (event, ok, elapsed_ms)
+        results = self.dispatcher.dispatch_now(self.get_due_events(self.utils.timestamp_now()))
+        if results:
+            self.display_status()
+        return results
+
+    def run(self):
+        # event driven main loop, sleeps on the web server socket until either
+        # a client connects or the next event is due
+        while(True):
+            if self.clock_jumped():
+                self.reconcile()
+            self.extend_schedule()
+            self.offload_timers()
+            self.observe_pushed()
+            self.poll_status()
+            timeout = min(max(self.ms_to_next_event(), 0), MAX_WAIT_MS)
+            if self.webserver.wait(timeout):
+                self.webserver.listen()
+            self.dispatch_due_events()
 
     
 if __name__ == "__main__":
     timer = Smartplug_Timer()
-    while(True):
-        while len(timer.plug_events) > 0:
-            event = timer.check_next_event(timer.utils.timestamp_now())
-            if event:
-                # print("process", event)
-                timer.smartplug.set_plug_state(event.index, event.state)
-                timer.display_status()
-            timer.webserver.listen()
-        timer.schedule_events(plugs)
-        
+    timer.run()
+
     
\ No newline at end of file
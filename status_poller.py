@@ -0,0 +1,65 @@
+'''
+  status_poller.py
+  Reads back the relay state of every plug in the fleet
+
+  Status_Poller reads every plug's state in one async_get_states call to the driver, which asks the
+  devices at the same time (My_Kasa sends one request per device even for a strip with several
+  outlets), and keeps a table of plug index -> (relay state, timestamp read).
+  Under the asyncio runtime polling is a separate task, the polling loop only polls when the next
+  event is further away than the poll timeout, so neither delays dispatch.
+'''
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+from timer_utils import const
+from loop_utils import run_until_complete
+
+POLL_SECS = const(300) # how often the fleet is read back
+POLL_TIMEOUT_SECS = const(3) # time allowed for all the devices to answer
+
+
+class Status_Poller(object):
+
+    def __init__(self, smartplug, utils, interval_secs=POLL_SECS, timeout_secs=POLL_TIMEOUT_SECS):
+        self.smartplug = smartplug
+        self.utils = utils
+        self.interval_secs = interval_secs
+        self.timeout_secs = timeout_secs
+        self.states = {} # plug index -> (relay state, timestamp read)
+        self.last_poll = None # timestamp of the last poll
+
+    def due(self, timestamp):
+        return self.last_poll is None or timestamp - self.last_poll >= self.interval_secs
+
+    def state(self, index, max_age_secs=None):
+        # returns the last state read for the plug, or None if unknown or older than max_age_secs
+        entry = self.states.get(index)
+        if entry is None:
+            return None
+        if max_age_secs is not None and self.utils.timestamp_now() - entry[1] > max_age_secs:
+            return None
+        return entry[0]
+
+    async def poll(self):
+        # reads every plug, returns the (plug index, state) pairs read
+        self.last_poll = self.utils.timestamp_now()
+        try:
+            states = await asyncio.wait_for(self.smartplug.async_get_states(), self.timeout_secs)
+        except asyncio.TimeoutError:
+            print("status poll timed out")
+            return []
+        except Exception as e: # e.g. a driver that could not parse a reply, the next poll tries again
+            print("status poll failed: {!r}".format(e))
+            return []
+        now = self.utils.timestamp_now()
+        for index, state in states.items():
+            self.states[index] = (state, now)
+        print("read {} plug states".format(len(states)))
+        return list(states.items())
+
+    def poll_now(self):
+        # blocking version of poll for the polling main loop, on the loop dispatch_now uses
+        return run_until_complete(self.poll())
@@ -0,0 +1,272 @@
+'''
+  tasmota_emulator.py
+  Emulated Tasmota plugs on localhost for testing my_tasmota without real devices
+
+  Each emulated plug serves the Tasmota /cm?cmnd= endpoint on its own port of 127.0.0.1 (8080, 8081 ...),
+  with HTTP/1.1 keep-alive, its address in smartplugs is ip:port. It answers Power (with 0, 1, 2, ON, OFF,
+  TOGGLE or nothing to ask), Status, Timer<n>, Timers and Backlog of those commands, as Tasmota does.
+  Replies can be delayed (latency plus random jitter, and connect_ms more for the first request on
+  a connection, as a plug on WiFi takes a round trip or two to accept one), can fail with an HTTP 500
+  error, and the connection is sometimes dropped after a reply.
+  The emulator runs its own asyncio loop in a thread, so blocking and asyncio clients can use it.
+  CPython only.
+
+  usage: python tasmota_emulator.py [nbr plugs] [latency ms] [errors] [drop]
+  benchmarks command latency with and without keep-alive, and dispatch to every emulated plug
+'''
+
+import json
+import random
+import threading
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+MAX_TIMERS = 16
+DISABLED_TIMER = {'Enable': 0, 'Mode': 0, 'Time': '00:00', 'Window': 0, 'Days': '0000000', 'Repeat': 0,
+                  'Output': 1, 'Action': 0}
+POWER_NAMES = ('OFF', 'ON')
+
+
+HOST = '127.0.0.1'
+FIRST_PORT = 8080 # unprivileged, plug n listens on FIRST_PORT + n
+
+
+def url_unquote(text):
+    parts = text.replace('+', ' ').split('%')
+    out = bytearray(parts[0].encode())
+    for part in parts[1:]:
+        out += bytes([int(part[:2], 16)]) + part[2:].encode()
+    return out.decode()
+
+
+class Emulated_Plug(object):
+
+    def __init__(self, n, host=HOST, port=FIRST_PORT):
+        self.host = host
+        self.port = port + n
+        self.ip = '{}:{}'.format(host, self.port) # address as in the smartplugs tuple
+        self.name = 'emulated {}'.format(n)
+        self.topic = 'tasmota_{:06X}'.format(n)
+        self.state = 0
+        self.timers = [dict(DISABLED_TIMER) for i in range(MAX_TIMERS)]
+        self.timers_enabled = 0
+        self.commands = 0
+
+    def status(self):
+        return {'Status': {'Module': 1, 'DeviceName': self.name, 'FriendlyName': [self.name], 'Topic': self.topic,
+                           'ButtonTopic': '0', 'Power': self.state, 'PowerOnState': 3, 'LedState': 1}}
+
+    def command(self, text):
+        # returns the reply dict for one command, as Tasmota does for /cm?cmnd=<text>
+        name, _, value = text.strip().partition(' ')
+        key = name.lower()
+        value = value.strip()
+        self.commands += 1
+        if key in ('power', 'power1'):
+            value = value.upper()
+            if value in ('1', 'ON'):
+                self.state = 1
+            elif value in ('0', 'OFF'):
+                self.state = 0
+            elif value in ('2', 'TOGGLE'):
+                self.state ^= 1
+            elif value:
+                return {'Command': 'Error'}
+            return {'POWER': POWER_NAMES[self.state]}
+        if key == 'status':
+            return self.status()
+        if key == 'timers':
+            if value:
+                self.timers_enabled = 1 if value.upper() in ('1', 'ON') else 0
+            reply = {'Timers': 'ON' if self.timers_enabled else 'OFF'}
+            for group in range(4):
+                reply['Timers{}'.format(group + 1)] = dict(
+                    ('Timer{}'.format(4 * group + i + 1), self.timers[4 * group + i]) for i in range(4))
+            return reply
+        if key.startswith('timer') and key[5:].isdigit() and 1 <= int(key[5:]) <= MAX_TIMERS:
+            slot = int(key[5:]) - 1
+            if value:
+                try:
+                    rule = json.loads(value)
+                except ValueError:
+                    return {'Command': 'Error'}
+                timer = dict(self.timers[slot])
+                timer.update(rule)
+                self.timers[slot] = timer
+            return {name: self.timers[slot]}
+        if key == 'backlog':
+            reply = {}
+            for part in value.split(';'):
+                if part.strip():
+                    reply.update(self.command(part))
+            return reply
+        return {'Command': 'Unknown'}
+
+
+class Tasmota_Emulator(object):
+
+    def __init__(self, nbr_plugs, latency_ms=0, jitter_ms=0, errors=0.0, drop=0.0, connect_ms=0,
+                 host=HOST, port=FIRST_PORT, seed=1):
+        self.plugs = [Emulated_Plug(n, host, port) for n in range(nbr_plugs)]
+        self.latency_ms = latency_ms
+        self.connect_ms = connect_ms
+        self.jitter_ms = jitter_ms
+        self.errors = errors # probability a request fails with an HTTP 500 error
+        self.drop = drop # probability the connection is closed after a reply
+        self.rng = random.Random(seed)
+        self.servers = []
+        self.loop = None
+        self.connections = 0
+        self.drops = 0
+
+    def smartplugs(self):
+        # (name, ip) for each plug, as in the my_tasmota smartplugs tuple
+        return tuple((plug.name, plug.ip) for plug in self.plugs)
+
+    def delay_ms(self):
+        return self.latency_ms + self.rng.random() * self.jitter_ms
+
+    def reply(self, plug, path):
+        # returns (status line, body) for the request path
+        if self.rng.random() < self.errors:
+            return 'HTTP/1.1 500 Internal Server Error', b'{}'
+        base, _, query = path.partition('?')
+        if base != '/cm' or not query.startswith('cmnd='):
+            return 'HTTP/1.1 404 Not Found', b'{}'
+        return 'HTTP/1.1 200 OK', json.dumps(plug.command(url_unquote(query[5:]))).encode()
+
+    async def handle_http(self, plug, reader, writer):
+        self.connections += 1
+        delay_ms = self.connect_ms
+        try:
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+                close = request.rstrip().endswith(b'HTTP/1.0')
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    if line.lower().startswith(b'connection:') and b'close' in line.lower():
+                        close = True
+                status, body = self.reply(plug, request.split(b' ')[1].decode())
+                await asyncio.sleep((delay_ms + self.delay_ms()) / 1000)
+                delay_ms = 0
+                if not close and self.rng.random() < self.drop:
+                    self.drops += 1
+                    close = True
+                writer.write('{}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+                    status, len(body), 'close' if close else 'keep-alive').encode() + body)
+                await writer.drain()
+                if close:
+                    break
+        except (IndexError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        for plug in self.plugs:
+            handler = lambda reader, writer, plug=plug: self.handle_http(plug, reader, writer)
+            self.servers.append(await asyncio.start_server(handler, plug.host, plug.port))
+
+    def start_thread(self):
+        # runs the emulator in a daemon thread, returns once every plug is listening
+        ready = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(self.start())
+            ready.set()
+            self.loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        def shutdown():
+            for server in self.servers:
+                server.close()
+            for task in asyncio.all_tasks(self.loop): # connections kept alive by clients
+                task.cancel()
+            self.loop.call_soon(self.loop.stop) # after the cancelled tasks have run
+
+        self.loop.call_soon_threadsafe(shutdown)
+
+
+if __name__ == "__main__":
+    import sys
+    import io
+    import time
+    from contextlib import redirect_stdout
+
+    import my_tasmota
+    from tasmota_pool import Tasmota_Session_Pool
+    from dispatch import Batch_Dispatcher
+    from event_store import plug_event
+    import timer_utils
+
+    nbr_plugs = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 20
+    errors = float(sys.argv[3]) if len(sys.argv) > 3 else 0.01
+    drop = float(sys.argv[4]) if len(sys.argv) > 4 else 0.05
+    emulator = Tasmota_Emulator(nbr_plugs, latency_ms, latency_ms / 2, errors, drop, latency_ms).start_thread()
+    print("{} plugs, latency {} ms, connect {} ms, errors {}, drop {}".format(nbr_plugs, latency_ms, latency_ms, errors, drop))
+
+    def percentile(values, p):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+    # per command latency to one plug, reusing the connection and opening one per command
+    ip = emulator.plugs[0].ip
+    print("{:>12} {:>10} {:>8} {:>8} {:>8}".format('connection', 'commands', 'ok', 'p50 ms', 'p99 ms'))
+    for name in ('keep-alive', 'per command'):
+        pool = Tasmota_Session_Pool()
+        elapsed = []
+        ok = 0
+        with redirect_stdout(io.StringIO()):
+            for i in range(200):
+                t = time.perf_counter()
+                ok += pool.get(ip, '/cm?cmnd=Power%20' + str(i & 1)) is not None
+                elapsed.append((time.perf_counter() - t) * 1000)
+                if name == 'per command':
+                    pool.close()
+        print("{:>12} {:>10} {:>8} {:>8.1f} {:>8.1f}".format(name, len(elapsed), ok,
+              percentile(elapsed, 0.5), percentile(elapsed, 0.99)))
+        pool.close()
+
+    # fleet wide dispatch through the timer's dispatcher, per plug by a pool of workers and in one batch
+    my_tasmota.smartplugs = emulator.smartplugs()
+    utils = timer_utils.Time_utils(0)
+    tasmota = my_tasmota.my_tasmota()
+
+    class per_plug(object):
+        # hides async_set_states so the dispatcher sends one command per plug
+        def __init__(self, driver):
+            self.async_set_plug_state = driver.async_set_plug_state
+
+    print("{:>10} {:>6} {:>10} {:>10} {:>8} {:>8} {:>8}".format(
+        'mode', 'state', 'plugs', 'total ms', 'ok', 'p50 ms', 'p99 ms'))
+    for name, driver, workers in (('8 workers', per_plug(tasmota), 8), ('64 workers', per_plug(tasmota), 64),
+                                  ('batched', tasmota, 0)):
+        dispatcher = Batch_Dispatcher(driver, utils, max_workers=workers)
+        for state in (1, 0, 1, 0):
+            events = [plug_event(0, 0, index, state) for index in range(nbr_plugs)]
+            t = time.time()
+            with redirect_stdout(io.StringIO()):
+                results = dispatcher.dispatch_now(events)
+            elapsed = [r[2] for r in results]
+            if not workers: # a batch has one elapsed time for every plug, it is the total
+                elapsed = ['-']
+            print("{:>10} {:>6} {:>10} {:>10.0f} {:>8} {:>8} {:>8}".format(
+                name, state, len(events), (time.time() - t) * 1000, len([r for r in results if r[1]]),
+                percentile(elapsed, 0.5), percentile(elapsed, 0.99)))
+    print("plugs off: {} of {}, connections opened: {}, dropped by plugs: {}".format(
+        len([plug for plug in emulator.plugs if plug.state == 0]), nbr_plugs, emulator.connections, emulator.drops))
+    emulator.stop()
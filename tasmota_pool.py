@@ -0,0 +1,273 @@
+'''
+  tasmota_pool.py
+  Keep-alive HTTP connections to Tasmota plugs, one per plug IP
+
+  On CPython each plug gets a requests.Session. On MicroPython (urequests has no sessions), or
+  without requests, a minimal HTTP/1.1 client keeps the socket open between commands. The asyncio
+  path keeps one stream per plug the same way. Every request has a connect and a read timeout, so an
+  unreachable plug cannot hang the loop. A connection the plug has closed is reopened and the request
+  resent once. Per plug stats record the command latency.
+  A plug's address is its ip, or ip:port for a plug not on port 80 (e.g. tasmota_emulator.py).
+'''
+
+import json
+import socket
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+try:
+    import requests
+    if not hasattr(requests, 'Session'):
+        requests = None
+except ImportError:
+    requests = None # MicroPython, see http_connection
+
+from timer_utils import const, ticks_ms, ticks_diff
+from loop_utils import check_loop
+
+CONNECT_TIMEOUT = 2.0 # seconds allowed to open a connection
+READ_TIMEOUT = 3.0 # seconds allowed for the reply
+MAX_BODY = const(8192) # Tasmota command replies are a few hundred bytes
+
+
+class plug_latency(object):
+    # command latency in ms for one plug
+
+    def __init__(self):
+        self.commands = 0
+        self.failures = 0
+        self.total_ms = 0
+        self.max_ms = 0
+
+    def add(self, ms):
+        self.commands += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def __repr__(self):
+        return '{} commands avg {} ms, max {} ms, {} failed'.format(
+            self.commands, self.total_ms // max(self.commands, 1), self.max_ms, self.failures)
+
+
+def host_port(address):
+    # returns (host, port) for an 'ip' or 'ip:port' plug address
+    host, _, port = address.partition(':')
+    return host, int(port) if port else 80
+
+
+def request_bytes(ip, path):
+    return 'GET {} HTTP/1.1\r\nHost: {}\r\nConnection: keep-alive\r\n\r\n'.format(path, ip).encode()
+
+
+def parse_head(head):
+    # returns (status code, content length or None, True if the plug will close the connection)
+    lines = head.split(b'\r\n')
+    status = int(lines[0].split(b' ', 2)[1])
+    length = None
+    close = lines[0].startswith(b'HTTP/1.0')
+    for line in lines[1:]:
+        name, _, value = line.partition(b':')
+        name = name.strip().lower()
+        if name == b'content-length':
+            length = int(value)
+        elif name == b'connection':
+            close = value.strip().lower() == b'close'
+    if length is not None and length > MAX_BODY:
+        raise OSError('reply too long')
+    return status, length, close
+
+
+class http_connection(object):
+    # one keep-alive HTTP/1.1 connection, used where there is no requests.Session
+
+    def __init__(self, ip, connect_timeout, read_timeout):
+        self.ip = ip
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.sock = None
+        self.pending = b'' # bytes received beyond the last reply
+
+    def connect(self):
+        addr = socket.getaddrinfo(*host_port(self.ip))[0][-1]
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.settimeout(self.connect_timeout)
+        try:
+            self.sock.connect(addr)
+        except OSError:
+            self.close()
+            raise
+        self.sock.settimeout(self.read_timeout)
+        self.pending = b''
+
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+
+    def recv_more(self):
+        data = self.sock.recv(1024)
+        if not data:
+            raise OSError('connection closed')
+        self.pending += data
+
+    def get(self, path):
+        # returns (status code, body), raises OSError if the connection failed
+        if self.sock is None:
+            self.connect()
+        self.sock.send(request_bytes(self.ip, path))
+        while b'\r\n\r\n' not in self.pending:
+            self.recv_more()
+        head, _, self.pending = self.pending.partition(b'\r\n\r\n')
+        status, length, close = parse_head(head)
+        if length is None: # body runs to the end of the connection
+            try:
+                while True:
+                    self.recv_more()
+            except OSError:
+                pass
+            length, close = len(self.pending), True
+        while len(self.pending) < length:
+            self.recv_more()
+        body, self.pending = self.pending[:length], self.pending[length:]
+        if close:
+            self.close()
+        return status, body
+
+
+class Tasmota_Session_Pool(object):
+
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.sessions = {} # ip -> requests.Session or http_connection
+        self.streams = {} # ip -> (reader, writer)
+        self.locks = {} # ip -> asyncio.Lock, requests to a plug take turns on its stream
+        self.loop = None # streams and locks belong to the event loop they were made in
+        self.stats = {} # ip -> plug_latency
+
+    def plug_latency(self, ip):
+        if ip not in self.stats:
+            self.stats[ip] = plug_latency()
+        return self.stats[ip]
+
+    def decode(self, ip, body):
+        # returns the json reply, or None if the plug's reply is not json
+        try:
+            return json.loads(body)
+        except ValueError as e:
+            print("Bad reply from {}: {}".format(ip, e))
+            self.plug_latency(ip).failures += 1
+            return None
+
+    def report(self):
+        for ip, stats in self.stats.items():
+            print('{}: {}'.format(ip, stats))
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
+        self.sessions = {}
+        for reader, writer in self.streams.values():
+            writer.close()
+        self.streams = {}
+
+    def session_get(self, ip, path):
+        # returns (status code, body)
+        session = self.sessions.get(ip)
+        if requests:
+            if session is None:
+                session = self.sessions[ip] = requests.Session()
+            response = session.get('http://' + ip + path, timeout=(self.connect_timeout, self.read_timeout))
+            return response.status_code, response.content
+        if session is None:
+            session = self.sessions[ip] = http_connection(ip, self.connect_timeout, self.read_timeout)
+        try:
+            return session.get(path)
+        except OSError:
+            if session.sock is None: # could not connect
+                raise
+            session.close() # the plug closed the idle connection, try once on a new one
+            return session.get(path)
+
+    def get(self, ip, path):
+        # returns the decoded json reply, or None if the plug could not be reached or replied with an error
+        stats = self.plug_latency(ip)
+        start = ticks_ms()
+        try:
+            status, body = self.session_get(ip, path)
+        except Exception as e: # OSError, or requests.RequestException on CPython
+            print("Unable to connect to {}: {}".format(ip, e))
+            stats.failures += 1
+            session = self.sessions.pop(ip, None)
+            if session:
+                session.close()
+            return None
+        stats.add(ticks_diff(ticks_ms(), start))
+        if status != 200:
+            print("Error: {}".format(status))
+            return None
+        return self.decode(ip, body)
+
+    async def stream_get(self, ip, path):
+        # returns (status code, body) on the plug's stream, opening it if needed
+        if ip not in self.streams:
+            self.streams[ip] = await asyncio.wait_for(asyncio.open_connection(*host_port(ip)), self.connect_timeout)
+        reader, writer = self.streams[ip]
+        writer.write(request_bytes(ip, path))
+        await writer.drain()
+        head = b''
+        while True:
+            line = await asyncio.wait_for(reader.readline(), self.read_timeout)
+            if not line:
+                raise OSError('connection closed')
+            if line == b'\r\n':
+                break
+            head += line
+        status, length, close = parse_head(head.rstrip(b'\r\n'))
+        if length is None:
+            body = await asyncio.wait_for(reader.read(MAX_BODY), self.read_timeout)
+            close = True
+        else:
+            body = await asyncio.wait_for(reader.readexactly(length), self.read_timeout)
+        if close:
+            self.streams.pop(ip)[1].close()
+        return status, body
+
+    async def async_get(self, ip, path):
+        # awaitable get, requests to one plug are sent one at a time on its connection
+        check_loop(self)
+        if ip not in self.locks:
+            self.locks[ip] = asyncio.Lock()
+        stats = self.plug_latency(ip)
+        async with self.locks[ip]:
+            start = ticks_ms()
+            for attempt in range(2):
+                reused = ip in self.streams
+                try:
+                    status, body = await self.stream_get(ip, path)
+                    break
+                except (OSError, EOFError, asyncio.TimeoutError) as e:
+                    entry = self.streams.pop(ip, None)
+                    if entry:
+                        entry[1].close()
+                    if not reused: # a new connection failed, no point retrying
+                        print("Unable to connect to {}: {}".format(ip, e))
+                        stats.failures += 1
+                        return None
+                except asyncio.CancelledError:
+                    # the caller's deadline passed mid request, the late reply must not be read as the next one's
+                    entry = self.streams.pop(ip, None)
+                    if entry:
+                        entry[1].close()
+                    raise
+        stats.add(ticks_diff(ticks_ms(), start))
+        if status != 200:
+            print("Error: {}".format(status))
+            return None
+        return self.decode(ip, body)
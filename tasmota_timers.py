@@ -0,0 +1,185 @@
+'''
+  tasmota_timers.py
+  Offloads a plug's pending events to the Tasmota on-device timers
+
+  Each on/off transition becomes one of the 16 Tasmota timers (Timer1 .. Timer16) firing once
+  (Repeat 0) at the event's minute on its weekday, so the plug switches even if the controller is busy
+  or offline. The timers last written to each plug are remembered (read from the plug the first time),
+  only the changed slots are rewritten, all in a single Backlog request, so each plug costs one
+  request per day instead of one per transition. async_push uses the driver's async requests, so the
+  plugs of a fleet are pushed concurrently (see Smartplug_Timer.async_offload_timers).
+  A plug whose pending transitions do not fit in the 16 timers is left to live dispatch, its timers are
+  turned off (Timers 0) so rules written for an earlier schedule do not fire alongside the live commands.
+
+  python tasmota_timers.py runs a push against an emulated Tasmota plug (see tasmota_emulator.py).
+'''
+
+import time
+
+from loop_utils import run_until_complete
+
+MAX_TIMERS = 16 # Tasmota Timer1 .. Timer16
+RULE_KEYS = ('Enable', 'Time', 'Days', 'Repeat', 'Action') # the timer fields that are compared
+DISABLED = {'Enable': 0, 'Mode': 0, 'Time': '00:00', 'Window': 0, 'Days': '0000000', 'Repeat': 0,
+            'Output': 1, 'Action': 0}
+SAFE_CHARS = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_.~'
+
+
+def url_quote(text):
+    # MicroPython has no urllib
+    return ''.join(chr(c) if c in SAFE_CHARS else '%{:02X}'.format(c) for c in text.encode())
+
+
+def timer_rule(timestamp, state):
+    # returns the Tasmota timer switching output 1 to state at the local time minute of timestamp
+    tt = time.localtime(timestamp)
+    days = ['0'] * 7
+    days[(tt[6] + 1) % 7] = '1' # Tasmota days start on Sunday, localtime weekdays on Monday
+    return {'Enable': 1, 'Mode': 0, 'Time': '{:02d}:{:02d}'.format(tt[3], tt[4]), 'Window': 0,
+            'Days': ''.join(days), 'Repeat': 0, 'Output': 1, 'Action': state}
+
+
+def compile_timers(events, after):
+    # returns the timer rules for one plug's events starting after the given timestamp, or None if
+    # the transitions do not fit in MAX_TIMERS, a transition replaces an earlier one in the same minute
+    rules = []
+    state = None
+    for event in sorted(events, key=lambda event: event.start):
+        if event.start <= after or event.state == state:
+            continue
+        state = event.state
+        rule = timer_rule(event.start, state)
+        if rules and rules[-1]['Time'] == rule['Time'] and rules[-1]['Days'] == rule['Days']:
+            rules.pop()
+        rules.append(rule)
+    if len(rules) > MAX_TIMERS:
+        return None
+    return rules
+
+
+def parse_timers(reply):
+    # returns the list of MAX_TIMERS rules from a Timers command reply (grouped as Timers1 .. Timers4)
+    rules = [None] * MAX_TIMERS
+    for key, value in reply.items():
+        if key.startswith('Timers') and isinstance(value, dict):
+            for name, rule in value.items():
+                rules[int(name[5:]) - 1] = rule
+        elif key.startswith('Timer') and key[5:].isdigit(): # single timer reply
+            rules[int(key[5:]) - 1] = value
+    return rules
+
+
+def same_rule(a, b):
+    if a is None or b is None:
+        return False
+    if not a.get('Enable') and not b.get('Enable'):
+        return True # disabled timers match whatever their other fields are
+    return all(a.get(key) == b.get(key) for key in RULE_KEYS)
+
+
+def assign_slots(current, rules):
+    # returns (timers, changes): rules already in a slot keep it, so the timers still to fire are not
+    # rewritten, the other rules go first into slots of timers no longer wanted, unused slots are disabled
+    # changes are the (slot, rule) pairs to write, slots count from 1
+    timers = [None] * MAX_TIMERS
+    remaining = []
+    for rule in rules:
+        for slot in range(MAX_TIMERS):
+            if timers[slot] is None and current[slot] and current[slot].get('Enable') and same_rule(current[slot], rule):
+                timers[slot] = rule
+                break
+        else:
+            remaining.append(rule)
+    free = [slot for slot in range(MAX_TIMERS) if timers[slot] is None]
+    free.sort(key=lambda slot: not (current[slot] and current[slot].get('Enable')))
+    changes = []
+    for slot in free:
+        rule = remaining.pop(0) if remaining else DISABLED
+        timers[slot] = rule
+        if not same_rule(current[slot], rule):
+            changes.append((slot + 1, rule))
+    return timers, changes
+
+
+def backlog_command(changes):
+    # returns the url encoded Backlog command writing the changed timers and enabling timers
+    commands = ['Timer{} {}'.format(slot, json_rule(rule)) for slot, rule in changes]
+    commands.append('Timers 1')
+    return 'Backlog%20' + url_quote('; '.join(commands))
+
+
+TIMERS_OFF = 'Timers%200' # disables every timer, the rules are kept
+
+
+def json_rule(rule):
+    return '{' + ','.join('"{}":{}'.format(key, '"{}"'.format(value) if isinstance(value, str) else value)
+                          for key, value in rule.items()) + '}'
+
+
+class Tasmota_Timer_Offload(object):
+
+    def __init__(self, smartplug):
+        self.smartplug = smartplug # driver with async_get_timers and async_set_timers (see my_tasmota)
+        self.device_timers = {} # plug index -> rules last read from or written to the plug
+        self.disabled = set() # plug indices whose timers were turned off, the next write turns them on
+        self.requests = 0
+        self.writes = 0 # timers rewritten
+
+    def push(self, plug_index, events, after):
+        # blocking version of async_push
+        return run_until_complete(self.async_push(plug_index, events, after))
+
+    async def async_push(self, plug_index, events, after):
+        # writes the plug's pending events to its timers, returns True if the plug's events are offloaded
+        rules = compile_timers(events, after)
+        if rules is None:
+            await self.disable(plug_index)
+            return False
+        current = self.device_timers.get(plug_index)
+        if current is None:
+            self.requests += 1
+            reply = await self.smartplug.async_get_timers(plug_index)
+            if reply is None:
+                return False
+            current = parse_timers(reply)
+        timers, changes = assign_slots(current, rules)
+        if changes or plug_index in self.disabled:
+            self.requests += 1
+            if await self.smartplug.async_set_timers(plug_index, backlog_command(changes)) is None:
+                self.device_timers.pop(plug_index, None) # read them back next time
+                return False
+            self.writes += len(changes)
+            self.disabled.discard(plug_index)
+        self.device_timers[plug_index] = timers
+        return True
+
+    async def disable(self, plug_index):
+        # turns the plug's timers off once, they may hold rules from an earlier push
+        if plug_index in self.disabled:
+            return
+        self.requests += 1
+        if await self.smartplug.async_set_timers(plug_index, TIMERS_OFF) is not None:
+            self.disabled.add(plug_index)
+
+
+if __name__ == "__main__":
+    # pushes ten hourly events to an emulated Tasmota plug, then pushes them again as they change
+    import my_tasmota
+    from tasmota_emulator import Tasmota_Emulator
+    from event_store import plug_event
+
+    emulator = Tasmota_Emulator(1).start_thread()
+    my_tasmota.smartplugs = emulator.smartplugs()
+    offload = Tasmota_Timer_Offload(my_tasmota.my_tasmota())
+    now = int(time.time())
+    events = [plug_event(now + 3600 * i, now + 3600 * (i + 1), 0, i & 1 ^ 1) for i in range(10)]
+    for attempt in ('first push', 'same events', 'one event moved', 'first two events passed'):
+        if attempt == 'one event moved':
+            events[4].start += 600
+        if attempt == 'first two events passed':
+            now += 3600 + 60
+        requests, writes = offload.requests, offload.writes
+        print("{}: offloaded {}, {} requests, {} timers written".format(
+            attempt, offload.push(0, events, now), offload.requests - requests, offload.writes - writes))
+    print([rule['Time'] for rule in emulator.plugs[0].timers if rule['Enable']])
+    emulator.stop()
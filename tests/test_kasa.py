@@ -0,0 +1,82 @@
+'''
+  test_kasa.py
+  My_Kasa switching and batching against the Kasa emulator (see kasa_emulator.py)
+'''
+
+import asyncio
+
+import pytest
+
+import timer_utils
+from my_kasa import My_Kasa
+from kasa_emulator import Kasa_Emulator
+from dispatch import Batch_Dispatcher
+from event_store import plug_event
+
+
+class Slow_Kasa_Emulator(Kasa_Emulator):
+    # devices whose ip is in slow take 2 s before they serve a new connection
+
+    def __init__(self, nbr_devices):
+        Kasa_Emulator.__init__(self, nbr_devices)
+        self.slow = set()
+
+    async def handle_tcp(self, device, reader, writer):
+        if device.ip in self.slow:
+            await asyncio.sleep(2)
+        await Kasa_Emulator.handle_tcp(self, device, reader, writer)
+
+
+@pytest.fixture(scope='module')
+def emulator():
+    # device 0 is a KP303 strip (plugs 0-2), device 1 a HS100 (plug 3), device 2 a KP105 (plug 4)
+    emulator = Slow_Kasa_Emulator(3).start_thread()
+    yield emulator
+    emulator.stop()
+
+
+@pytest.fixture
+def kasa(emulator, tmp_path):
+    kasa = My_Kasa(str(tmp_path / 'registry.json'))
+    kasa.use_registry(emulator.registry())
+    yield kasa
+    kasa.pool.close()
+
+
+def test_set_plug_state(emulator, kasa):
+    assert kasa.set_plug_state(3, 1).ok
+    assert emulator.devices[1].states == [1]
+    assert kasa.set_plug_state(1, 1).ok
+    assert emulator.devices[0].states[1] == 1
+    assert kasa.get_states([1, 3]) == {1: 1, 3: 1}
+
+
+def test_strip_outlets_share_one_command(emulator, kasa):
+    device = emulator.devices[0]
+    commands = device.commands
+    replies = kasa.set_states([(0, 0), (1, 0), (2, 0)])
+    assert all(reply.ok for reply in replies.values())
+    assert device.commands == commands + 1
+    assert device.states == [0, 0, 0]
+
+
+def test_dispatch_batch_reuses_connections(emulator, kasa):
+    dispatcher = Batch_Dispatcher(kasa, timer_utils.Time_utils(0))
+    for state in (1, 0, 1):
+        results = dispatcher.dispatch_now([plug_event(0, 0, index, state) for index in range(5)])
+        assert [ok for event, ok, elapsed_ms in results] == [True] * 5
+    assert [device.states for device in emulator.devices] == [[1, 1, 1], [1], [1]]
+    assert [stats.connects for stats in kasa.pool.stats.values()] == [1, 1, 1]
+
+
+def test_slow_device_fails_alone(emulator, kasa):
+    kasa.deadline_ms = 300
+    emulator.slow.add(emulator.devices[1].ip)
+    try:
+        dispatcher = Batch_Dispatcher(kasa, timer_utils.Time_utils(0))
+        results = dispatcher.dispatch_now([plug_event(0, 0, index, 0) for index in range(5)])
+    finally:
+        emulator.slow.discard(emulator.devices[1].ip)
+    assert [ok for event, ok, elapsed_ms in results] == [True, True, True, False, True]
+    assert emulator.devices[0].states == [0, 0, 0]
+    assert emulator.devices[2].states == [0]
@@ -0,0 +1,74 @@
+'''
+  test_mqtt.py
+  my_tasmota_mqtt switching, batching and pushed states against the stand-in broker (see mqtt_broker.py)
+'''
+
+import time
+
+import pytest
+
+import my_tasmota_mqtt
+import timer_utils
+from mqtt_broker import MQTT_Broker
+from dispatch import Batch_Dispatcher
+from event_store import plug_event
+
+PORT = 18830
+TOPICS = tuple('tasmota_{:06X}'.format(i) for i in range(5))
+
+
+@pytest.fixture(scope='module')
+def broker():
+    broker = MQTT_Broker(TOPICS, port=PORT).start_thread()
+    yield broker
+    broker.stop()
+
+
+@pytest.fixture
+def driver(broker, monkeypatch):
+    monkeypatch.setattr(my_tasmota_mqtt, 'smartplugs', tuple(('plug {}'.format(i), topic) for i, topic in enumerate(TOPICS)))
+    driver = my_tasmota_mqtt.my_tasmota_mqtt('127.0.0.1', PORT)
+    yield driver
+    driver.client.close()
+
+
+def test_set_states_in_one_burst(broker, driver):
+    replies = driver.set_states([(0, 1), (1, 1)])
+    assert replies == {0: {'POWER': 'ON'}, 1: {'POWER': 'ON'}}
+    assert broker.plugs[TOPICS[0]] == broker.plugs[TOPICS[1]] == 1
+    assert driver.get_states([0, 1]) == {0: 1, 1: 1}
+
+
+def test_dispatch_batch(broker, driver):
+    dispatcher = Batch_Dispatcher(driver, timer_utils.Time_utils(0))
+    for state in (1, 0):
+        results = dispatcher.dispatch_now([plug_event(0, 0, index, state) for index in range(5)])
+        assert [ok for event, ok, elapsed_ms in results] == [True] * 5
+    assert not any(broker.plugs.values())
+
+
+def test_pushed_states(broker, driver):
+    assert driver.pushed_states() == [] # not connected, and does not connect
+    assert driver.client.sock is None
+    driver.set_states([(3, 0)]) # connects, every plug then publishes its state
+    while driver.client.wait_msg(0.1):
+        pass
+    driver.pushed_states()
+    broker.press(TOPICS[3])
+    start = time.time()
+    pushed = []
+    while not pushed and time.time() - start < 2:
+        time.sleep(0.01)
+        pushed = driver.pushed_states()
+    assert pushed == [(3, 1)]
+
+
+def test_reconnect_backoff(monkeypatch):
+    monkeypatch.setattr(my_tasmota_mqtt, 'smartplugs', (('plug 0', TOPICS[0]),))
+    driver = my_tasmota_mqtt.my_tasmota_mqtt('127.0.0.1', 1) # nothing listens on port 1
+    connects = []
+    connect = driver.connect
+    monkeypatch.setattr(driver, 'connect', lambda: connects.append(1) or connect())
+    assert driver.set_states([(0, 1)]) == {0: None}
+    assert driver.set_states([(0, 1)]) == {0: None}
+    assert len(connects) == 1
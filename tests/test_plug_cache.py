@@ -0,0 +1,38 @@
+'''
+  test_plug_cache.py
+  coalesce_events and the Plug_State_Cache in front of the simulator's Fake_Plug
+'''
+
+from plug_cache import Plug_State_Cache, coalesce_events, SUPPRESSED
+from simulator import Virtual_Clock, Sim_Time_utils, Fake_Plug
+from event_store import plug_event
+
+
+def test_coalesce_short_off():
+    events = [plug_event(0, 100, 0, 1), plug_event(100, 110, 0, 0), plug_event(110, 200, 0, 1)]
+    kept, removed = coalesce_events(events, 30)
+    assert removed == 2
+    assert [(event.start, event.end, event.state) for event in kept] == [(0, 200, 1)]
+
+
+def test_coalesce_keeps_long_and_separate_spans():
+    events = [plug_event(0, 100, 0, 1), plug_event(100, 160, 0, 0), plug_event(160, 200, 0, 1),
+              plug_event(0, 100, 1, 1), plug_event(100, 110, 1, 0), plug_event(120, 200, 1, 1)]
+    kept, removed = coalesce_events(events, 30)
+    assert removed == 0
+    assert len(kept) == 6
+
+
+def test_cache_suppresses_known_states():
+    clock = Virtual_Clock(1000)
+    utils = Sim_Time_utils(clock)
+    plug = Fake_Plug(clock, 2)
+    cache = Plug_State_Cache(plug, utils, max_age_secs=60)
+    cache.set_states([(0, 1), (1, 1)])
+    replies = cache.set_states([(0, 1), (1, 0)])
+    assert replies[0] == SUPPRESSED
+    assert plug.timelines == [[(1000, 1)], [(1000, 1), (1000, 0)]]
+    clock.advance_to(1100) # older than max_age_secs, resent
+    cache.set_states([(0, 1)])
+    assert plug.timelines[0] == [(1000, 1), (1100, 1)]
+    assert cache.counters['suppressed'] == 1
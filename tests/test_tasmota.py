@@ -0,0 +1,130 @@
+'''
+  test_tasmota.py
+  my_tasmota switching and batching, and the on-device timer offload, against the Tasmota emulator
+  (see tasmota_emulator.py)
+'''
+
+import time
+
+import pytest
+
+import my_tasmota
+import timer_utils
+from tasmota_emulator import Tasmota_Emulator
+from tasmota_timers import Tasmota_Timer_Offload, assign_slots, timer_rule, DISABLED, MAX_TIMERS
+from dispatch import Batch_Dispatcher
+from event_store import plug_event
+
+
+@pytest.fixture(scope='module')
+def emulator():
+    emulator = Tasmota_Emulator(4).start_thread()
+    yield emulator
+    emulator.stop()
+
+
+@pytest.fixture
+def tasmota(emulator, monkeypatch):
+    monkeypatch.setattr(my_tasmota, 'smartplugs', emulator.smartplugs())
+    tasmota = my_tasmota.my_tasmota()
+    yield tasmota
+    tasmota.pool.close()
+
+
+def test_set_plug_state(emulator, tasmota):
+    assert tasmota.set_plug_state(2, 1) == {'POWER': 'ON'}
+    assert emulator.plugs[2].state == 1
+    assert tasmota.get_states([2]) == {2: 1}
+    assert tasmota.set_plug_state(2, 0) == {'POWER': 'OFF'}
+    assert emulator.plugs[2].state == 0
+
+
+def test_dispatch_batch(emulator, tasmota):
+    dispatcher = Batch_Dispatcher(tasmota, timer_utils.Time_utils(0))
+    for state in (1, 0, 1):
+        results = dispatcher.dispatch_now([plug_event(0, 0, index, state) for index in range(4)])
+        assert [ok for event, ok, elapsed_ms in results] == [True] * 4
+    assert [plug.state for plug in emulator.plugs] == [1, 1, 1, 1]
+
+
+def test_dispatch_per_plug_sends_last_state(emulator, tasmota):
+    sent = []
+
+    class per_plug(object):
+        # hides async_set_states so the dispatcher sends one command per plug
+        async def async_set_plug_state(self, index, state):
+            sent.append((index, state))
+            return await tasmota.async_set_plug_state(index, state)
+
+    dispatcher = Batch_Dispatcher(per_plug(), timer_utils.Time_utils(0))
+    results = dispatcher.dispatch_now([plug_event(0, 0, 1, 1), plug_event(0, 0, 3, 1), plug_event(0, 0, 1, 0)])
+    assert sent == [(3, 1), (1, 0)]
+    assert [(event.index, event.state, ok) for event, ok, elapsed_ms in results] == [(1, 1, True), (3, 1, True), (1, 0, True)]
+    assert (emulator.plugs[1].state, emulator.plugs[3].state) == (0, 1)
+
+
+def test_backlog(emulator, tasmota):
+    reply = tasmota.send_request(emulator.plugs[0].ip, 'Backlog%20Power%200%3B%20Status')
+    assert reply['POWER'] == 'OFF'
+    assert reply['Status']['Topic'] == emulator.plugs[0].topic
+
+
+def rules(*minutes):
+    # enabled timer rules at the given minutes past midnight of 2024-01-01, alternately on and off
+    base = int(time.mktime((2024, 1, 1, 0, 0, 0, 0, 0, -1)))
+    return [timer_rule(base + 60 * minute, (i + 1) & 1) for i, minute in enumerate(minutes)]
+
+
+def test_assign_slots_writes_only_changes():
+    current = [dict(DISABLED) for i in range(MAX_TIMERS)]
+    timers, changes = assign_slots(current, rules(60, 120, 180))
+    assert [slot for slot, rule in changes] == [1, 2, 3]
+    assert timers[3:] == [DISABLED] * (MAX_TIMERS - 3)
+    assert assign_slots(timers, rules(60, 120, 180))[1] == []
+
+
+def test_assign_slots_keeps_pending_timers():
+    # the 01:00 timer has fired, 02:00 and 03:00 keep their slots and 04:00 takes the freed slot
+    timers = assign_slots([dict(DISABLED) for i in range(MAX_TIMERS)], rules(60, 120, 180))[0]
+    new_rules = rules(60, 120, 180, 240)[1:]
+    timers, changes = assign_slots(timers, new_rules)
+    assert changes == [(1, new_rules[2])]
+    assert timers[1:3] == new_rules[:2]
+
+
+def test_assign_slots_disables_unwanted_timers():
+    timers = assign_slots([dict(DISABLED) for i in range(MAX_TIMERS)], rules(60, 120))[0]
+    timers, changes = assign_slots(timers, rules(60, 120)[1:])
+    assert changes == [(1, DISABLED)]
+
+
+def test_timer_offload(emulator, tasmota):
+    offload = Tasmota_Timer_Offload(tasmota)
+    now = int(time.time())
+    events = [plug_event(now + 3600 * i, now + 3600 * (i + 1), 1, (i + 1) & 1) for i in range(1, 5)]
+    assert offload.push(1, events, now)
+    assert offload.requests == 2 # read the plug's timers, then write them
+    assert [timer['Time'] for timer in emulator.plugs[1].timers if timer['Enable']] == \
+        [timer_rule(event.start, event.state)['Time'] for event in events]
+    assert emulator.plugs[1].timers_enabled
+    assert offload.push(1, events, now)
+    assert offload.requests == 2 # unchanged, nothing sent
+    events[2].start += 600
+    assert offload.push(1, events, now)
+    assert (offload.requests, offload.writes) == (3, 5)
+
+
+def test_timer_offload_overflow_turns_timers_off(emulator, tasmota):
+    offload = Tasmota_Timer_Offload(tasmota)
+    now = int(time.time())
+    events = [plug_event(now + 3600 * i, now + 3600 * (i + 1), 3, (i + 1) & 1) for i in range(1, 5)]
+    assert offload.push(3, events, now)
+    assert emulator.plugs[3].timers_enabled
+    many = [plug_event(now + 600 * i, now + 600 * (i + 1), 3, (i + 1) & 1) for i in range(1, 20)]
+    assert not offload.push(3, many, now)
+    assert not emulator.plugs[3].timers_enabled
+    requests = offload.requests
+    assert not offload.push(3, many, now)
+    assert offload.requests == requests # already off
+    assert offload.push(3, events, now) # same rules as before, the timers are turned back on
+    assert emulator.plugs[3].timers_enabled
@@ -21,6 +21,14 @@ days = ('Mon','Tue','Wed','Thr','Fri','Sat','Sun')
 months = ('', 'Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep','Oct','Nov','Dec') 
 
 UTC_OFFSET = 0 # hours UTC_OFFSEToffset to local time, ignore DST
+
+# ticks for the modules that have no Time_utils (the connection pools, mqtt_client)
+try:
+    ticks_ms = time.ticks_ms
+    ticks_diff = time.ticks_diff
+except AttributeError:
+    ticks_ms = lambda: int(time.perf_counter() * 1000)
+    ticks_diff = lambda end, start: end - start
     
 class Time_utils(object):
     def __init__(self, utc_offset, tz_region= 'EU'):
@@ -37,8 +45,14 @@ class Time_utils(object):
     def ticks_ms(self):
         if upython:
             return time.ticks_ms()
-        else:    
-            return round(time.time()*1000)
+        else: # monotonic, so the wall clock being stepped can be detected (see Smartplug_Timer.clock_jumped)
+            return round(time.monotonic()*1000)
+
+    def ticks_diff(self, end, start):
+        if upython:
+            return time.ticks_diff(end, start)
+        else:
+            return end - start
 
     def zfl(self, s, width):
         # Pads given string with leading 0's to suit the specified width
@@ -75,14 +89,21 @@ class Time_utils(object):
         '''    
         # print(now, time.localtime(now))   
         return int(now)
+
+    def timestamp_ms(self):
+        # as timestamp_now but in ms, used to time waits to the next event without a second of truncation
+        try:
+            return time.time_ns() // 1000000
+        except AttributeError:
+            return self.timestamp_now() * 1000
         
     def utc_offset(self):
         self.timestamp_now()
         return self.utc_offset
     
-    def get_ntp_ts(self):
+    def get_ntp_ts(self, attempts=2):
         ts = 0
-        remaining_attempts = 2
+        remaining_attempts = attempts
         while ts == 0:
             try:
                 ts = ntptime.time()
@@ -90,19 +111,19 @@ class Time_utils(object):
             except:    
             # except Exception as e:
                 print('ts=', ts, "attempting ntp time")
-                time.sleep(2)
                 ts=0
                 remaining_attempts -= 1
                 if remaining_attempts <=0:
                     return 0
+                time.sleep(2)
                 
         
-    def set_clock(self, rtc_setter = None ):
+    def set_clock(self, rtc_setter = None, attempts = 2):
         """
         calls the given rtc_setter method to sync localtime
         returns True iff synced on this call
         """
-        ts = self.get_ntp_ts()
+        ts = self.get_ntp_ts(attempts)
         if ts == 0:
             return False  
         if self.is_dst(ts, self.tz_region):
@@ -129,7 +150,7 @@ class Time_utils(object):
         if self.time_synced == None:
             return False # time has not yet been synced
         # return true if previous sync was within the time_sync interval
-        return time.ticks_diff(self.ticks_ms(),self.time_synced) < self.time_sync_interval
+        return self.ticks_diff(self.ticks_ms(),self.time_synced) < self.time_sync_interval
     
     def check_sync(self, rtc_setter):
         if not self.is_synced():
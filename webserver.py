@@ -1,5 +1,9 @@
 import socket
 import os
+try:
+    import select
+except ImportError:
+    import uselect as select
 import errno
 import sys
 import time
@@ -11,11 +15,19 @@ except ImportError:
     const = lambda x: x
     upython = False
 
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
 TITLE = 'Smartplug Timer' # Only Bears in the Building
 IMAGE = 'image.jpg' # 'bears.jpg'
 
 SOCK_TIMEOUT = const(1)
 READ_BUF_LEN = 512
+PAGE_HEADER = b'HTTP/1.0 200 OK\r\nContent-type: text/html\r\n\r\n'
+REFRESH_MARK = '%REFRESH%' # stands in for the refresh time in a cached page
+MAX_CACHED_PAGES = const(8) # pages for different days kept at once
 
 content_types = {
     'html': 'text/html',
@@ -27,6 +39,16 @@ content_types = {
     'default': 'text/plain',
 }
 
+class stream_client(object):
+    # gives an asyncio StreamWriter the send method used by the request handlers
+    def __init__(self, writer):
+        self.writer = writer
+
+    def send(self, data):
+        self.writer.write(data)
+        return len(data)
+
+
 class my_HTTPserver(object):
     def __init__(self, cfg, cfg_tags, timer):
         self.cfg = cfg
@@ -36,6 +58,11 @@ class my_HTTPserver(object):
         self.get_time_scheduled = timer.get_time_scheduled
         self.ms_to_next_event = timer.ms_to_next_event
         self.timer = timer
+        # rendered pages, day offset -> (prefix bytes, suffix bytes) either side of the refresh time,
+        # valid while the timer's page_version is unchanged
+        self.page_cache = {}
+        self.page_version = None
+        self.cache_counters = {'hits': 0, 'misses': 0}
 
         addr = socket.getaddrinfo('0.0.0.0', 80)[0][-1]
         self.sock = socket.socket()
@@ -44,8 +71,27 @@ class my_HTTPserver(object):
         self.sock.bind(addr)
         self.send_array = bytearray(READ_BUF_LEN)
         self.sock.listen(5)
+        if hasattr(select, 'poll'):
+            self.poller = select.poll()
+            self.poller.register(self.sock, select.POLLIN)
+        else:
+            self.poller = None # windows has no poll, select is used instead
         print('Ready to listen on', addr)
 
+    def close(self):
+        # releases the listening socket, used when the asyncio runtime serves the port instead
+        if self.poller:
+            self.poller.unregister(self.sock)
+        self.sock.close()
+
+    def wait(self, timeout_ms):
+        # blocks until a client is waiting to connect or timeout_ms has elapsed
+        # returns True if a client is waiting
+        if self.poller:
+            return len(self.poller.poll(timeout_ms)) > 0
+        readable, _, _ = select.select([self.sock], [], [], timeout_ms / 1000)
+        return len(readable) > 0
+
     def listen(self):
         client = None
         try:
@@ -94,6 +140,38 @@ class my_HTTPserver(object):
             self.process_request(request.decode('utf-8'), client)
 
 
+    async def serve_client(self, reader, writer):
+        # asyncio stream handler, reads the headers and any form body then responds as handle_client does
+        try:
+            request = b""
+            while b'\r\n\r\n' not in request:
+                part = await asyncio.wait_for(reader.read(READ_BUF_LEN), 2)
+                if not part:
+                    break
+                request += part
+            header, _, body = request.partition(b'\r\n\r\n')
+            content_length = 0
+            for line in header.split(b'\r\n'):
+                if line.lower().startswith(b'content-length:'):
+                    content_length = int(line[15:])
+            while len(body) < content_length:
+                part = await asyncio.wait_for(reader.read(READ_BUF_LEN), 2)
+                if not part:
+                    break
+                body += part
+                request += part
+            if request:
+                self.process_request(request.decode('utf-8'), stream_client(writer))
+                await writer.drain()
+        except Exception as e:
+            print('Error in serve_client:', e)
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
     def process_request(self, request, client):
         if request.startswith('GET'):
             self.process_get(request, client)
@@ -107,13 +185,43 @@ class my_HTTPserver(object):
         if r[1][1:7] == 'images':
             fname = r[1][1:]
             self.send_file(cl, fname)
+        elif r[1] == '/cache':
+            cl.send(b'HTTP/1.0 200 OK\r\nContent-type: application/json\r\n\r\n' +
+                    '{{"hits": {hits}, "misses": {misses}}}'.format(**self.cache_counters).encode())
         elif r[2][:4] == 'HTTP':
-            ms_to_next_event = str(self.ms_to_next_event())
-            response = self.generate_html(ms_to_next_event, self.get_input_tags())
-            cl.send(b'HTTP/1.0 200 OK\r\nContent-type: text/html\r\n\r\n' + response.encode('utf-8'))
+            prefix, suffix = self.get_page(self.get_day_offset(r[1]))
+            cl.send(prefix + str(self.ms_to_next_event()).encode() + suffix)
         elif len(r) > 0:
             print('unhandled:', r)
 
+    def get_page(self, day_offset):
+        # returns the (prefix, suffix) bytes of the page, only rendered again after the timer's
+        # page_version changes (a timer without one is rendered every time)
+        version = self.timer.page_version() if hasattr(self.timer, 'page_version') else None
+        if version is None or version != self.page_version or len(self.page_cache) >= MAX_CACHED_PAGES:
+            self.page_cache = {}
+            self.page_version = version
+        page = self.page_cache.get(day_offset)
+        if page:
+            self.cache_counters['hits'] += 1
+            return page
+        self.cache_counters['misses'] += 1
+        html = self.generate_html(REFRESH_MARK, self.get_input_tags(), day_offset)
+        prefix, _, suffix = (PAGE_HEADER + html.encode('utf-8')).partition(REFRESH_MARK.encode())
+        page = (prefix, suffix)
+        if version is not None:
+            self.page_cache[day_offset] = page
+        return page
+
+    def get_day_offset(self, path):
+        # returns the day offset from today in a path such as /?day=3, 0 if not given
+        query = path.partition('?')[2]
+        for item in query.split('&'):
+            key, _, value = item.partition('=')
+            if key == 'day' and value.isdigit():
+                return int(value)
+        return 0
+
     def process_post(self, request, cl):
         try:
             start = request.find('\r\n\r\n') + 4
@@ -171,7 +279,7 @@ class my_HTTPserver(object):
             else:
                 raise
             
-    def generate_html(self, refresh_time, content):
+    def generate_html(self, refresh_time, content, day_offset=0):
         html_template = f"""
         <!DOCTYPE html>
         <html>
@@ -206,9 +314,11 @@ class my_HTTPserver(object):
             <h1>{TITLE}</h1>
             <img src="images/{IMAGE}"/>
             <table>
-                <tr><td colspan="2" class="section-title">Pending Events</td></tr>
-                {self.get_pending_events()}
+                <tr><td colspan="2" class="section-title">{'Pending Events' if day_offset == 0 else f'Events in {day_offset} days'}</td></tr>
+                {self.get_pending_events(day_offset)}
                 <tr><td colspan="2" style="text-align: center;">Events were scheduled on {self.get_time_scheduled()}</td></tr>
+                {self.get_command_counters()}
+                {self.get_plug_states()}
                 <tr><td colspan="2"><br><br><hr></td></tr>
             </table>
             <form action="/" method="POST">
@@ -225,14 +335,52 @@ class my_HTTPserver(object):
         """
         return html_template
 
-    def get_pending_events(self):
+    def get_pending_events(self, day_offset=0):
         pending_events_html = []
-        for event in self.get_eventQ():
+        if day_offset == 0:
+            events = self.get_eventQ()
+        else: # future windows are generated on demand by the timer's schedule horizon
+            events = sorted(self.timer.get_window_events(day_offset) or [], key=lambda e: e.start)
+        for event in events:
             if event.state:  # Check the state attribute of the event
                 pending_events_html.append(f'<tr><td colspan="2">{str(event)}</td></tr>')
+        pending_events_html.append(self.get_day_links(day_offset))
         return '\n'.join(pending_events_html)
 
+    def get_command_counters(self):
+        if not hasattr(self.timer, 'get_command_counters'):
+            return ''
+        counters = self.timer.get_command_counters()
+        return '<tr><td colspan="2">Commands sent {sent}, suppressed {suppressed}, coalesced {coalesced}</td></tr>'.format(**counters)
+
+    def get_plug_states(self):
+        # relay states read back by the timer's status poller, no network access here
+        if not hasattr(self.timer, 'get_plug_states'):
+            return ''
+        rows = []
+        for name, state, timestamp in self.timer.get_plug_states():
+            rows.append(f'<tr><td>{name} {"on" if state else "off"}</td><td>read {self.timer.utils.str_timestamp(timestamp)}</td></tr>')
+        return '\n'.join(rows)
+
+    def get_day_links(self, day_offset):
+        # links to page through the days in the timer's schedule horizon
+        prev_link = f'<a href="/?day={day_offset - 1}">Previous day</a>' if day_offset > 0 else ''
+        next_link = ''
+        if hasattr(self.timer, 'horizon') and day_offset + 1 < self.timer.horizon.horizon_days:
+            next_link = f'<a href="/?day={day_offset + 1}">Next day</a>'
+        return f'<tr><td>{prev_link}</td><td>{next_link}</td></tr>'
+
     def get_input_tags(self):
+        # one set of form fields per schedule profile, field names are profile.key
+        if 'profiles' not in self.cfg:
+            return self.get_profile_tags(self.cfg, '')
+        fields = []
+        for name, profile in self.cfg['profiles'].items():
+            fields.append(f'<div class="group group0"><table><tbody><tr><td colspan="2" class="section-title">Profile: {name}</td></tr></tbody></table></div>')
+            fields.append(self.get_profile_tags(profile, name + '.'))
+        return '\n'.join(fields)
+
+    def get_profile_tags(self, cfg, prefix):
         fields = []
 
         current_group = None
@@ -246,12 +394,12 @@ class my_HTTPserver(object):
                 fields.append(f'<div class="group group{group}"><table><tbody>')
 
             if type == 'C':
-                checked = 'checked' if self.cfg[key] else ''
-                fields.append(f'<tr><td colspan="2" style="text-align: center;">{text}<input type="checkbox" name="{key}" value="1" {checked} style="background-color: silver"/>&nbsp;</td></tr>')
+                checked = 'checked' if cfg[key] else ''
+                fields.append(f'<tr><td colspan="2" style="text-align: center;">{text}<input type="checkbox" name="{prefix}{key}" value="1" {checked} style="background-color: silver"/>&nbsp;</td></tr>')
             elif type == 'T':
                 fields.append(f'<tr><td colspan="2" style="text-align: center;">{text}</td></tr>')
             elif type == 'N':
-                fields.append(self.form_input(key, text, min, max, self.cfg[key]))
+                fields.append(self.form_input(prefix + key, text, min, max, cfg[key]))
 
         fields.append('</tbody></table></div>')
 